@@ -1,34 +1,96 @@
+import csv
+import io
 import os
-from flask import Flask, request, abort, jsonify
+from flask import Flask, request, abort, jsonify, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 from flask import logging
-from sqlalchemy import func
+from fsnd_shared.compression import Compression
+from fsnd_shared.instrumentation import Instrumentation
+from fsnd_shared.json_provider import install_json, dumps_bytes
+from fsnd_shared.pool import pool_metrics
+from fsnd_shared.ratelimit import RateLimiter, storage_from_url
 
-from models import setup_db, Question, Category
+from models import setup_db, Question, Category, question_fields
+from replicas import read_only
+from .bulk import ImportAborted, import_questions, import_questions_command, iter_rows
+from .categories import category_cache
+from .counts import question_counts
+from .quiz import quiz_options, quiz_sampler
+from .search import question_search
+from .services import QUESTIONS_PER_PAGE, EXPORT_BATCH, category_service, question_service
 
-QUESTIONS_PER_PAGE = 10
+# per client budget of every route without its own
+DEFAULT_RATE_LIMIT = '50/second'
 
-def pagination_helper(req, selection):
+def page_args(req):
   """
-  req: a json requst
-  select: a sqlAlchemy model (should have format())
-  returns subset
+  req: a flask request
+  returns (page, after_id) from the query string
   """
-  page = req.args.get('page', 1, type=int)
-  start = (page - 1) * QUESTIONS_PER_PAGE
-  end = start + QUESTIONS_PER_PAGE
-  selection_formated = [sel.format() for sel in selection]
-  curr_selection = selection_formated[start:end]
+  return req.args.get('page', 1, type=int), req.args.get('after_id', None, type=int)
 
-  return curr_selection
+def fields_arg(req):
+  """
+  req: a flask request
+  returns the question_fields projection asked for by ?fields=a,b (all
+  fields without it), aborts with 400 on an unknown field
+  """
+  try:
+    return question_fields.parse(req.args.get('fields'))
+  except ValueError:
+    abort(400)
+
+def export_lines(rows, fmt, fields=question_fields.all.fields):
+  """
+  rows: iterable of formatted questions
+  fields: their keys, the CSV columns
+  yields the NDJSON or CSV export body, EXPORT_BATCH rows per chunk
+  """
+  buf = io.StringIO()
+  writer = csv.DictWriter(buf, fieldnames=fields)
+  if fmt == 'csv':
+    writer.writeheader()
+
+  chunk, count = [], 0
+  for row in rows:
+    if fmt == 'csv':
+      writer.writerow(row)
+    else:
+      chunk.append(dumps_bytes(row))
+      chunk.append(b'\n')
+    count += 1
+    if count % EXPORT_BATCH == 0:
+      if fmt == 'csv':
+        chunk.append(buf.getvalue().encode('utf-8'))
+        buf.seek(0)
+        buf.truncate()
+      yield b''.join(chunk)
+      chunk = []
+
+  if fmt == 'csv':
+    chunk.append(buf.getvalue().encode('utf-8'))
+  yield b''.join(chunk)
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
-  setup_db(app)
+  install_json(app)
+  instrumentation = Instrumentation(app)
+  pool_metrics.register_metrics(instrumentation.registry)
+  # registered after Instrumentation so its timings include compressing
+  Compression(app)
+  # test_config holds setup_db arguments, e.g. database_path or create_all
+  setup_db(app, **(test_config or {}))
+  category_cache.invalidate()
+  question_counts.invalidate()
+  quiz_sampler.invalidate()
+  question_search.invalidate()
   CORS(app)
+  app.cli.add_command(import_questions_command)
+  # RATELIMIT_STORAGE_URL=redis://... shares the buckets between workers
+  limiter = RateLimiter(app, default=DEFAULT_RATE_LIMIT, shed=pool_metrics.saturated,
+                        storage=storage_from_url(os.environ.get('RATELIMIT_STORAGE_URL')))
 
   @app.after_request
   def after_request(response):
@@ -41,19 +103,20 @@ def create_app(test_config=None):
     return jsonify({'message': 'home'})
   
   @app.route('/categories', methods=['GET'])
+  @read_only
   def show_categories():
-    cat_list = Category.query.order_by(Category.id).all()
-    categories = {cat.id: cat.type for cat in cat_list}
-    return jsonify({
-      'success': True,
-      'categories': categories
-    })
+    snapshot = category_service.snapshot()
+    response = app.response_class(snapshot.body, mimetype='application/json')
+    response.set_etag(snapshot.etag)
+    # clients may keep it but must revalidate, which costs a 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
   
   @app.route('/questions', methods=['GET'])
+  @read_only
   def show_questions():
-    q_list = Question.query.all()
-    questions = pagination_helper(request, q_list)
-    categories = show_categories().get_json()['categories']
+    questions = question_service.list(*page_args(request), projection=fields_arg(request))
+    categories = category_service.all()
   
     if len(questions) == 0: 
       abort(404)
@@ -61,20 +124,37 @@ def create_app(test_config=None):
     return jsonify({
       'success': True,
       'questions': questions,
-      'total_questions': len(q_list),
+      'total_questions': question_service.total(),
       'categories': categories,
       'current_category': None
     })
 
 
+  # every question, streamed, ?format=ndjson (default) or csv,
+  # filtered by ?category= and the ?min_id= / ?max_id= range
+  @app.route('/questions/export', methods=['GET'])
+  @limiter.limit('1/second', burst=2)
+  @read_only
+  def export_questions():
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+      abort(400)
+    projection = fields_arg(request)
+    rows = question_service.export(
+      category=request.args.get('category', None, type=int),
+      min_id=request.args.get('min_id', None, type=int),
+      max_id=request.args.get('max_id', None, type=int),
+      projection=projection)
+
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(stream_with_context(export_lines(rows, fmt, projection.fields)),
+                    mimetype=mimetype)
+
   @app.route('/questions/<int:question_id>', methods=['DELETE'])
   def delete_question(question_id):
     try:
-      question = Question.query.filter_by(id=question_id).one_or_none()
-
-      if question is None:
+      if not question_service.delete(question_id):
         abort(422)
-      question.delete()
     
     except Exception as e:
 
@@ -89,25 +169,67 @@ def create_app(test_config=None):
   def add_question():
     payload = request.get_json()
     try:
-      new_question = Question(question=payload['question'], answer=payload['answer'],
-                              difficulty=payload['difficulty'], category=payload['category'])
-      new_question.insert()
+      question_service.create(payload['question'], payload['answer'],
+                              payload['category'], payload['difficulty'])
     except Exception as e:
       abort(300)
     
     return jsonify({
       'success': True,
-      'tatal_questions': len(Question.query.all())
+      'tatal_questions': question_service.total()
     })
 
 
+  # bulk import, the body is JSONL (one question per line) or CSV
+  @app.route('/questions/bulk', methods=['POST'])
+  @limiter.limit('1/second', burst=2)
+  def bulk_add_questions():
+    fmt = request.args.get('format')
+    if fmt is None:
+      fmt = 'csv' if request.mimetype == 'text/csv' else 'jsonl'
+    if fmt not in ('jsonl', 'csv'):
+      abort(400)
+    chunk_size = request.args.get('chunk_size', 1000, type=int)
+
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    try:
+      summary = import_questions(iter_rows(stream, fmt), max(chunk_size, 1),
+                                 lambda chunk: app.logger.info('bulk import %s', chunk))
+    except ImportAborted as e:
+      app.logger.exception('bulk import stopped')
+      # the earlier chunks are committed, say how far it got
+      return jsonify({
+        'success': False,
+        'error': 422,
+        'message': 'Unable to insert a chunk, the chunks before it were imported',
+        'inserted': e.summary['inserted'],
+        'rejected': e.summary['rejected'],
+        'chunks': e.summary['chunks'],
+        'errors': e.summary['errors']
+      }), 422
+    except Exception as e:
+      abort(422)
+
+    return jsonify({
+      'success': True,
+      'inserted': summary['inserted'],
+      'rejected': summary['rejected'],
+      'chunks': summary['chunks'],
+      'errors': summary['errors'],
+      'total_questions': question_service.total()
+    })
+
   @app.route('/searchQuestions', methods=['POST'])
+  @limiter.limit('5/second', burst=10)
+  @read_only
   def find_question():
     payload = request.get_json()['searchTerm']
     
+    page = request.args.get('page', 1, type=int)
+    projection = fields_arg(request)
+
     try:
-      q_list = Question.query.filter(func.lower(Question.question).contains(payload.lower())).all()
-      questions = pagination_helper(request, q_list)
+      questions = question_service.search(payload, page, projection)
 
     except Exception as e:
       abort(422)
@@ -115,17 +237,18 @@ def create_app(test_config=None):
     return jsonify({
       'success': True,
       'questions': questions,
-      'total_questions': len(Question.query.all()),
+      'total_questions': question_service.total(),
       'current_category': None
     })
 
 
   @app.route('/categories/<int:cat_id>/questions', methods=['GET'])
+  @read_only
   def show_category_questions(cat_id):
+    projection = fields_arg(request)
 
     try:
-      q_list = Question.query.filter(Question.category==cat_id).all()
-      questions = pagination_helper(request, q_list)
+      questions = question_service.by_category(cat_id, *page_args(request), projection=projection)
     except Exception as e:
       abort(422)
     
@@ -133,32 +256,52 @@ def create_app(test_config=None):
       'success': True,
       'questions': questions,
       'current_category': cat_id,
-      'total_questions': len(Question.query.all())
+      'total_questions': question_service.category_total(cat_id)
     })
 
   @app.route('/quizzes', methods=['POST'])
+  @limiter.limit('10/second', burst=20)
+  @read_only
   def quiz():
     payload = request.get_json()
-    prev_q = payload['previous_questions']
-    category = payload['quiz_category']['id']
-    
-    questions = show_category_questions(category).get_json()['questions'] \
-                if category != 0 else show_questions().get_json()['questions']
+    try:
+      category = int(payload['quiz_category']['id'])
+      prev_q = set(payload.get('previous_questions') or [])
+    except (KeyError, TypeError, ValueError):
+      abort(400)
 
-    app.logger.info(questions)
+    # count, difficulty or seed ask for a batch in "questions"
+    batch = None
+    if any(key in payload for key in ('count', 'difficulty', 'seed')):
+      try:
+        batch = quiz_options(payload)
+      except (TypeError, ValueError):
+        abort(400)
+
+    # optional server side history, {"quiz_session": true} starts one
+    session = payload.get('quiz_session')
+    if session is not None and session is not True and not isinstance(session, str):
+      abort(400)
+    if session is True:
+      session = question_service.start_quiz_session()
     try:
-      if prev_q:
-        questions = [q for q in questions if q['id'] not in prev_q]
-        question = random.choice(questions)
+      if batch is None:
+        question = question_service.quiz_question(category, prev_q, session)
       else:
-        question = random.choice(questions)
-    except IndexError:
-      question = None
+        drawn = question_service.quiz_questions(category, batch[0], prev_q, session, *batch[1:])
+        question = drawn[0] if drawn else None
+    except LookupError:
+      abort(404)
 
-    return jsonify({
+    result = {
       'success': True,
       'question': question
-    })
+    }
+    if batch is not None:
+      result['questions'] = drawn
+    if session:
+      result['quiz_session'] = session
+    return jsonify(result)
 
   @app.errorhandler(404)
   def not_found(error):
@@ -183,6 +326,22 @@ def create_app(test_config=None):
       'error': 400,
       "message": "Invalid data request, please try again"
     }), 400
+
+  @app.errorhandler(429)
+  def too_many_requests(error):
+    return jsonify({
+      'success': False,
+      'error': 429,
+      "message": "Too many requests, slow down and try again"
+    }), 429
+
+  @app.errorhandler(503)
+  def unavailable(error):
+    return jsonify({
+      'success': False,
+      'error': 503,
+      "message": "The server is busy, try again shortly"
+    }), 503
   
   
   return app
@@ -0,0 +1,392 @@
+"""
+ASGI variant of the trivia API, for quiz events where thousands of clients
+poll /quizzes and /categories at once.
+
+It serves the same routes, payloads and error responses as create_app,
+but runs on Starlette with an async driver (asyncpg on postgres,
+aiosqlite on sqlite, through `databases`), so one process keeps many
+requests in flight while they wait on the database.
+Bulk import and export stay on the WSGI app.
+
+    uvicorn --factory flaskr.asgi:create_asgi_app
+"""
+import hashlib
+import random
+import time
+
+from databases import Database
+from fsnd_shared.compression import MIN_SIZE, coded_etag
+from fsnd_shared.json_provider import dumps_bytes
+from fsnd_shared.projection import Projector
+from sqlalchemy import func, select
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+
+from models import database_path, Question, Category, question_fields
+from .counts import COUNTS_TTL
+from .quiz import ALL_CATEGORIES, INDEX_TTL, IdPool, QuizSessions, allocate, draw, quiz_options
+from .search import like_pattern, search_order
+from .services import QUESTIONS_PER_PAGE
+
+questions = Question.__table__
+categories = Category.__table__
+
+ERROR_MESSAGES = {
+  400: 'Invalid data request, please try again',
+  404: 'Resourse was not found, try again',
+  422: 'Unable to access the entity, try again',
+}
+
+
+class JSONResponse(Response):
+  media_type = 'application/json'
+
+  def render(self, content):
+    return dumps_bytes(content)
+
+
+# the question_fields projections, over result rows instead of Question objects
+row_fields = Projector((name, ('obj[{!r}]'.format(name), (name,))) for name in question_fields.fields)
+format_question = row_fields.all.format
+
+
+def page_args(request):
+  def arg(name, default):
+    try:
+      return int(request.query_params[name])
+    except (KeyError, ValueError):
+      return default
+  return arg('page', 1), arg('after_id', None)
+
+
+def fields_arg(request):
+  try:
+    return row_fields.parse(request.query_params.get('fields'))
+  except ValueError:
+    raise HTTPException(400)
+
+
+async def json_body(request):
+  try:
+    return await request.json()
+  except ValueError:
+    raise HTTPException(400)
+
+
+class AsyncTriviaService:
+  """
+  the QuestionService / CategoryService reads and writes over an async
+  connection, with the same in-process caches: category snapshot,
+  counts and quiz id pools. everything runs on one event loop, so the
+  caches need no locks.
+  """
+
+  def __init__(self, database):
+    self.db = database
+    self.sessions = QuizSessions()
+    self._categories = None
+    self._counts = None
+    self._pools = {}
+    # whether postgres has pg_trgm, looked up on the first search
+    self._trigram = None
+
+  async def category_snapshot(self):
+    if self._categories is None:
+      rows = await self.db.fetch_all(select([categories]).order_by(categories.c.id))
+      cat_map = {row['id']: row['type'] for row in rows}
+      body = dumps_bytes({'success': True, 'categories': cat_map}, sort_keys=True) + b'\n'
+      self._categories = (cat_map, body, hashlib.sha256(body).hexdigest()[:32])
+    return self._categories
+
+  async def _load_counts(self):
+    if self._counts is None or time.monotonic() - self._counts[1] > COUNTS_TTL:
+      rows = await self.db.fetch_all(
+        select([questions.c.category, func.count(questions.c.id)]).group_by(questions.c.category))
+      self._counts = ({row[0]: row[1] for row in rows}, time.monotonic())
+    return self._counts[0]
+
+  async def total(self):
+    return sum((await self._load_counts()).values())
+
+  async def category_total(self, cat_id):
+    return (await self._load_counts()).get(cat_id, 0)
+
+  async def page(self, where=None, page=1, after_id=None, projection=row_fields.all):
+    query = select([questions.c[name] for name in projection.columns])
+    if where is not None:
+      query = query.where(where)
+    if after_id is not None:
+      query = query.where(questions.c.id > after_id).order_by(questions.c.id)
+    else:
+      query = query.order_by(questions.c.id).offset((max(page, 1) - 1) * QUESTIONS_PER_PAGE)
+    rows = await self.db.fetch_all(query.limit(QUESTIONS_PER_PAGE))
+    return [projection.format(row) for row in rows]
+
+  async def search(self, term, page=1, projection=row_fields.all):
+    postgres = self.db.url.dialect.startswith('postgres')
+    if postgres and self._trigram is None:
+      self._trigram = await self.db.fetch_val(
+        "SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'") > 0
+    query = self.search_query(term, page, projection, postgres)
+    return [projection.format(row) for row in await self.db.fetch_all(query)]
+
+  def search_query(self, term, page, projection, postgres):
+    offset = (max(page, 1) - 1) * QUESTIONS_PER_PAGE
+    if postgres:
+      # the WSGI PostgresSearch query: ILIKE on the trigram index, ranked by similarity()
+      return select([questions.c[name] for name in projection.columns]) \
+        .where(questions.c.question.ilike(like_pattern(term))) \
+        .order_by(*search_order(term, self._trigram)).offset(offset).limit(QUESTIONS_PER_PAGE)
+    # same order as the in-process index: earliest match, then shortest
+    term = term.lower()
+    position = func.instr(func.lower(questions.c.question), term)
+    # the term is bound once, in a subquery: databases mis-binds repeated parameters on sqlite
+    ranked = select([questions, position.label('position')]).alias('ranked')
+    return select([ranked.c[name] for name in projection.columns]).where(ranked.c.position > 0) \
+      .order_by(ranked.c.position, func.length(ranked.c.question), ranked.c.id) \
+      .offset(offset).limit(QUESTIONS_PER_PAGE)
+
+  async def create(self, question, answer, category, difficulty):
+    # asyncpg does not coerce, a "1" from the client has to become 1 here
+    category = int(category)
+    qid = await self.db.execute(questions.insert().values(
+      question=question, answer=answer, category=category, difficulty=difficulty))
+    self._changed('insert', qid, category, difficulty)
+    return qid
+
+  async def delete(self, question_id):
+    row = await self.db.fetch_one(select([questions.c.category, questions.c.difficulty])
+                                  .where(questions.c.id == question_id))
+    if row is None:
+      return False
+    await self.db.execute(questions.delete().where(questions.c.id == question_id))
+    self._changed('delete', question_id, row['category'], row['difficulty'])
+    return True
+
+  def _changed(self, event, qid, category, difficulty):
+    delta = 1 if event == 'insert' else -1
+    if self._counts is not None:
+      counts = self._counts[0]
+      counts[category] = counts.get(category, 0) + delta
+    for key in ((ALL_CATEGORIES, None), (category, None),
+                (ALL_CATEGORIES, difficulty), (category, difficulty)):
+      entry = self._pools.get(key)
+      if entry is None:
+        continue
+      if event == 'insert':
+        entry[0].add(qid)
+      else:
+        entry[0].remove(qid)
+
+  def _quiz_exclude(self, previous, session):
+    exclude = set(previous)
+    if session:
+      served = self.sessions.served(session)
+      if served is None:
+        raise LookupError(session)
+      exclude |= served
+    return exclude
+
+  async def _pool(self, cat_id, difficulty=None):
+    key = (cat_id, difficulty)
+    entry = self._pools.get(key)
+    if entry is None or time.monotonic() - entry[1] > INDEX_TTL:
+      query = select([questions.c.id])
+      if cat_id != ALL_CATEGORIES:
+        query = query.where(questions.c.category == cat_id)
+      if difficulty is not None:
+        query = query.where(questions.c.difficulty == difficulty)
+      entry = (IdPool(row[0] for row in await self.db.fetch_all(query)), time.monotonic())
+      self._pools[key] = entry
+    return entry[0]
+
+  async def quiz_question(self, cat_id, previous=(), session=None):
+    exclude = self._quiz_exclude(previous, session)
+    qid = (await self._pool(cat_id)).sample(exclude)
+    if qid is None:
+      return None
+    row = await self.db.fetch_one(select([questions]).where(questions.c.id == qid))
+    if row is None:
+      return None
+    if session:
+      self.sessions.record(session, qid)
+    return format_question(row)
+
+  async def quiz_questions(self, cat_id, count, previous=(), session=None, difficulty=None, seed=None):
+    exclude = self._quiz_exclude(previous, session)
+    plan = allocate(count, difficulty)
+    pools = {d: await self._pool(cat_id, d) for d, _ in plan}
+    rng = random.Random(seed) if seed is not None else random
+    ids = draw(pools, plan, exclude, rng, stable=seed is not None)
+    if not ids:
+      return []
+    rows = {row['id']: row for row in
+            await self.db.fetch_all(select([questions]).where(questions.c.id.in_(ids)))}
+    result = [format_question(rows[qid]) for qid in ids if qid in rows]
+    if session and result:
+      self.sessions.record(session, *(q['id'] for q in result))
+    return result
+
+def create_asgi_app(database_url=database_path, debug=False):
+  database = Database(database_url)
+  service = AsyncTriviaService(database)
+
+  async def home(request):
+    return JSONResponse({'message': 'home'})
+
+  async def show_categories(request):
+    cat_map, body, etag = await service.category_snapshot()
+    headers = {'Cache-Control': 'no-cache'}
+    if len(body) >= MIN_SIZE:
+      # GZipMiddleware compresses the body for gzip clients, and adds the
+      # Vary header itself. the gzip variant has its own etag
+      if 'gzip' in request.headers.get('accept-encoding', ''):
+        etag = coded_etag(etag, 'gzip')
+      else:
+        headers['Vary'] = 'Accept-Encoding'
+    quoted = headers['ETag'] = '"{}"'.format(etag)
+    if quoted in request.headers.get('if-none-match', ''):
+      return Response(status_code=304, headers=headers)
+    return Response(body, media_type='application/json', headers=headers)
+
+  async def show_questions(request):
+    result = await service.page(None, *page_args(request), projection=fields_arg(request))
+    if len(result) == 0:
+      raise HTTPException(404)
+    cat_map = (await service.category_snapshot())[0]
+    return JSONResponse({
+      'success': True,
+      'questions': result,
+      'total_questions': await service.total(),
+      'categories': cat_map,
+      'current_category': None
+    })
+
+  async def delete_question(request):
+    if not await service.delete(request.path_params['question_id']):
+      # the WSGI app answers 400 here as well
+      raise HTTPException(400)
+    return JSONResponse({'success': True})
+
+  async def add_question(request):
+    payload = await json_body(request)
+    try:
+      await service.create(payload['question'], payload['answer'],
+                           payload['category'], payload['difficulty'])
+    except (KeyError, TypeError, ValueError):
+      raise HTTPException(422)
+    return JSONResponse({
+      'success': True,
+      'tatal_questions': await service.total()
+    })
+
+  async def find_question(request):
+    payload = await json_body(request)
+    projection = fields_arg(request)
+    try:
+      result = await service.search(payload['searchTerm'], page_args(request)[0], projection)
+    except (KeyError, TypeError, AttributeError):
+      raise HTTPException(422)
+    return JSONResponse({
+      'success': True,
+      'questions': result,
+      'total_questions': await service.total(),
+      'current_category': None
+    })
+
+  async def show_category_questions(request):
+    cat_id = request.path_params['cat_id']
+    result = await service.page(questions.c.category == cat_id, *page_args(request),
+                                projection=fields_arg(request))
+    return JSONResponse({
+      'success': True,
+      'questions': result,
+      'current_category': cat_id,
+      'total_questions': await service.category_total(cat_id)
+    })
+
+  async def quiz(request):
+    payload = await json_body(request)
+    try:
+      category = int(payload['quiz_category']['id'])
+      prev_q = set(payload.get('previous_questions') or [])
+    except (KeyError, TypeError, ValueError):
+      raise HTTPException(400)
+
+    batch = None
+    if any(key in payload for key in ('count', 'difficulty', 'seed')):
+      try:
+        batch = quiz_options(payload)
+      except (TypeError, ValueError):
+        raise HTTPException(400)
+
+    session = payload.get('quiz_session')
+    if session is True:
+      session = service.sessions.start()
+    try:
+      if batch is None:
+        question = await service.quiz_question(category, prev_q, session)
+      else:
+        drawn = await service.quiz_questions(category, batch[0], prev_q, session, *batch[1:])
+        question = drawn[0] if drawn else None
+    except LookupError:
+      raise HTTPException(404)
+
+    result = {
+      'success': True,
+      'question': question
+    }
+    if batch is not None:
+      result['questions'] = drawn
+    if session:
+      result['quiz_session'] = session
+    return JSONResponse(result)
+
+  async def http_error(request, exc):
+    if exc.status_code not in ERROR_MESSAGES:
+      return Response(exc.detail, status_code=exc.status_code)
+    return JSONResponse({
+      'success': False,
+      'error': exc.status_code,
+      'message': ERROR_MESSAGES[exc.status_code]
+    }, status_code=exc.status_code)
+
+  routes = [
+    Route('/', home),
+    Route('/categories', show_categories, methods=['GET']),
+    Route('/questions', show_questions, methods=['GET']),
+    Route('/questions', add_question, methods=['POST']),
+    Route('/questions/{question_id:int}', delete_question, methods=['DELETE']),
+    Route('/searchQuestions', find_question, methods=['POST']),
+    Route('/categories/{cat_id:int}/questions', show_category_questions, methods=['GET']),
+    Route('/quizzes', quiz, methods=['POST']),
+  ]
+  middleware = [
+    Middleware(CORSMiddleware, allow_origins=['*'],
+               allow_headers=['Content-Type', 'Authorization', 'true'],
+               allow_methods=['GET', 'PUT', 'POST', 'DELETE', 'OPTIONS']),
+    # gzip only, per response: the precompressed variants are WSGI side
+    Middleware(GZipMiddleware, minimum_size=MIN_SIZE)
+  ]
+
+  app = Starlette(debug=debug, routes=routes, middleware=middleware,
+                  exception_handlers={HTTPException: http_error},
+                  on_startup=[database.connect], on_shutdown=[database.disconnect])
+  app.state.service = service
+  return app
+
+
+def __getattr__(name):
+  """
+  flaskr.asgi:app is built on first access, so importing the module (for
+  create_asgi_app, or in tests) loads no database driver
+  """
+  if name == 'app':
+    app = globals()['app'] = create_asgi_app()
+    return app
+  raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
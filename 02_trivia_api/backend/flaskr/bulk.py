@@ -0,0 +1,179 @@
+import csv
+import io
+import json
+
+import click
+from flask.cli import with_appcontext
+
+from models import db, Question, Category, DIFFICULTIES, notify_question_change
+
+CHUNK_SIZE = 1000
+MAX_REPORTED_ERRORS = 20
+FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+
+def iter_rows(stream, fmt):
+  """
+  stream: a text stream of JSONL (one question object per line) or CSV
+  (with a question,answer,category,difficulty header)
+  fmt: 'jsonl' or 'csv'
+  yields (line number, row dict) lazily, so the input is never held whole
+  """
+  if fmt == 'csv':
+    for line_no, row in enumerate(csv.DictReader(stream), start=2):
+      yield line_no, row
+    return
+
+  for line_no, line in enumerate(stream, start=1):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      yield line_no, json.loads(line)
+    except ValueError:
+      yield line_no, None
+
+
+class ImportAborted(Exception):
+  """
+  a chunk failed to insert. summary is what import_questions returns,
+  counting the chunks committed before it
+  """
+
+  def __init__(self, summary):
+    super().__init__('import stopped after {} chunks'.format(summary['chunks']))
+    self.summary = summary
+
+
+def integer_field(row, name):
+  """
+  the integer value of row[name]: an int, or digits in a string as CSV
+  gives them. floats and booleans are not read as integers
+  """
+  value = row[name]
+  if isinstance(value, bool) or not isinstance(value, (int, str)):
+    raise ValueError('{} must be an integer'.format(name))
+  try:
+    return int(value)
+  except ValueError:
+    raise ValueError('{} must be an integer'.format(name)) from None
+
+
+def validate_row(row, category_ids):
+  """
+  returns the insert parameters for a row, raises ValueError when invalid
+  """
+  if not isinstance(row, dict):
+    raise ValueError('not a question object')
+  missing = [f for f in FIELDS if row.get(f) in (None, '')]
+  if missing:
+    raise ValueError('missing ' + ', '.join(missing))
+  category = integer_field(row, 'category')
+  if category not in category_ids:
+    raise ValueError('unknown category {}'.format(category))
+  difficulty = integer_field(row, 'difficulty')
+  if difficulty not in DIFFICULTIES:
+    raise ValueError('difficulty must be {} to {}'.format(DIFFICULTIES[0], DIFFICULTIES[-1]))
+  return {
+    'question': str(row['question']),
+    'answer': str(row['answer']),
+    'category': category,
+    'difficulty': difficulty
+  }
+
+
+def _insert_chunk(params):
+  connection = db.session.connection()
+  if connection.dialect.name == 'postgresql':
+    # COPY is far cheaper per row than INSERT on postgres
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for p in params:
+      writer.writerow([p[f] for f in FIELDS])
+    buf.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+      cursor.copy_expert('COPY questions ({}) FROM STDIN WITH CSV'.format(', '.join(FIELDS)), buf)
+    finally:
+      cursor.close()
+  else:
+    connection.execute(Question.__table__.insert(), params)
+
+
+def import_questions(rows, chunk_size=CHUNK_SIZE, progress=None):
+  """
+  rows: iterable of (line number, row dict), as from iter_rows
+  progress: optional callable, given the report of every chunk
+  validates and inserts rows chunk by chunk, one transaction per chunk,
+  invalid rows are skipped and reported.
+  returns a summary dict, raises ImportAborted carrying it when a chunk
+  fails to insert, the chunks before it stay committed
+  """
+  category_ids = {cat_id for cat_id, in db.session.query(Category.id)}
+  summary = {'inserted': 0, 'rejected': 0, 'chunks': 0, 'errors': []}
+
+  def flush(params, rejected):
+    if params:
+      try:
+        _insert_chunk(params)
+        db.session.commit()
+      except Exception as e:
+        db.session.rollback()
+        raise ImportAborted(summary) from e
+    summary['chunks'] += 1
+    summary['inserted'] += len(params)
+    summary['rejected'] += rejected
+    if progress is not None:
+      progress({
+        'chunk': summary['chunks'],
+        'inserted': len(params),
+        'rejected': rejected,
+        'total_inserted': summary['inserted']
+      })
+
+  params, rejected = [], 0
+  try:
+    for line_no, row in rows:
+      try:
+        params.append(validate_row(row, category_ids))
+      except (ValueError, TypeError) as e:
+        rejected += 1
+        if len(summary['errors']) < MAX_REPORTED_ERRORS:
+          summary['errors'].append({'line': line_no, 'error': str(e)})
+      if len(params) + rejected >= chunk_size:
+        flush(params, rejected)
+        params, rejected = [], 0
+    if params or rejected:
+      flush(params, rejected)
+  finally:
+    # listeners were not told about single rows, let them reload
+    if summary['inserted']:
+      notify_question_change('reset', None)
+
+  return summary
+
+
+@click.command('import-questions')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['jsonl', 'csv']),
+              help='input format, guessed from the file extension by default')
+@click.option('--chunk-size', default=CHUNK_SIZE, show_default=True)
+@with_appcontext
+def import_questions_command(path, fmt, chunk_size):
+  """Bulk load questions from a JSONL or CSV file."""
+  fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'jsonl')
+
+  def report(chunk):
+    click.echo('chunk {chunk}: {inserted} inserted, {rejected} rejected '
+               '({total_inserted} so far)'.format(**chunk))
+
+  with open(path, newline='', encoding='utf-8') as stream:
+    try:
+      summary = import_questions(iter_rows(stream, fmt), chunk_size, report)
+    except ImportAborted as e:
+      raise click.ClickException('{} (caused by {!r}), {} questions were imported'.format(
+        e, e.__cause__, e.summary['inserted']))
+
+  click.echo('{inserted} questions imported, {rejected} rejected'.format(**summary))
+  for error in summary['errors']:
+    click.echo('  line {line}: {error}'.format(**error), err=True)
@@ -0,0 +1,49 @@
+import hashlib
+import threading
+from collections import namedtuple
+
+from flask import json
+
+from models import Category
+
+'''
+CategorySnapshot
+    categories: {id: type} map
+    body: the encoded GET /categories response
+    etag: strong etag of body
+'''
+CategorySnapshot = namedtuple('CategorySnapshot', ['categories', 'body', 'etag'])
+
+
+class CategoryCache:
+  """
+  categories hardly ever change, so the map, its encoded response and
+  etag are built once and served from memory until invalidate() is called.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._snapshot = None
+
+  def get(self):
+    snapshot = self._snapshot
+    if snapshot is None:
+      with self._lock:
+        if self._snapshot is None:
+          self._snapshot = self._build()
+        snapshot = self._snapshot
+    return snapshot
+
+  def _build(self):
+    cat_list = Category.query.order_by(Category.id).all()
+    categories = {cat.id: cat.type for cat in cat_list}
+    body = (json.dumps({'success': True, 'categories': categories}, separators=(',', ':')) + '\n').encode('utf-8')
+    etag = hashlib.sha256(body).hexdigest()[:32]
+    return CategorySnapshot(categories, body, etag)
+
+  def invalidate(self):
+    with self._lock:
+      self._snapshot = None
+
+
+category_cache = CategoryCache()
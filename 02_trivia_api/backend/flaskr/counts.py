@@ -0,0 +1,68 @@
+import threading
+import time
+
+from sqlalchemy import func
+
+from models import db, Question, question_listeners
+
+COUNTS_TTL = 300
+
+
+class QuestionCounts:
+  """
+  in-process cache of the number of questions, overall and per category.
+  loaded with one grouped COUNT(*) on a cold start or once ttl seconds
+  have passed, and kept up to date by Question.insert() / delete()
+  in between, so reading a count does not touch the db.
+  """
+
+  def __init__(self, ttl=COUNTS_TTL):
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._total = None
+    self._by_category = {}
+    self._loaded_at = 0.0
+
+  def _stale(self):
+    return self._total is None or time.monotonic() - self._loaded_at > self.ttl
+
+  def _load(self):
+    rows = db.session.query(Question.category, func.count(Question.id)) \
+                     .group_by(Question.category).all()
+    self._by_category = dict(rows)
+    self._total = sum(self._by_category.values())
+    self._loaded_at = time.monotonic()
+
+  def total(self):
+    with self._lock:
+      if self._stale():
+        self._load()
+      return self._total
+
+  def for_category(self, cat_id):
+    with self._lock:
+      if self._stale():
+        self._load()
+      return self._by_category.get(cat_id, 0)
+
+  def invalidate(self):
+    with self._lock:
+      self._total = None
+      self._by_category = {}
+
+  def on_change(self, event, question):
+    if event == 'reset':
+      self.invalidate()
+      return
+    delta = 1 if event == 'insert' else -1
+    with self._lock:
+      # nothing cached yet, the next read loads fresh numbers anyway
+      if self._total is None:
+        return
+      key = question.category
+      self._total += delta
+      self._by_category[key] = self._by_category.get(key, 0) + delta
+
+
+question_counts = QuestionCounts()
+question_listeners.append(question_counts.on_change)
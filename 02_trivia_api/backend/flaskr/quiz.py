@@ -0,0 +1,299 @@
+import bisect
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from models import db, Question, DIFFICULTIES, question_listeners
+
+INDEX_TTL = 300
+SESSION_TTL = 60 * 60
+MAX_SESSIONS = 10000
+MAX_QUIZ_COUNT = 50
+
+# category id the frontend sends for "all categories"
+ALL_CATEGORIES = 0
+
+
+class IdPool:
+  """
+  a set of question ids that supports O(1) random pick and cheap add and
+  remove. ids live in a list, a dict maps each id to its slot so removal
+  can swap the last id into the hole. a sorted copy, kept with bisect,
+  serves stable sampling.
+  """
+
+  def __init__(self, ids=()):
+    self._ids = list(ids)
+    self._slots = {qid: i for i, qid in enumerate(self._ids)}
+    self._sorted = sorted(self._ids)
+
+  def __len__(self):
+    return len(self._ids)
+
+  def add(self, qid):
+    if qid not in self._slots:
+      self._slots[qid] = len(self._ids)
+      self._ids.append(qid)
+      bisect.insort(self._sorted, qid)
+
+  def remove(self, qid):
+    slot = self._slots.pop(qid, None)
+    if slot is None:
+      return
+    last = self._ids.pop()
+    if slot < len(self._ids):
+      self._ids[slot] = last
+      self._slots[last] = slot
+    del self._sorted[bisect.bisect_left(self._sorted, qid)]
+
+  def sample(self, exclude, rng=random):
+    """
+    exclude: a set of ids that must not be returned
+    returns a random id not in exclude, or None when all are excluded
+    """
+    if not self._ids:
+      return None
+    # rejection sampling is O(1) expected while most of the pool is free,
+    # once history covers half of it pick from what is left instead
+    if len(exclude) * 2 < len(self._ids):
+      while True:
+        qid = self._ids[rng.randrange(len(self._ids))]
+        if qid not in exclude:
+          return qid
+    left = [qid for qid in self._ids if qid not in exclude]
+    return rng.choice(left) if left else None
+
+  def sample_many(self, count, exclude, rng=random, stable=False):
+    """
+    returns up to count distinct random ids not in exclude.
+    stable: draw from the ids in sorted order rather than in list slot
+      order, so the result only depends on which ids are in the pool,
+      not on the order they were added or removed in. a seeded rng then
+      gives the same ids in every process.
+    """
+    ids = self._sorted if stable else self._ids
+    picked = []
+    taken = set(exclude)
+    # as in sample(): reject while most of the pool is free, past that
+    # pick from one pass over what is left
+    if (len(taken) + count) * 2 < len(ids):
+      while len(picked) < count:
+        qid = ids[rng.randrange(len(ids))]
+        if qid not in taken:
+          taken.add(qid)
+          picked.append(qid)
+      return picked
+    left = [qid for qid in ids if qid not in taken]
+    return rng.sample(left, min(count, len(left)))
+
+
+def quiz_options(payload):
+  """
+  reads the optional count, difficulty and seed of a /quizzes payload:
+  count: 1 to MAX_QUIZ_COUNT questions
+  difficulty: one difficulty, or a {difficulty: weight} mix
+  seed: an int or string, the same seed draws the same quiz
+  raises ValueError when one is malformed
+  """
+  count = payload.get('count', 1)
+  if isinstance(count, bool) or not isinstance(count, int) or not 1 <= count <= MAX_QUIZ_COUNT:
+    raise ValueError('count must be 1 to {}'.format(MAX_QUIZ_COUNT))
+
+  difficulty = payload.get('difficulty')
+  if isinstance(difficulty, dict):
+    mix = {}
+    for key, weight in difficulty.items():
+      if int(key) not in DIFFICULTIES or isinstance(weight, bool) \
+          or not isinstance(weight, (int, float)) or weight < 0:
+        raise ValueError('bad difficulty mix')
+      if weight:
+        mix[int(key)] = weight
+    if not mix:
+      raise ValueError('bad difficulty mix')
+    difficulty = mix
+  elif difficulty is not None and (isinstance(difficulty, bool) or difficulty not in DIFFICULTIES):
+    raise ValueError('bad difficulty')
+
+  seed = payload.get('seed')
+  if seed is not None and (isinstance(seed, bool) or not isinstance(seed, (int, str))):
+    raise ValueError('seed must be an int or a string')
+  return count, difficulty, seed
+
+
+def allocate(count, difficulty=None):
+  """
+  splits count between difficulties. difficulty is None for any, one
+  difficulty, or a {difficulty: weight} mix shared out by largest
+  remainder. returns [(difficulty, n)] in difficulty order.
+  """
+  if not isinstance(difficulty, dict):
+    return [(difficulty, count)]
+  total = sum(difficulty.values())
+  shares = {d: count * w / total for d, w in sorted(difficulty.items())}
+  plan = {d: int(share) for d, share in shares.items()}
+  left = count - sum(plan.values())
+  for d in sorted(shares, key=lambda d: (int(shares[d]) - shares[d], d))[:left]:
+    plan[d] += 1
+  return list(plan.items())
+
+
+def draw(pools, plan, exclude, rng=random, stable=False):
+  """
+  pools: difficulty -> IdPool for every difficulty in plan
+  plan: [(difficulty, n)] from allocate()
+  returns distinct ids not in exclude, a difficulty that runs short is
+  made up from the others in the plan
+  """
+  count = sum(n for _, n in plan)
+  taken = set(exclude)
+  picked = []
+  for difficulty, n in plan:
+    ids = pools[difficulty].sample_many(n, taken, rng, stable)
+    taken.update(ids)
+    picked.extend(ids)
+  for difficulty, _ in plan:
+    if len(picked) >= count:
+      break
+    ids = pools[difficulty].sample_many(count - len(picked), taken, rng, stable)
+    taken.update(ids)
+    picked.extend(ids)
+  if len(plan) > 1:
+    # otherwise the batch would come sorted by difficulty
+    rng.shuffle(picked)
+  return picked
+
+
+class QuizSampler:
+  """
+  picks quiz questions from an in-memory index of question ids per
+  category (and difficulty), then loads only the chosen rows by primary
+  key. an index is loaded lazily on first use, refreshed after ttl seconds
+  and kept in step with Question.insert() / delete() in between.
+  """
+
+  def __init__(self, ttl=INDEX_TTL):
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._pools = {}
+
+  def _pool(self, cat_id, difficulty=None):
+    key = (cat_id, difficulty)
+    entry = self._pools.get(key)
+    if entry is None or time.monotonic() - entry[1] > self.ttl:
+      query = db.session.query(Question.id)
+      if cat_id != ALL_CATEGORIES:
+        query = query.filter(Question.category == cat_id)
+      if difficulty is not None:
+        query = query.filter(Question.difficulty == difficulty)
+      entry = (IdPool(qid for qid, in query), time.monotonic())
+      self._pools[key] = entry
+    return entry[0]
+
+  def pick_id(self, cat_id, exclude):
+    with self._lock:
+      return self._pool(cat_id).sample(exclude)
+
+  def pick(self, cat_id, exclude):
+    """
+    cat_id: category id, 0 for all categories
+    exclude: a set of question ids already asked
+    returns a random formatted question, or None when none are left
+    """
+    qid = self.pick_id(cat_id, exclude)
+    if qid is None:
+      return None
+    question = Question.query.get(qid)
+    return question.format() if question else None
+
+  def pick_many(self, cat_id, exclude, count, difficulty=None, seed=None):
+    """
+    returns up to count formatted questions, none of them in exclude,
+    loaded in one query. difficulty and seed are as in quiz_options().
+    """
+    plan = allocate(count, difficulty)
+    rng = random.Random(seed) if seed is not None else random
+    with self._lock:
+      pools = {d: self._pool(cat_id, d) for d, _ in plan}
+      ids = draw(pools, plan, exclude, rng, stable=seed is not None)
+    if not ids:
+      return []
+    rows = {q.id: q for q in Question.query.filter(Question.id.in_(ids))}
+    return [rows[qid].format() for qid in ids if qid in rows]
+
+  def invalidate(self):
+    with self._lock:
+      self._pools = {}
+
+  def on_change(self, event, question):
+    if event == 'reset':
+      self.invalidate()
+      return
+    with self._lock:
+      for key in ((ALL_CATEGORIES, None), (question.category, None),
+                  (ALL_CATEGORIES, question.difficulty),
+                  (question.category, question.difficulty)):
+        entry = self._pools.get(key)
+        if entry is None:
+          continue
+        if event == 'insert':
+          entry[0].add(question.id)
+        else:
+          entry[0].remove(question.id)
+
+
+class QuizSessions:
+  """
+  optional server side quiz history, so clients can send a session token
+  instead of a growing previous_questions list.
+  sessions expire after ttl seconds idle, the least recently used are
+  dropped past max_sessions. they are kept in last use order, so both
+  come off the head.
+  """
+
+  def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+    self.ttl = ttl
+    self.max_sessions = max_sessions
+    self._lock = threading.Lock()
+    self._sessions = OrderedDict()
+
+  def start(self):
+    token = secrets.token_urlsafe(16)
+    with self._lock:
+      self._evict()
+      self._sessions[token] = [set(), time.monotonic()]
+    return token
+
+  def served(self, token):
+    """
+    returns a frozenset of the ids served in the session, None if it is
+    unknown or expired
+    """
+    with self._lock:
+      entry = self._sessions.get(token)
+      if entry is None or time.monotonic() - entry[1] > self.ttl:
+        self._sessions.pop(token, None)
+        return None
+      entry[1] = time.monotonic()
+      self._sessions.move_to_end(token)
+      return frozenset(entry[0])
+
+  def record(self, token, *qids):
+    with self._lock:
+      entry = self._sessions.get(token)
+      if entry is not None:
+        entry[0].update(qids)
+
+  def _evict(self):
+    now = time.monotonic()
+    while self._sessions:
+      _, seen = next(iter(self._sessions.values()))
+      if now - seen <= self.ttl and len(self._sessions) < self.max_sessions:
+        break
+      self._sessions.popitem(last=False)
+
+
+quiz_sampler = QuizSampler()
+quiz_sessions = QuizSessions()
+question_listeners.append(quiz_sampler.on_change)
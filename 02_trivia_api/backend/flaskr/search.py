@@ -0,0 +1,255 @@
+import heapq
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy import func, text
+
+from models import db, Question, question_listeners
+
+# made by migration 0003
+TRIGRAM_INDEX = 'ix_questions_question_trgm'
+# seconds the in-memory index is trusted, writes made by other processes
+# show up after at most this long
+INDEX_TTL = 60
+
+
+def trigrams(value):
+  return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+def like_pattern(term):
+  """ILIKE pattern matching term anywhere, its wildcards and the escape character escaped"""
+  return '%{}%'.format(term.replace('\\', '\\\\').replace('%', r'\%').replace('_', r'\_'))
+
+
+def search_order(term, trigram=True):
+  """
+  ORDER BY of the matches of term, best first: trigram similarity when
+  pg_trgm is installed, else the earliest then shortest match, the order
+  InvertedIndexSearch ranks by. ties go by id.
+  """
+  if trigram:
+    return (func.similarity(Question.question, term).desc(), Question.id)
+  return (func.strpos(func.lower(Question.question), term.lower()),
+          func.length(Question.question), Question.id)
+
+
+class PostgresSearch:
+  """
+  substring search on postgres. with pg_trgm and the GIN index of
+  migration 0003 ILIKE '%term%' is an index scan rather than a
+  sequential one. matches are ranked by search_order and paginated in
+  SQL.
+  """
+
+  def __init__(self):
+    self.trigram = None
+    self.indexed = None
+
+  def prepare(self):
+    """looks up, once, whether pg_trgm and the index are there. nothing is created here"""
+    if self.trigram is not None:
+      return
+    with db.engine.connect() as conn:
+      self.trigram = conn.execute(text(
+        "SELECT count(*) FROM pg_extension WHERE extname = 'pg_trgm'")).scalar() > 0
+      self.indexed = conn.execute(text(
+        "SELECT count(*) FROM pg_indexes WHERE tablename = 'questions' AND indexname = :name"),
+        name=TRIGRAM_INDEX).scalar() > 0
+    if not self.indexed:
+      current_app.logger.warning('%s is missing, search scans the questions table. '
+                                 'run flask db upgrade', TRIGRAM_INDEX)
+
+  def search(self, term, offset, limit, options=()):
+    self.prepare()
+    return Question.query.options(*options).filter(Question.question.ilike(like_pattern(term))) \
+                         .order_by(*search_order(term, self.trigram)) \
+                         .offset(offset).limit(limit).all()
+
+  def invalidate(self):
+    self.trigram = self.indexed = None
+
+  def on_change(self, event, question):
+    pass
+
+
+class TrigramIndex:
+  """lowercased question texts by id and the postings of their trigrams"""
+
+  def __init__(self):
+    self.texts = {}
+    self.postings = {}
+
+  def add(self, qid, question):
+    value = (question or '').lower()
+    self.texts[qid] = value
+    for gram in trigrams(value):
+      self.postings.setdefault(gram, set()).add(qid)
+
+  def remove(self, qid):
+    value = self.texts.pop(qid, None)
+    if value is None:
+      return
+    for gram in trigrams(value):
+      ids = self.postings.get(gram)
+      if ids is not None:
+        ids.discard(qid)
+        if not ids:
+          del self.postings[gram]
+
+  def apply(self, event, qid, question):
+    if event == 'insert':
+      self.add(qid, question)
+    else:
+      self.remove(qid)
+
+  def match(self, term):
+    grams = trigrams(term)
+    if not grams:
+      # too short for a trigram, check every text (no db access though)
+      return [qid for qid, value in self.texts.items() if term in value]
+    postings = sorted((self.postings.get(g, set()) for g in grams), key=len)
+    candidates = set(postings[0]).intersection(*postings[1:])
+    return [qid for qid in candidates if term in self.texts[qid]]
+
+  def rank(self, term, offset, limit):
+    # earlier and tighter matches rank first, only the ranks up to the
+    # page are ordered
+    texts = self.texts
+    page = heapq.nsmallest(offset + limit, self.match(term),
+                           key=lambda qid: (texts[qid].find(term), len(texts[qid]), qid))
+    return page[offset:]
+
+
+def load_index():
+  index = TrigramIndex()
+  for qid, question in db.session.query(Question.id, Question.question):
+    index.add(qid, question)
+  return index
+
+
+class InvertedIndexSearch:
+  """
+  in-process trigram index over lowercased question text, for sqlite
+  and test setups. candidates are the intersection of the postings of
+  the term's trigrams, then confirmed as real substrings.
+  built from one query on first use, updated by Question.insert() /
+  delete() afterwards. once it is ttl seconds old a background thread
+  rebuilds it, so that writes made by other processes are found too,
+  and searches keep using the old index until the new one is swapped in.
+  """
+
+  def __init__(self, ttl=INDEX_TTL):
+    self.ttl = ttl
+    self._lock = threading.Lock()
+    self._index = None
+    self._built_at = 0.0
+    # bumped by invalidate(), a rebuild started before it is thrown away
+    self._generation = 0
+    self._rebuilding = None
+    # changes seen while a rebuild runs, replayed onto its result
+    self._pending = []
+
+  def search(self, term, offset, limit, options=()):
+    term = term.lower()
+    with self._lock:
+      if self._index is None:
+        # nothing to serve yet, build it here
+        self._index = load_index()
+        self._built_at = time.monotonic()
+      elif time.monotonic() - self._built_at >= self.ttl and self._rebuilding is None:
+        self._start_rebuild()
+      page = self._index.rank(term, offset, limit)
+    if not page:
+      return []
+    rows = {q.id: q for q in Question.query.options(*options).filter(Question.id.in_(page))}
+    return [rows[qid] for qid in page if qid in rows]
+
+  def _start_rebuild(self):
+    self._pending = []
+    self._rebuilding = threading.Thread(target=self._rebuild, name='question-index',
+                                        args=(current_app._get_current_object(), self._generation),
+                                        daemon=True)
+    self._rebuilding.start()
+
+  def _rebuild(self, app, generation):
+    index = None
+    try:
+      with app.app_context():
+        index = load_index()
+    except Exception:
+      app.logger.exception('rebuilding the question search index failed')
+    with self._lock:
+      self._rebuilding = None
+      if index is None or generation != self._generation:
+        # retried after another ttl, or rebuilt on the next search
+        self._built_at = time.monotonic()
+        return
+      for change in self._pending:
+        index.apply(*change)
+      self._pending = []
+      self._index = index
+      self._built_at = time.monotonic()
+
+  def wait(self, timeout=None):
+    """waits for a running rebuild to be swapped in"""
+    thread = self._rebuilding
+    if thread is not None:
+      thread.join(timeout)
+
+  def invalidate(self):
+    with self._lock:
+      self._index = None
+      self._generation += 1
+      self._pending = []
+
+  def on_change(self, event, question):
+    if event == 'reset':
+      self.invalidate()
+      return
+    change = (event, question.id, question.question if event == 'insert' else None)
+    with self._lock:
+      if self._index is None:
+        return
+      self._index.apply(*change)
+      if self._rebuilding is not None:
+        self._pending.append(change)
+
+
+class QuestionSearch:
+  """
+  picks the search backend for the bound database on first use:
+  PostgresSearch on postgres, InvertedIndexSearch anywhere else
+  """
+
+  def __init__(self):
+    self._backend = None
+
+  @property
+  def backend(self):
+    if self._backend is None:
+      if db.engine.dialect.name == 'postgresql':
+        self._backend = PostgresSearch()
+      else:
+        self._backend = InvertedIndexSearch()
+    return self._backend
+
+  def search(self, term, offset, limit, options=()):
+    """
+    term: substring to look for, case insensitive
+    options: query options for loading the rows, e.g. load_only
+    returns up to limit ranked Question rows, skipping the first offset
+    """
+    return self.backend.search(term, offset, limit, options)
+
+  def invalidate(self):
+    self._backend = None
+
+  def on_change(self, event, question):
+    if self._backend is not None:
+      self._backend.on_change(event, question)
+
+
+question_search = QuestionSearch()
+question_listeners.append(question_search.on_change)
@@ -0,0 +1,159 @@
+from models import Question, question_fields
+from .categories import category_cache
+from .counts import question_counts
+from .quiz import quiz_sampler, quiz_sessions
+from .search import question_search
+
+QUESTIONS_PER_PAGE = 10
+EXPORT_BATCH = 1000
+
+
+def paginate(selection, page=1, after_id=None, per_page=QUESTIONS_PER_PAGE, projection=None):
+  """
+  selection: a sqlAlchemy query (should have format()), not yet executed
+  projection: optional Projection, only its columns are loaded and formatted
+  returns one page of formatted rows
+
+  pages are cut in SQL rather than in python, so only one page of rows
+  is ever fetched. page uses LIMIT/OFFSET, after_id seeks past the last
+  seen id instead (keyset), which stays cheap on deep pages.
+  """
+  model = selection.column_descriptions[0]['entity']
+  format = model.format
+  if projection is not None:
+    selection = selection.options(projection.load)
+    format = projection.format
+
+  if after_id is not None:
+    selection = selection.filter(model.id > after_id).order_by(model.id)
+  else:
+    selection = selection.order_by(model.id).offset((max(page, 1) - 1) * per_page)
+
+  return [format(sel) for sel in selection.limit(per_page).all()]
+
+
+class CategoryService:
+  """
+  category reads, as plain python data
+  """
+
+  def __init__(self, cache=category_cache):
+    self.cache = cache
+
+  def all(self):
+    """returns the {id: type} map"""
+    return self.cache.get().categories
+
+  def snapshot(self):
+    """returns the cached CategorySnapshot, with the encoded response"""
+    return self.cache.get()
+
+
+class QuestionService:
+  """
+  question reads and writes, as plain python data.
+  needs an app context for the db but no request, so it can be called
+  (and timed) directly.
+  """
+
+  def __init__(self, counts=question_counts, search_index=question_search,
+               sampler=quiz_sampler, sessions=quiz_sessions):
+    self.counts = counts
+    self.search_index = search_index
+    self.sampler = sampler
+    self.sessions = sessions
+
+  # projection: a question_fields Projection, all fields by default
+
+  def list(self, page=1, after_id=None, projection=None):
+    return paginate(Question.query, page, after_id, projection=projection)
+
+  def by_category(self, cat_id, page=1, after_id=None, projection=None):
+    return paginate(Question.query.filter(Question.category == cat_id), page, after_id,
+                    projection=projection)
+
+  def search(self, term, page=1, projection=question_fields.all):
+    offset = (max(page, 1) - 1) * QUESTIONS_PER_PAGE
+    found = self.search_index.search(term, offset, QUESTIONS_PER_PAGE, (projection.load,))
+    return [projection.format(q) for q in found]
+
+  def export(self, category=None, min_id=None, max_id=None, batch=EXPORT_BATCH,
+             projection=question_fields.all):
+    """
+    yields every matching question, formatted, in id order.
+    rows come through a server side cursor batch at a time, so memory
+    does not grow with the size of the table.
+    """
+    query = Question.query.options(projection.load)
+    if category is not None:
+      query = query.filter(Question.category == category)
+    if min_id is not None:
+      query = query.filter(Question.id >= min_id)
+    if max_id is not None:
+      query = query.filter(Question.id <= max_id)
+    query = query.order_by(Question.id).execution_options(stream_results=True).yield_per(batch)
+    format = projection.format
+    for question in query:
+      yield format(question)
+
+  def total(self):
+    return self.counts.total()
+
+  def category_total(self, cat_id):
+    return self.counts.for_category(cat_id)
+
+  def create(self, question, answer, category, difficulty):
+    new_question = Question(question=question, answer=answer,
+                            difficulty=difficulty, category=category)
+    new_question.insert()
+    return new_question.format()
+
+  def delete(self, question_id):
+    """returns False when there is no such question"""
+    question = Question.query.filter_by(id=question_id).one_or_none()
+    if question is None:
+      return False
+    question.delete()
+    return True
+
+  def start_quiz_session(self):
+    return self.sessions.start()
+
+  def _quiz_exclude(self, previous, session):
+    exclude = set(previous)
+    if session:
+      served = self.sessions.served(session)
+      if served is None:
+        raise LookupError(session)
+      exclude |= served
+    return exclude
+
+  def quiz_question(self, cat_id, previous=(), session=None):
+    """
+    cat_id: category id, 0 for all categories
+    previous: ids already asked
+    session: optional quiz session token, its served ids are excluded too
+      and the picked question is recorded in it
+    returns a formatted question or None when none are left,
+    raises LookupError for an unknown or expired session
+    """
+    exclude = self._quiz_exclude(previous, session)
+    question = self.sampler.pick(cat_id, exclude)
+    if session and question is not None:
+      self.sessions.record(session, question['id'])
+    return question
+
+  def quiz_questions(self, cat_id, count, previous=(), session=None, difficulty=None, seed=None):
+    """
+    a batch of up to count distinct questions, as quiz_question.
+    difficulty: None, one difficulty or a {difficulty: weight} mix
+    seed: draws the same batch for the same category, history and questions
+    """
+    exclude = self._quiz_exclude(previous, session)
+    questions = self.sampler.pick_many(cat_id, exclude, count, difficulty, seed)
+    if session and questions:
+      self.sessions.record(session, *(q['id'] for q in questions))
+    return questions
+
+category_service = CategoryService()
+question_service = QuestionService()
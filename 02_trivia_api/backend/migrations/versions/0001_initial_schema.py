@@ -0,0 +1,45 @@
+"""initial schema
+
+the tables as create_all made them before migrations, with
+questions.category a string. existing tables are left alone, so a
+database loaded from trivia.psql or made by create_all can be upgraded
+as is.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'categories' not in tables:
+        op.create_table(
+            'categories',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('type', sa.String()),
+        )
+    if 'questions' not in tables:
+        op.create_table(
+            'questions',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('question', sa.String()),
+            sa.Column('answer', sa.String()),
+            sa.Column('category', sa.String()),
+            sa.Column('difficulty', sa.Integer()),
+        )
+
+
+def downgrade():
+    op.drop_table('questions')
+    op.drop_table('categories')
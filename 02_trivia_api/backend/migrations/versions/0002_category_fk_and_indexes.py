@@ -0,0 +1,129 @@
+"""questions.category as an integer foreign key, with indexes
+
+category was a string compared against integer ids, so filtering by
+category scanned the table and cast every row. it becomes an integer
+referencing categories.id, and gets indexes on (category, id), for the
+category filter and its id order, and on difficulty.
+
+on postgres this runs online: the new column is backfilled in short
+batches that commit on their own, only the final swap takes a table
+lock, and the foreign key and indexes are validated / built without
+blocking writes. rows whose category is not a known category id end up
+NULL, as if their category had been deleted. other databases (sqlite)
+rebuild the table in one go.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 00:00:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH = 10000
+FK_NAME = 'fk_questions_category'
+INDEXES = {
+    'ix_questions_category_id': ['category', 'id'],
+    'ix_questions_difficulty': ['difficulty'],
+}
+
+# the join leaves category_id NULL for anything but a known category id
+BACKFILL = '''
+    UPDATE questions SET category_id = categories.id
+    FROM categories
+    WHERE questions.category = CAST(categories.id AS varchar)
+      AND questions.id > :low AND questions.id <= :high
+'''
+ADD_FK = '''
+    ALTER TABLE questions ADD CONSTRAINT {} FOREIGN KEY (category)
+    REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL NOT VALID
+'''.format(FK_NAME)
+
+
+def category_foreign_key(bind):
+    for fk in sa.inspect(bind).get_foreign_keys('questions'):
+        if fk['constrained_columns'] == ['category']:
+            return fk
+    return None
+
+
+def backfill_postgresql(bind):
+    op.add_column('questions', sa.Column('category_id', sa.Integer()))
+    max_id = bind.execute(sa.text('SELECT max(id) FROM questions')).scalar() or 0
+
+    # every batch commits on its own, the app keeps writing meanwhile
+    with op.get_context().autocommit_block():
+        autocommit = op.get_bind()
+        for low in range(0, max_id, BACKFILL_BATCH):
+            autocommit.execute(sa.text(BACKFILL), low=low, high=low + BACKFILL_BATCH)
+
+    # catch up on rows inserted since, then swap the columns. the lock is
+    # held until the end of this transaction, which is short.
+    op.execute('LOCK TABLE questions IN ACCESS EXCLUSIVE MODE')
+    bind.execute(sa.text(BACKFILL), low=max_id, high=2 ** 31 - 1)
+    op.drop_column('questions', 'category')
+    op.alter_column('questions', 'category_id', new_column_name='category')
+    op.execute(ADD_FK)
+
+    # VALIDATE only takes a lock that lets reads and writes through
+    with op.get_context().autocommit_block():
+        op.execute('ALTER TABLE questions VALIDATE CONSTRAINT ' + FK_NAME)
+
+
+def add_foreign_key(bind):
+    op.execute('UPDATE questions SET category = NULL '
+               'WHERE category NOT IN (SELECT id FROM categories)')
+    if bind.dialect.name == 'postgresql':
+        op.execute(ADD_FK)
+        with op.get_context().autocommit_block():
+            op.execute('ALTER TABLE questions VALIDATE CONSTRAINT ' + FK_NAME)
+        return
+    with op.batch_alter_table('questions') as batch_op:
+        batch_op.create_foreign_key(FK_NAME, 'categories', ['category'], ['id'],
+                                    onupdate='CASCADE', ondelete='SET NULL')
+
+
+def upgrade():
+    bind = op.get_bind()
+    columns = {c['name']: c['type'] for c in sa.inspect(bind).get_columns('questions')}
+
+    if not isinstance(columns['category'], sa.Integer):
+        if bind.dialect.name == 'postgresql':
+            backfill_postgresql(bind)
+        else:
+            with op.batch_alter_table('questions') as batch_op:
+                batch_op.alter_column('category', type_=sa.Integer(), existing_type=sa.String())
+
+    # a database loaded from trivia.psql has the column and its key already
+    if category_foreign_key(bind) is None:
+        add_foreign_key(bind)
+
+    existing = {ix['name'] for ix in sa.inspect(bind).get_indexes('questions')}
+    missing = [name for name in INDEXES if name not in existing]
+    if bind.dialect.name == 'postgresql':
+        # CONCURRENTLY builds without blocking writes, outside a transaction
+        with op.get_context().autocommit_block():
+            for name in missing:
+                op.create_index(name, 'questions', INDEXES[name], postgresql_concurrently=True)
+    else:
+        for name in missing:
+            op.create_index(name, 'questions', INDEXES[name])
+
+
+def downgrade():
+    bind = op.get_bind()
+    for name in INDEXES:
+        op.drop_index(name, 'questions')
+    fk = category_foreign_key(bind)
+    with op.batch_alter_table('questions') as batch_op:
+        if fk is not None:
+            batch_op.drop_constraint(fk['name'], type_='foreignkey')
+        batch_op.alter_column('category', type_=sa.String(), existing_type=sa.Integer(),
+                              postgresql_using='category::varchar')
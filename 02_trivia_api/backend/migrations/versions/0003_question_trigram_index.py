@@ -0,0 +1,44 @@
+"""pg_trgm GIN index on questions.question, for the substring search
+
+with the index ILIKE '%term%' is an index scan and the results can be
+ranked by similarity(). postgres only, the index is built CONCURRENTLY
+so writes go on while it builds. other databases search an in-memory
+index and get nothing here.
+
+the extension needs a role allowed to create it. without one, ask a
+superuser to run CREATE EXTENSION pg_trgm first, search keeps working
+meanwhile, unindexed.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 00:00:00
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+INDEX = 'ix_questions_question_trgm'
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # CONCURRENTLY builds without blocking writes, outside a transaction
+    with op.get_context().autocommit_block():
+        op.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} '
+                   'ON questions USING gin (question gin_trgm_ops)'.format(INDEX))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    # the extension stays, other objects may depend on it
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + INDEX)
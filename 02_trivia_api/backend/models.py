@@ -1,23 +1,69 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Integer, ForeignKey, Index, create_engine
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate, upgrade
 import json
+from fsnd_shared.pool import engine_options
+from fsnd_shared.projection import Projector
+
+from replicas import ReplicaSet, RoutingSQLAlchemy, clear_routing
 
 database_name = "trivia"
 database_path = "postgres://{}/{}".format('localhost:5432', database_name)
+migrations_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+db = RoutingSQLAlchemy()
+
+'''
+question_listeners
+    callables run as listener(event, question) once a question change
+    is committed, event being 'insert' or 'delete'.
+    'reset' (question is None) means many rows changed at once, e.g. a
+    bulk import, and anything cached should be dropped.
+    used to keep in-process caches (counts, indexes) in step with the db
+'''
+question_listeners = []
 
-db = SQLAlchemy()
+def notify_question_change(event, question):
+    for listener in question_listeners:
+        listener(event, question)
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    create_all: create missing tables, off by default so app start up
+        does not pay for schema introspection
+    migrate: run the pending migrations (flask db upgrade) on start up,
+        `flask db` manages them otherwise
+    pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping:
+        connection pool settings, see fsnd_shared.pool.engine_options
+    statement_timeout: postgres statement timeout in milliseconds
+    pool usage is reported by fsnd_shared.pool.pool_metrics, on /metrics
+    replica_paths: read replica urls, views marked @read_only query them
+    replica_strategy: 'round_robin' or 'least_latency'
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, create_all=False, migrate=False,
+             replica_paths=None, replica_strategy='round_robin', **pool_options):
+    options = engine_options(database_path, **pool_options)
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+    if replica_paths:
+        # only the primary pool reports to pool_metrics
+        replica_options = {k: v for k, v in options.items() if k != 'poolclass'}
+        app.extensions['replicas'] = ReplicaSet(replica_paths, replica_strategy, **replica_options)
+        app.teardown_request(clear_routing)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    Migrate(app, db, directory=migrations_path)
+    if create_all:
+        db.create_all()
+    if migrate:
+        with app.app_context():
+            upgrade(directory=migrations_path)
+
+# the values Question.difficulty takes
+DIFFICULTIES = range(1, 6)
 
 '''
 Question
@@ -29,9 +75,17 @@ class Question(db.Model):
   id = Column(Integer, primary_key=True)
   question = Column(String)
   answer = Column(String)
-  category = Column(String)
+  category = Column(Integer, ForeignKey('categories.id', name='fk_questions_category',
+                                        onupdate='CASCADE', ondelete='SET NULL'))
   difficulty = Column(Integer)
 
+  # (category, id) serves both the category filter and its id order,
+  # see migrations/versions/0002_category_fk_and_indexes.py
+  __table_args__ = (
+    Index('ix_questions_category_id', 'category', 'id'),
+    Index('ix_questions_difficulty', 'difficulty'),
+  )
+
   def __init__(self, question, answer, category, difficulty):
     self.question = question
     self.answer = answer
@@ -41,6 +95,7 @@ class Question(db.Model):
   def insert(self):
     db.session.add(self)
     db.session.commit()
+    notify_question_change('insert', self)
   
   def update(self):
     db.session.commit()
@@ -48,6 +103,7 @@ class Question(db.Model):
   def delete(self):
     db.session.delete(self)
     db.session.commit()
+    notify_question_change('delete', self)
 
   def format(self):
     return {
@@ -58,6 +114,14 @@ class Question(db.Model):
       'difficulty': self.difficulty
     }
 
+'''
+question_fields
+    ?fields= projections of Question, e.g. ?fields=question,category
+    skips loading and sending the answers. id is always kept.
+'''
+question_fields = Projector((name, ('obj.' + name, (name,)))
+                            for name in ('id', 'question', 'answer', 'category', 'difficulty'))
+
 '''
 Category
 
@@ -0,0 +1,112 @@
+import itertools
+import threading
+import time
+from functools import wraps
+
+from flask import g, has_app_context, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+
+# weight of the newest sample in the per replica latency average
+LATENCY_SMOOTHING = 0.2
+
+
+class ReplicaSet:
+  """
+  engines for the read replicas and the policy picking one per session:
+  'round_robin' cycles through them, 'least_latency' takes the one with
+  the lowest moving average statement time (untried replicas first)
+  """
+
+  def __init__(self, urls, strategy='round_robin', **engine_options):
+    if strategy not in ('round_robin', 'least_latency'):
+      raise ValueError('unknown replica strategy {}'.format(strategy))
+    self.strategy = strategy
+    self.engines = [create_engine(url, **engine_options) for url in urls]
+    self.latency = {engine: 0.0 for engine in self.engines}
+    self._cycle = itertools.cycle(self.engines)
+    self._lock = threading.Lock()
+    for engine in self.engines:
+      event.listen(engine, 'before_cursor_execute', self._before_execute)
+      event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+  def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+    conn.info['replica_query_start'] = time.perf_counter()
+
+  def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+    start = conn.info.pop('replica_query_start', None)
+    if start is None:
+      return
+    elapsed = time.perf_counter() - start
+    with self._lock:
+      previous = self.latency[conn.engine]
+      self.latency[conn.engine] = elapsed if previous == 0.0 else \
+        previous + LATENCY_SMOOTHING * (elapsed - previous)
+
+  def choose(self):
+    with self._lock:
+      if self.strategy == 'least_latency':
+        return min(self.engines, key=self.latency.__getitem__)
+      return next(self._cycle)
+
+  def dispose(self):
+    for engine in self.engines:
+      engine.dispose()
+
+
+# the routing state of a request, kept on flask.g
+ROUTING_FLAGS = ('db_read_only', 'db_wrote', 'db_replica')
+
+
+def clear_routing(exc=None):
+  """
+  drops the routing flags. g belongs to the app context, which tests and
+  CLI work keep pushed around several requests, so setup_db runs this
+  on every request teardown: after a streamed body is sent, the next
+  request and the code around it start on the primary again
+  """
+  for name in ROUTING_FLAGS:
+    g.pop(name, None)
+
+
+def read_only(f):
+  """
+  marks a view as read only, its queries may then go to a replica.
+  called outside a request the flags are dropped as soon as it returns
+  """
+  @wraps(f)
+  def wrapper(*args, **kwargs):
+    g.db_read_only = True
+    if has_request_context():
+      return f(*args, **kwargs)
+    try:
+      return f(*args, **kwargs)
+    finally:
+      clear_routing()
+
+  return wrapper
+
+
+class RoutingSession(SignallingSession):
+  """
+  sends the queries of read only views to a replica, sticking to one
+  replica for the whole session. flushes, and anything after a flush in
+  the same request, use the primary so a view reads its own writes.
+  """
+
+  def get_bind(self, mapper=None, clause=None):
+    replicas = self.app.extensions.get('replicas')
+    if replicas is not None and has_app_context():
+      if self._flushing:
+        if g.get('db_read_only'):
+          g.db_wrote = True
+      elif g.get('db_read_only') and not g.get('db_wrote'):
+        if 'db_replica' not in g:
+          g.db_replica = replicas.choose()
+        return g.db_replica
+    return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
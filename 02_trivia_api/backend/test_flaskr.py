@@ -1,12 +1,27 @@
+import gzip
 import os
+import shutil
+import tempfile
+import threading
+import types
 import unittest
 import json
+from unittest import mock
 from flask_sqlalchemy import SQLAlchemy
-from flask import jsonify
+from flask import g, jsonify
+from sqlalchemy import create_engine, event, inspect as sa_inspect, Integer
 import random
+from fsnd_shared.compression import compress
+from fsnd_shared.ratelimit import Limit, MemoryStorage
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import quiz as quiz_module
+from flaskr import search as search_module
+from flaskr.bulk import _insert_chunk, import_questions
+from flaskr.search import InvertedIndexSearch, like_pattern
+from flaskr.services import question_service, category_service
+from models import setup_db, db, Question, Category, question_listeners
+from replicas import read_only
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -40,6 +55,37 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['total_questions'], len(Question.query.all()))
     
+    # questions get, keyset pagination
+    def test_get_questions_after_id(self):
+        first = Question.query.order_by(Question.id).first()
+        res = self.client().get('/questions?after_id=' + str(first.id))
+        data = json.loads(res.data)
+        ids = [q['id'] for q in data['questions']]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotIn(first.id, ids)
+        self.assertEqual(ids, sorted(ids))
+
+    # categories get, conditional on the etag
+    def test_categories_not_modified(self):
+        res = self.client().get('/categories')
+        etag = res.headers['ETag']
+        res = self.client().get('/categories', headers={'If-None-Match': etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+
+    # questions/export get
+    def test_export_questions(self):
+        res = self.client().get('/questions/export?category=1')
+        lines = res.data.splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), Question.query.filter(Question.category == 1).count())
+        for line in lines:
+            self.assertEqual(str(json.loads(line)['category']), '1')
+
     # question by category
     def test_category_filter(self):
         cat_id = 5
@@ -50,6 +96,25 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(len(data['questions']), len(questions))
 
+    # category total uses the per category count
+    def test_category_total_questions(self):
+        cat_id = 5
+        res = self.client().get('/categories/'+ str(cat_id) +'/questions')
+        data = json.loads(res.data)
+        count = Question.query.filter(Question.category == cat_id).count()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['total_questions'], count)
+
+    # services need an app context but no request
+    def test_services_without_request(self):
+        with self.app.app_context():
+            questions = question_service.list(page=1)
+            categories = category_service.all()
+
+            self.assertEqual(len(questions), min(10, Question.query.count()))
+            self.assertEqual(len(categories), Category.query.count())
+
     # question id
     def test_nonexistant_question(self):
         qid = 999999
@@ -87,6 +152,25 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data['success'], True)
         self.assertEqual(data['tatal_questions'], q_len + 1)
 
+    # questions/bulk post
+    def test_bulk_questions(self):
+        rows = [
+            {'question': 'bulk question', 'answer': 'a', 'difficulty': 1, 'category': 1},
+            {'question': 'bulk question', 'answer': 'a', 'difficulty': 1, 'category': 1},
+            {'question': '', 'answer': 'a', 'difficulty': 1, 'category': 1}
+        ]
+        body = '\n'.join(json.dumps(row) for row in rows)
+
+        q_len = Question.query.count()
+        res = self.client().post('/questions/bulk', data=body,
+                                 content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['total_questions'], q_len + 2)
+
     # searchQuestion post
     def test_question_search(self):
         sub_string = {'searchTerm': 'where is'}
@@ -96,6 +180,16 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    # searchQuestion results contain the term
+    def test_question_search_matches(self):
+        res = self.client().post('/searchQuestions', json={'searchTerm': 'WHERE IS'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(len(data['questions']) <= 10)
+        for question in data['questions']:
+            self.assertIn('where is', question['question'].lower())
+
     # cat/id/question get
     def test_category_questions(self):
         res = self.client().get('/categories/1/questions')
@@ -123,6 +217,774 @@ class TriviaTestCase(unittest.TestCase):
             self.assertNotIn(data['question'], payload['previous_questions'])
 
 
+    # quiz post with a server side session
+    def test_quiz_session(self):
+        res = self.client().post('/quizzes', json={
+            'quiz_session': True,
+            'quiz_category': {'id': 0}
+        })
+        data = json.loads(res.data)
+        seen = [data['question']['id']]
+
+        for i in range(4):
+            res = self.client().post('/quizzes', json={
+                'quiz_session': data['quiz_session'],
+                'quiz_category': {'id': 0}
+            })
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertNotIn(data['question']['id'], seen)
+            seen.append(data['question']['id'])
+
+    def test_quiz_unknown_session(self):
+        res = self.client().post('/quizzes', json={
+            'quiz_session': 'not-a-session',
+            'quiz_category': {'id': 0}
+        })
+
+        self.assertEqual(res.status_code, 404)
+
+
+class SqliteAppTestCase(unittest.TestCase):
+    """
+    base of the tests run on a throwaway sqlite file: self.database_path
+    in self.tmp_dir, removed after the test, and self.app built on it by
+    create_app with the tables created. app_config holds more setup_db
+    arguments, None leaves building the app to the test.
+    """
+
+    app_config = {}
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.database_path = self.sqlite_path('trivia.db')
+        if self.app_config is not None:
+            self.app = self.create_app(create_all=True, **self.app_config)
+            self.client = self.app.test_client
+
+    def sqlite_path(self, name):
+        return 'sqlite:///' + os.path.join(self.tmp_dir, name)
+
+    def create_app(self, **config):
+        return create_app(dict({'database_path': self.database_path}, **config))
+
+
+class ReplicaRoutingTestCase(SqliteAppTestCase):
+    """Read routing, with two sqlite files standing in for primary and replica"""
+
+    app_config = None
+
+    def setUp(self):
+        super().setUp()
+        self.replica_path = self.sqlite_path('replica.db')
+
+        replica = create_engine(self.replica_path)
+        Question.metadata.create_all(replica)
+        replica.execute(Category.__table__.insert(), {'id': 1, 'type': 'Replica'})
+        replica.dispose()
+
+        self.app = self.create_app(replica_paths=[self.replica_path], create_all=True)
+        self.client = self.app.test_client
+        with self.app.app_context():
+            db.session.add(Category('Primary'))
+            db.session.commit()
+
+    def tearDown(self):
+        self.app.extensions['replicas'].dispose()
+
+    def test_reads_use_replica(self):
+        res = self.client().get('/categories')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['categories'], {'1': 'Replica'})
+
+    def test_writes_use_primary(self):
+        new_q = dict(question='routed', answer='a', difficulty=1, category=1)
+        res = self.client().post('/questions', json=new_q)
+
+        primary = create_engine(self.database_path)
+        rows = primary.execute('select count(*) from questions').scalar()
+        primary.dispose()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(rows, 1)
+
+    def test_routing_ends_with_the_request(self):
+        # one app context around several requests, as in CLI work
+        with self.app.app_context():
+            self.client().get('/categories')
+            self.assertFalse(any(name in g for name in ('db_read_only', 'db_wrote', 'db_replica')))
+            self.assertEqual([c.type for c in Category.query.all()], ['Primary'])
+            self.assertEqual(json.loads(self.client().get('/categories').data)['categories'],
+                             {'1': 'Replica'})
+
+    def test_read_only_outside_a_request(self):
+        @read_only
+        def category_types():
+            return [c.type for c in Category.query.all()]
+
+        with self.app.app_context():
+            self.assertEqual(category_types(), ['Replica'])
+            self.assertNotIn('db_read_only', g)
+            self.assertEqual([c.type for c in Category.query.all()], ['Primary'])
+
+
+class MigrationTestCase(SqliteAppTestCase):
+    """migrations bring a string category sqlite database to the integer key"""
+
+    app_config = None
+
+    def setUp(self):
+        super().setUp()
+        legacy = create_engine(self.database_path)
+        legacy.execute('CREATE TABLE categories (id INTEGER PRIMARY KEY, type VARCHAR)')
+        legacy.execute('CREATE TABLE questions (id INTEGER PRIMARY KEY, question VARCHAR, '
+                       'answer VARCHAR, category VARCHAR, difficulty INTEGER)')
+        legacy.execute("INSERT INTO categories VALUES (1, 'Science'), (2, 'Art')")
+        legacy.execute("INSERT INTO questions VALUES (1, 'q1', 'a', '1', 1), (2, 'q2', 'a', '2', 3), "
+                       "(3, 'q3', 'a', '2', 5), (4, 'orphan', 'a', '9', 2)")
+        legacy.dispose()
+
+    def inspect(self):
+        engine = create_engine(self.database_path)
+        inspector = sa_inspect(engine)
+        columns = {c['name']: c['type'] for c in inspector.get_columns('questions')}
+        indexes = {ix['name']: ix['column_names'] for ix in inspector.get_indexes('questions')}
+        fks = [fk['constrained_columns'] for fk in inspector.get_foreign_keys('questions')]
+        rows = engine.execute('SELECT id, category FROM questions ORDER BY id').fetchall()
+        engine.dispose()
+        return columns, indexes, fks, rows
+
+    def test_upgrade_legacy_database(self):
+        app = self.create_app(migrate=True)
+        columns, indexes, fks, rows = self.inspect()
+
+        self.assertIsInstance(columns['category'], Integer)
+        self.assertEqual(indexes['ix_questions_category_id'], ['category', 'id'])
+        self.assertEqual(indexes['ix_questions_difficulty'], ['difficulty'])
+        self.assertEqual(fks, [['category']])
+        self.assertEqual([tuple(row) for row in rows], [(1, 1), (2, 2), (3, 2), (4, None)])
+
+        data = json.loads(app.test_client().get('/categories/2/questions').data)
+        self.assertEqual(data['total_questions'], 2)
+        self.assertEqual([q['category'] for q in data['questions']], [2, 2])
+
+    def test_upgrade_create_all_database(self):
+        # tables made by create_all are already current, upgrading only records it
+        self.database_path = self.sqlite_path('fresh.db')
+        self.create_app(create_all=True, migrate=True)
+        columns, indexes, fks, rows = self.inspect()
+
+        self.assertEqual(sorted(indexes), ['ix_questions_category_id', 'ix_questions_difficulty'])
+        self.assertEqual(fks, [['category']])
+
+    def test_trigram_index_is_postgres_only(self):
+        self.create_app(migrate=True)
+        engine = create_engine(self.database_path)
+        version = engine.execute('SELECT version_num FROM alembic_version').scalar()
+        indexes = [ix['name'] for ix in sa_inspect(engine).get_indexes('questions')]
+        engine.dispose()
+
+        self.assertEqual(version, '0003')
+        self.assertNotIn('ix_questions_question_trgm', indexes)
+
+
+class SearchTestCase(SqliteAppTestCase):
+    """the in-memory trigram search index, on a sqlite file"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add(Category('Science'))
+            for text in ['where is it', 'so where is it now', 'where', 'nowhere', 'elsewhere else',
+                         'who is it']:
+                db.session.add(Question(text, 'a', 1, 1))
+            db.session.commit()
+
+    def test_ranked_pages(self):
+        with self.app.app_context():
+            index = InvertedIndexSearch()
+            ranked = [q.question for q in index.search('WHERE', 0, 10)]
+            pages = [q.question for offset in (0, 2, 4) for q in index.search('where', offset, 2)]
+
+        self.assertEqual(ranked, ['where', 'where is it', 'nowhere', 'so where is it now',
+                                  'elsewhere else'])
+        self.assertEqual(pages, ranked)
+
+    def test_index_expires(self):
+        with self.app.app_context():
+            index = InvertedIndexSearch(ttl=3600)
+            self.assertEqual(index.search('zebra', 0, 10), [])
+            # written by another process, so this one's index is not told
+            db.session.execute(Question.__table__.insert().values(
+                question='a zebra', answer='a', category=1, difficulty=1))
+            db.session.commit()
+
+            self.assertEqual(index.search('zebra', 0, 10), [])
+            index.ttl = 0
+            # the stale index answers while it is rebuilt in the background
+            self.assertEqual(index.search('zebra', 0, 10), [])
+            index.wait()
+            index.ttl = 3600
+            self.assertEqual([q.question for q in index.search('zebra', 0, 10)], ['a zebra'])
+
+    def test_changes_during_rebuild(self):
+        loaded, proceed = threading.Event(), threading.Event()
+        real_load_index = search_module.load_index
+
+        def load_index():
+            # hold the rebuilt index back until the writes below are made
+            index = real_load_index()
+            loaded.set()
+            proceed.wait(5)
+            return index
+
+        with self.app.app_context():
+            index = InvertedIndexSearch(ttl=0)
+            question_listeners.append(index.on_change)
+            self.addCleanup(question_listeners.remove, index.on_change)
+            index.search('zebra', 0, 10)
+            with mock.patch.object(search_module, 'load_index', load_index):
+                index.search('zebra', 0, 10)
+                self.assertTrue(loaded.wait(5))
+            Question('a zebra', 'a', 1, 1).insert()
+            Question.query.filter_by(question='nowhere').one().delete()
+            proceed.set()
+            index.wait()
+            index.ttl = 3600
+
+            self.assertEqual([q.question for q in index.search('zebra', 0, 10)], ['a zebra'])
+            self.assertNotIn('nowhere', [q.question for q in index.search('where', 0, 10)])
+
+    def test_like_pattern(self):
+        self.assertEqual(like_pattern('50%_off'), r'%50\%\_off%')
+        # the escape character itself matches literally
+        self.assertEqual(like_pattern('C:\\'), '%C:\\\\%')
+
+
+class BulkImportTestCase(SqliteAppTestCase):
+    """row validation and chunked inserts of the bulk import, on a sqlite file"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add(Category('Science'))
+            db.session.commit()
+
+    def test_rejects_bad_rows(self):
+        rows = [
+            {'question': 'ok', 'answer': 'a', 'category': 1, 'difficulty': 5},
+            {'question': 'too easy', 'answer': 'a', 'category': 1, 'difficulty': 0},
+            {'question': 'too hard', 'answer': 'a', 'category': 1, 'difficulty': 6},
+            {'question': 'nonsense', 'answer': 'a', 'category': 1, 'difficulty': 'x'},
+            {'question': 'elsewhere', 'answer': 'a', 'category': 2, 'difficulty': 1},
+            {'question': 'ok too', 'answer': 'a', 'category': '1', 'difficulty': '1'},
+        ]
+        with self.app.app_context():
+            summary = import_questions(enumerate(rows, start=1), chunk_size=4)
+            difficulties = sorted(d for d, in db.session.query(Question.difficulty))
+
+        self.assertEqual((summary['inserted'], summary['rejected'], summary['chunks']), (2, 4, 2))
+        self.assertEqual([e['line'] for e in summary['errors']], [2, 3, 4, 5])
+        self.assertEqual(summary['errors'][0]['error'], 'difficulty must be 1 to 5')
+        self.assertEqual(difficulties, [1, 5])
+
+    def test_rejects_non_integral_numbers(self):
+        rows = [
+            {'question': 'rounded', 'answer': 'a', 'category': 1, 'difficulty': 2.9},
+            {'question': 'flag', 'answer': 'a', 'category': True, 'difficulty': 1},
+            {'question': 'listed', 'answer': 'a', 'category': 1, 'difficulty': [1]},
+            {'question': 'csv float', 'answer': 'a', 'category': '1', 'difficulty': '2.0'},
+        ]
+        with self.app.app_context():
+            summary = import_questions(enumerate(rows, start=1))
+
+        self.assertEqual((summary['inserted'], summary['rejected']), (0, 4))
+        self.assertEqual([e['error'] for e in summary['errors']],
+                         ['difficulty must be an integer', 'category must be an integer',
+                          'difficulty must be an integer', 'difficulty must be an integer'])
+
+    def test_failed_chunk_reports_progress(self):
+        body = ''.join(json.dumps({'question': 'q{}'.format(i), 'answer': 'a', 'category': 1,
+                                   'difficulty': 1}) + '\n' for i in range(3))
+        insert_chunk = _insert_chunk
+        calls = []
+
+        def failing_insert(params):
+            calls.append(params)
+            if len(calls) == 2:
+                raise RuntimeError('connection lost')
+            insert_chunk(params)
+
+        with mock.patch('flaskr.bulk._insert_chunk', failing_insert):
+            res = self.client().post('/questions/bulk?chunk_size=1', data=body)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertEqual((data['success'], data['inserted'], data['chunks']), (False, 1, 1))
+        with self.app.app_context():
+            self.assertEqual([q for q, in db.session.query(Question.question)], ['q0'])
+
+    def test_copy_cursor_is_closed(self):
+        connection = mock.Mock()
+        connection.dialect.name = 'postgresql'
+        cursor = connection.connection.cursor.return_value
+        cursor.copy_expert.side_effect = RuntimeError('copy failed')
+
+        with self.app.app_context(), mock.patch.object(db.session, 'connection', return_value=connection):
+            with self.assertRaises(RuntimeError):
+                _insert_chunk([{'question': 'q', 'answer': 'a', 'category': 1, 'difficulty': 1}])
+        cursor.close.assert_called_once_with()
+
+
+class FrozenClockStorage(MemoryStorage):
+    def take(self, key, limit, now=None):
+        return super().take(key, limit, now=0.0)
+
+
+class RateLimitTestCase(SqliteAppTestCase):
+    """token buckets per client and route, on a sqlite file"""
+
+    def setUp(self):
+        super().setUp()
+        self.limiter = self.app.extensions['ratelimiter']
+        # a stopped clock, so no tokens come back while the test runs
+        self.limiter.storage = FrozenClockStorage()
+
+    def search(self, addr='10.0.0.1'):
+        return self.client().post('/searchQuestions', json={'searchTerm': 'x'},
+                                  environ_base={'REMOTE_ADDR': addr})
+
+    def test_over_budget_gets_429(self):
+        statuses = [self.search().status_code for i in range(10)]
+        res = self.search()
+        data = json.loads(res.data)
+
+        self.assertEqual(statuses[:10], [200] * 10)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data['error'], 429)
+        self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+        # other clients and other routes keep their own budget
+        self.assertEqual(self.search('10.0.0.2').status_code, 200)
+        self.assertEqual(self.client().get('/categories', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+                         .status_code, 200)
+
+    def test_bucket_refills(self):
+        limit = Limit.parse('2/second')
+        storage = MemoryStorage()
+
+        self.assertEqual([storage.take('k', limit, now=0.0) for i in range(2)], [0.0, 0.0])
+        self.assertAlmostEqual(storage.take('k', limit, now=0.0), 0.5)
+        self.assertEqual(storage.take('k', limit, now=0.5), 0.0)
+
+    def test_shedding_when_pool_saturated(self):
+        self.limiter.shed = lambda: True
+        res = self.search()
+
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers['Retry-After'], '1')
+        # routes without their own budget are not shed
+        self.assertEqual(self.client().get('/categories').status_code, 200)
+
+
+class QuizBatchTestCase(SqliteAppTestCase):
+    """/quizzes with count, difficulty and seed, on a sqlite file"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            for cat_type in ['Science', 'Art']:
+                db.session.add(Category(cat_type))
+            for i in range(40):
+                db.session.add(Question('question {}'.format(i), 'answer', i % 2 + 1, i % 5 + 1))
+            db.session.commit()
+
+    def quiz(self, **payload):
+        payload.setdefault('quiz_category', {'id': 0})
+        res = self.client().post('/quizzes', json=payload)
+        return res.status_code, json.loads(res.data)
+
+    def test_batch_does_not_repeat(self):
+        status, data = self.quiz(count=15, quiz_category={'id': 1}, previous_questions=[1, 3])
+        ids = [q['id'] for q in data['questions']]
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(set(ids)), 15)
+        self.assertEqual(data['question'], data['questions'][0])
+        self.assertTrue(all(q['category'] == 1 for q in data['questions']))
+        self.assertFalse({1, 3} & set(ids))
+        # fewer left than asked for
+        status, data = self.quiz(count=10, quiz_category={'id': 1}, previous_questions=ids + [1, 3])
+        self.assertEqual(len(data['questions']), 20 - 15 - 2)
+
+    def test_seed_is_reproducible(self):
+        first = self.quiz(count=10, seed='event-7')[1]['questions']
+        again = self.quiz(count=10, seed='event-7')[1]['questions']
+        other = self.quiz(count=10, seed='event-8')[1]['questions']
+
+        self.assertEqual(first, again)
+        self.assertNotEqual(first, other)
+
+    def test_difficulty_mix(self):
+        status, data = self.quiz(count=10, difficulty={'1': 3, '5': 2}, seed=1)
+        difficulties = sorted(q['difficulty'] for q in data['questions'])
+        self.assertEqual(difficulties, [1] * 6 + [5] * 4)
+
+        status, data = self.quiz(count=5, difficulty=2)
+        self.assertEqual([q['difficulty'] for q in data['questions']], [2] * 5)
+
+    def test_session_records_the_batch(self):
+        status, data = self.quiz(count=30, quiz_session=True)
+        session = data['quiz_session']
+        status, data = self.quiz(count=30, quiz_session=session)
+
+        self.assertEqual(len(data['questions']), 10)
+
+    def test_bad_options(self):
+        for payload in ({'count': 0}, {'count': 51}, {'count': '3'}, {'difficulty': 9},
+                        {'difficulty': {'x': 1}}, {'difficulty': {'1': 0}}, {'seed': [1]},
+                        {'quiz_session': ['x']}, {'quiz_session': {'x': 1}}, {'quiz_session': 1},
+                        {'quiz_session': False}):
+            self.assertEqual(self.quiz(**payload)[0], 400, payload)
+
+    def test_stable_sample_on_sparse_pool(self):
+        ids = random.Random(3).sample(range(1, 10 ** 6), 200)
+        ordered = quiz_module.IdPool(sorted(ids))
+        # the same ids, reached through another history
+        shuffled = quiz_module.IdPool(random.Random(4).sample(ids, len(ids)) + [7, 8, 9])
+        for qid in (7, 8, 9):
+            shuffled.remove(qid)
+        shuffled.add(ids[0])
+
+        # few ids excluded (rejection sampling), then most (one pass over the rest)
+        for exclude in (set(ids[:10]), set(ids[:150])):
+            picked = ordered.sample_many(40, exclude, random.Random(5), stable=True)
+            again = shuffled.sample_many(40, exclude, random.Random(5), stable=True)
+
+            self.assertEqual(picked, again)
+            self.assertEqual(len(set(picked)), 40)
+            self.assertFalse(exclude & set(picked))
+            self.assertTrue(set(picked) <= set(ids))
+        self.assertEqual(len(ordered.sample_many(80, set(ids[:150]), random.Random(5), stable=True)), 50)
+
+    def test_sessions_evict_from_head(self):
+        self.now = 0.0
+        clock = mock.patch.object(quiz_module, 'time', types.SimpleNamespace(monotonic=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+        sessions = quiz_module.QuizSessions(ttl=60, max_sessions=3)
+        a, b, c = sessions.start(), sessions.start(), sessions.start()
+
+        self.now = 10.0
+        sessions.served(a)
+        # full: the least recently used goes
+        d = sessions.start()
+        self.assertIsNone(sessions.served(b))
+        # c idled past the ttl, a was used since
+        self.now = 65.0
+        e = sessions.start()
+
+        self.assertIsNone(sessions.served(c))
+        self.assertEqual([sessions.served(t) is not None for t in (a, d, e)], [True, True, True])
+
+    def test_served_is_a_snapshot(self):
+        sessions = quiz_module.QuizSessions()
+        token = sessions.start()
+        sessions.record(token, 1, 2)
+        served = sessions.served(token)
+        sessions.record(token, 3)
+
+        self.assertEqual(served, {1, 2})
+        self.assertEqual(sessions.served(token), {1, 2, 3})
+
+
+class ProjectionTestCase(SqliteAppTestCase):
+    """?fields= projections, on a sqlite file"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            db.session.add(Category('Science'))
+            for i in range(12):
+                db.session.add(Question('question {}'.format(i), 'a long answer', 1, 2))
+            db.session.commit()
+
+    def test_fields_projection(self):
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            res = self.client().get('/categories/1/questions?fields=question,category')
+        finally:
+            with self.app.app_context():
+                event.remove(db.engine, 'before_cursor_execute', record)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(data['questions'][0]), ['category', 'id', 'question'])
+        selects = [s for s in statements if 'FROM questions' in s and 'count' not in s]
+        self.assertTrue(selects)
+        self.assertFalse(any('questions.answer' in s for s in selects))
+
+    def test_fields_on_search_and_export(self):
+        res = self.client().post('/searchQuestions?fields=answer', json={'searchTerm': 'question 1'})
+        self.assertEqual(json.loads(res.data)['questions'][0], {'id': 2, 'answer': 'a long answer'})
+
+        res = self.client().get('/questions/export?format=csv&fields=difficulty,id')
+        self.assertEqual(res.data.decode().splitlines()[:2], ['id,difficulty', '1,2'])
+
+    def test_unknown_field(self):
+        self.assertEqual(self.client().get('/questions?fields=id,secret').status_code, 400)
+
+
+class CompressionTestCase(SqliteAppTestCase):
+    """gzip negotiation and precompressed variants, on a sqlite file"""
+
+    def setUp(self):
+        super().setUp()
+        with self.app.app_context():
+            for i in range(100):
+                db.session.add(Category('category {}'.format(i)))
+            for i in range(40):
+                db.session.add(Question('question {}'.format(i), 'answer', i % 6 + 1, 1))
+            db.session.commit()
+        self.gzip = {'Accept-Encoding': 'gzip'}
+
+    def test_negotiated_gzip(self):
+        plain = self.client().get('/questions')
+        res = self.client().get('/questions', headers=self.gzip)
+
+        self.assertIsNone(plain.headers.get('Content-Encoding'))
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        # refused, or too small to bother
+        res = self.client().get('/questions', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+        res = self.client().get('/', headers=self.gzip)
+        self.assertIsNone(res.headers.get('Content-Encoding'))
+
+    def test_categories_compressed_once(self):
+        with mock.patch('fsnd_shared.compression.compress', wraps=compress) as spy:
+            bodies = [self.client().get('/categories', headers=self.gzip).data for i in range(3)]
+            res = self.client().get('/categories', headers=dict(
+                self.gzip, **{'If-None-Match': self.client().get('/categories').headers['ETag']}))
+
+        self.assertEqual(spy.call_count, 1)
+        self.assertEqual(len(set(bodies)), 1)
+        self.assertIn(b'category 99', gzip.decompress(bodies[0]))
+        self.assertEqual(res.status_code, 304)
+
+    def test_coded_etags(self):
+        plain = self.client().get('/categories')
+        res = self.client().get('/categories', headers=self.gzip)
+        cached = self.client().get('/categories', headers=dict(
+            self.gzip, **{'If-None-Match': res.headers['ETag']}))
+        # an identity client holding the gzip variant gets the plain body
+        other = self.client().get('/categories', headers={'If-None-Match': res.headers['ETag']})
+
+        self.assertEqual(res.headers['ETag'], plain.headers['ETag'][:-1] + '-gz"')
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(cached.headers['ETag'], res.headers['ETag'])
+        self.assertEqual(cached.data, b'')
+        self.assertEqual(other.status_code, 200)
+        self.assertEqual(other.data, plain.data)
+
+    def test_asgi_coded_etag(self):
+        from starlette.testclient import TestClient
+        from flaskr.asgi import create_asgi_app
+
+        with TestClient(create_asgi_app(self.database_path)) as asgi:
+            res = asgi.get('/categories', headers=self.gzip)
+            cached = asgi.get('/categories', headers=dict(
+                self.gzip, **{'If-None-Match': res.headers['ETag']}))
+            plain = asgi.get('/categories', headers={'Accept-Encoding': 'identity'})
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['ETag'], plain.headers['ETag'][:-1] + '-gz"')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(cached.status_code, 304)
+
+    def test_streamed_export(self):
+        plain = self.client().get('/questions/export').data
+        res = self.client().get('/questions/export', headers=self.gzip)
+
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(res.data), plain)
+
+
+class InstrumentationTestCase(SqliteAppTestCase):
+    """Server-Timing, /metrics and N+1 detection, on a sqlite file"""
+
+    app_config = None
+
+    def setUp(self):
+        super().setUp()
+        with mock.patch.dict(os.environ, {'METRICS_ENABLED': '1'}):
+            self.app = self.create_app(create_all=True)
+
+        @self.app.route('/one-by-one')
+        def one_by_one():
+            return jsonify([Question.query.get(i).format() for i in range(1, 7)])
+
+        with self.app.app_context():
+            db.session.add(Category('Science'))
+            for i in range(6):
+                db.session.add(Question('q{}'.format(i), 'a', '1', 1))
+            db.session.commit()
+        self.client = self.app.test_client
+
+    def test_server_timing_header(self):
+        res = self.client().get('/questions')
+        timing = res.headers['Server-Timing']
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(timing.startswith('app;dur='))
+        self.assertIn('db;desc="', timing)
+
+    def test_metrics_endpoint(self):
+        self.client().get('/questions')
+        self.client().get('/questions?page=100')
+        res = self.client().get('/metrics')
+        body = res.data.decode('utf-8')
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/questions",status="200"} 1', body)
+        self.assertIn('http_request_duration_seconds_count{method="GET",route="/questions",status="404"} 1', body)
+        self.assertIn('http_request_sql_queries_bucket{route="/questions",le="+Inf"} 2', body)
+        self.assertNotIn('route="/metrics"', body)
+        # sqlite has no pool, the gauges are there all the same
+        self.assertIn('\ndb_pool_checkouts_total ', body)
+
+    def test_n_plus_one_flagged(self):
+        self.client().get('/one-by-one')
+        self.client().get('/questions')
+        body = self.client().get('/metrics').data.decode('utf-8')
+
+        self.assertIn('sql_n_plus_one_total{route="/one-by-one"} 1', body)
+        self.assertNotIn('sql_n_plus_one_total{route="/questions"}', body)
+
+    def test_metrics_off_by_default(self):
+        with mock.patch.dict(os.environ, {'METRICS_ENABLED': ''}):
+            app = self.create_app()
+
+        self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+        self.assertEqual(app.test_client().get('/questions').status_code, 200)
+
+    def test_metrics_not_rate_limited(self):
+        self.app.extensions['ratelimiter'].storage = FrozenClockStorage()
+        statuses = {self.client().get('/metrics').status_code for i in range(60)}
+
+        self.assertEqual(statuses, {200})
+        # the scrapes took nothing from the client's 50/s budget
+        statuses = [self.client().get('/categories').status_code for i in range(51)]
+        self.assertEqual(statuses, [200] * 50 + [429])
+
+
+class AsgiParityTestCase(SqliteAppTestCase):
+    """The ASGI app must answer like the WSGI app, both run on one sqlite file"""
+
+    def setUp(self):
+        from starlette.testclient import TestClient
+        from flaskr.asgi import create_asgi_app
+
+        super().setUp()
+        with self.app.app_context():
+            for cat_type in ['Science', 'Art', 'Geography']:
+                db.session.add(Category(cat_type))
+            for i in range(25):
+                db.session.add(Question('where is question {}?'.format(i), 'answer {}'.format(i),
+                                        str(i % 3 + 1), i % 5 + 1))
+            db.session.commit()
+
+        self.wsgi = self.app.test_client()
+        self.asgi_client = TestClient(create_asgi_app(self.database_path))
+        self.asgi = self.asgi_client.__enter__()
+
+    def tearDown(self):
+        self.asgi_client.__exit__(None, None, None)
+
+    def assertSameResponse(self, method, url, body=None):
+        wsgi_res = getattr(self.wsgi, method)(url, json=body)
+        asgi_res = getattr(self.asgi, method)(url, json=body)
+
+        self.assertEqual(asgi_res.status_code, wsgi_res.status_code, url)
+        self.assertEqual(asgi_res.json(), json.loads(wsgi_res.data), url)
+
+    def test_read_endpoints(self):
+        self.assertSameResponse('get', '/')
+        self.assertSameResponse('get', '/categories')
+        self.assertSameResponse('get', '/questions')
+        self.assertSameResponse('get', '/questions?page=3')
+        self.assertSameResponse('get', '/questions?after_id=12')
+        self.assertSameResponse('get', '/questions?page=50')
+        self.assertSameResponse('get', '/categories/2/questions')
+        self.assertSameResponse('post', '/searchQuestions', {'searchTerm': 'QUESTION 1'})
+        self.assertSameResponse('get', '/questions?page=2&fields=question,difficulty')
+        self.assertSameResponse('get', '/categories/2/questions?fields=answer')
+        self.assertSameResponse('post', '/searchQuestions?fields=category', {'searchTerm': 'where'})
+        self.assertSameResponse('get', '/questions?fields=nope')
+
+    def test_quiz_last_question(self):
+        with self.app.app_context():
+            ids = [q.id for q in Question.query.filter(Question.category == 1)]
+        payload = {'previous_questions': ids[1:], 'quiz_category': {'id': 1}}
+
+        self.assertSameResponse('post', '/quizzes', payload)
+        payload['previous_questions'] = ids
+        self.assertSameResponse('post', '/quizzes', payload)
+
+    def test_quiz_seeded_batch(self):
+        payload = {'previous_questions': [2], 'quiz_category': {'id': 0},
+                   'count': 8, 'difficulty': {'1': 1, '4': 1}, 'seed': 42}
+        self.assertSameResponse('post', '/quizzes', payload)
+
+    def test_write_endpoints(self):
+        self.assertSameResponse('delete', '/questions/999')
+        new_q = {'question': 'parity', 'answer': 'a', 'difficulty': 1, 'category': 1}
+
+        res = self.asgi.post('/questions', json=new_q)
+        self.assertEqual(res.json()['tatal_questions'], 26)
+        res = self.wsgi.post('/questions', json=new_q)
+        self.assertEqual(json.loads(res.data)['tatal_questions'], 27)
+
+    def test_postgres_search_matches_wsgi(self):
+        # no postgres here, so compare the statements both apps send it
+        from sqlalchemy.dialects import postgresql
+        from flaskr.asgi import AsyncTriviaService, row_fields
+        from flaskr.search import PostgresSearch
+
+        sent = []
+        with self.app.app_context(), mock.patch('flask_sqlalchemy.BaseQuery.all',
+                                                lambda query: sent.append(query.statement)):
+            backend = PostgresSearch()
+            backend.trigram = True
+            backend.search('where', 10, 10)
+        service = AsyncTriviaService(None)
+        service._trigram = True
+        asgi_query = service.search_query('where', 2, row_fields.all, postgres=True)
+
+        def tail(query):
+            sql = str(query.compile(dialect=postgresql.dialect()))
+            return sql[sql.index('WHERE'):]
+        self.assertIn('similarity(questions.question', tail(asgi_query))
+        self.assertEqual(tail(asgi_query), tail(sent[0]))
+
+    def test_app_is_built_lazily(self):
+        import flaskr.asgi
+
+        self.assertNotIn('app', vars(flaskr.asgi))
+        self.addCleanup(vars(flaskr.asgi).pop, 'app', None)
+        self.assertIs(flaskr.asgi.app, flaskr.asgi.app)
 
 
 # Make the tests conveniently executable
@@ -3,13 +3,30 @@ from flask import Flask, request, jsonify, abort
 from sqlalchemy import exc
 import json
 from flask_cors import CORS
+from fsnd_shared.compression import Compression
+from fsnd_shared.instrumentation import Instrumentation
+from fsnd_shared.json_provider import install_json
+from fsnd_shared.pool import pool_metrics
+from fsnd_shared.ratelimit import RateLimiter, storage_from_url
 
-from .database.models import db_drop_and_create_all, setup_db, Drink
-from .auth.auth import AuthError, requires_auth
+from .database.models import db_drop_and_create_all, setup_db, Drink, db, drink_fields
+from .auth.auth import AuthError, requires_auth, rate_limit_key, verified_tokens
+from .menu import menu, menu_fields
 
 app = Flask(__name__)
+install_json(app)
+instrumentation = Instrumentation(app)
+verified_tokens.register_metrics(instrumentation.registry)
+pool_metrics.register_metrics(instrumentation.registry)
+# gzip / brotli, the menu is compressed once per change
+Compression(app)
 setup_db(app)
 CORS(app)
+# per client, by token sub or ip. RATELIMIT_STORAGE_URL=redis://... shares
+# the buckets between workers
+limiter = RateLimiter(app, default='20/second', key_func=rate_limit_key,
+                      shed=pool_metrics.saturated,
+                      storage=storage_from_url(os.environ.get('RATELIMIT_STORAGE_URL')))
 
 '''
 @#TODO uncomment the following line to initialize the datbase
@@ -18,61 +35,182 @@ CORS(app)
 '''
 # db_drop_and_create_all()
 
+'''
+fields_arg(projector)
+    the projection asked for by ?fields=a,b, all fields without it
+    aborts with 400 on an unknown field
+'''
+def fields_arg(projector):
+    try:
+        return projector.parse(request.args.get('fields'))
+    except ValueError:
+        abort(400)
+
+'''
+recipe_arg(recipe)
+    the recipe of a POST / PATCH body as the list the recipe column stores,
+    a single ingredient dict is taken as a one item list
+    aborts with 422 unless every ingredient is a {'name', 'color', 'parts'}
+    dict, the shape short() and long() read back
+'''
+def recipe_arg(recipe):
+    if isinstance(recipe, dict):
+        recipe = [recipe]
+    if not isinstance(recipe, list) or not recipe:
+        abort(422)
+    for ingredient in recipe:
+        if not isinstance(ingredient, dict) \
+                or not isinstance(ingredient.get('name'), str) or not ingredient['name'] \
+                or not isinstance(ingredient.get('color'), str) \
+                or isinstance(ingredient.get('parts'), bool) \
+                or not isinstance(ingredient.get('parts'), (int, float)):
+            abort(422)
+    return recipe
+
 ## ROUTES
 '''
-@#TODO implement endpoint
-    GET /drinks
-        it should be a public endpoint
-        it should contain only the drink.short() data representation
+GET /drinks
+    it should be a public endpoint
+    it should contain only the drink.short() data representation
     returns status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
         or appropriate status code indicating reason for failure
+    served from the pre-encoded menu snapshot, with an etag for conditional gets
+    ?fields=title (or any of id, title, recipe) serves a projection of the menu
 '''
+@app.route('/drinks', methods=['GET'])
+def get_drinks():
+    snapshot = menu.get(fields_arg(menu_fields))
+    response = app.response_class(snapshot.body, mimetype='application/json')
+    response.set_etag(snapshot.etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
 
 
 '''
-@#TODO implement endpoint
-    GET /drinks-detail
-        it should require the 'get:drinks-detail' permission
-        it should contain the drink.long() data representation
+GET /drinks-detail
+    it should require the 'get:drinks-detail' permission
+    it should contain the drink.long() data representation
     returns status code 200 and json {"success": True, "drinks": drinks} where drinks is the list of drinks
         or appropriate status code indicating reason for failure
+    ?fields= loads and returns only those columns, e.g. ?fields=title
 '''
+@app.route('/drinks-detail', methods=['GET'])
+@limiter.limit('5/second', burst=10)
+@requires_auth('get:drinks-detail')
+def get_drinks_detail(payload):
+    projection = fields_arg(drink_fields)
+    drinks = Drink.query.options(projection.load).order_by(Drink.id).all()
+    return jsonify({
+        'success': True,
+        'drinks': [projection.format(drink) for drink in drinks]
+    })
+
 
 
 '''
-@#TODO implement endpoint
-    POST /drinks
-        it should create a new row in the drinks table
-        it should require the 'post:drinks' permission
-        it should contain the drink.long() data representation
+POST /drinks
+    it should create a new row in the drinks table
+    it should require the 'post:drinks' permission
+    it should contain the drink.long() data representation
     returns status code 200 and json {"success": True, "drinks": drink} where drink an array containing only the newly created drink
         or appropriate status code indicating reason for failure
 '''
+@app.route('/drinks', methods=['POST'])
+@limiter.limit('1/second', burst=5)
+@requires_auth('post:drinks')
+def create_drink(payload):
+    body = request.get_json(silent=True) or {}
+    title = body.get('title')
+    if not title or not isinstance(title, str):
+        abort(422)
+    recipe = recipe_arg(body.get('recipe'))
+
+    try:
+        drink = Drink(title=title, recipe=json.dumps(recipe))
+        drink.insert()
+    except exc.SQLAlchemyError:
+        db.session.rollback()
+        abort(422)
+
+    menu.rebuild()
+    return jsonify({
+        'success': True,
+        'drinks': [drink.long()]
+    })
+
 
 
 '''
-@#TODO implement endpoint
-    PATCH /drinks/<id>
-        where <id> is the existing model id
-        it should respond with a 404 error if <id> is not found
-        it should update the corresponding row for <id>
-        it should require the 'patch:drinks' permission
-        it should contain the drink.long() data representation
+PATCH /drinks/<id>
+    where <id> is the existing model id
+    it should respond with a 404 error if <id> is not found
+    it should update the corresponding row for <id>
+    it should require the 'patch:drinks' permission
+    it should contain the drink.long() data representation
     returns status code 200 and json {"success": True, "drinks": drink} where drink an array containing only the updated drink
         or appropriate status code indicating reason for failure
 '''
+@app.route('/drinks/<int:drink_id>', methods=['PATCH'])
+@limiter.limit('1/second', burst=5)
+@requires_auth('patch:drinks')
+def update_drink(payload, drink_id):
+    drink = Drink.query.filter(Drink.id == drink_id).one_or_none()
+    if drink is None:
+        abort(404)
+
+    body = request.get_json(silent=True) or {}
+    if 'title' in body and (not body['title'] or not isinstance(body['title'], str)):
+        abort(422)
+    recipe = recipe_arg(body['recipe']) if 'recipe' in body else None
+    if 'title' in body:
+        drink.title = body['title']
+    if recipe is not None:
+        drink.recipe = json.dumps(recipe)
+
+    try:
+        drink.update()
+    except exc.SQLAlchemyError:
+        db.session.rollback()
+        abort(422)
+
+    menu.rebuild()
+    return jsonify({
+        'success': True,
+        'drinks': [drink.long()]
+    })
+
 
 
 '''
-@#TODO implement endpoint
-    DELETE /drinks/<id>
-        where <id> is the existing model id
-        it should respond with a 404 error if <id> is not found
-        it should delete the corresponding row for <id>
-        it should require the 'delete:drinks' permission
+DELETE /drinks/<id>
+    where <id> is the existing model id
+    it should respond with a 404 error if <id> is not found
+    it should delete the corresponding row for <id>
+    it should require the 'delete:drinks' permission
     returns status code 200 and json {"success": True, "delete": id} where id is the id of the deleted record
         or appropriate status code indicating reason for failure
 '''
+@app.route('/drinks/<int:drink_id>', methods=['DELETE'])
+@limiter.limit('1/second', burst=5)
+@requires_auth('delete:drinks')
+def delete_drink(payload, drink_id):
+    drink = Drink.query.filter(Drink.id == drink_id).one_or_none()
+    if drink is None:
+        abort(404)
+
+    try:
+        drink.delete()
+    except exc.SQLAlchemyError:
+        db.session.rollback()
+        abort(422)
+
+    menu.rebuild()
+    return jsonify({
+        'success': True,
+        'delete': drink_id
+    })
+
 
 
 ## Error Handling
@@ -99,12 +237,60 @@ def unprocessable(error):
 '''
 
 '''
-@#TODO implement error handler for 404
+error handler for 404
     error handler should conform to general task above 
 '''
+@app.errorhandler(404)
+def not_found(error):
+    return jsonify({
+                    "success": False, 
+                    "error": 404,
+                    "message": "resource not found"
+                    }), 404
+
+
+'''
+error handler for 400, e.g. an unknown ?fields= name
+'''
+@app.errorhandler(400)
+def bad_request(error):
+    return jsonify({
+                    "success": False, 
+                    "error": 400,
+                    "message": "bad request"
+                    }), 400
 
 
 '''
-@#TODO implement error handler for AuthError
+error handlers for 429 and 503, sent by the rate limiter with a Retry-After header
+'''
+@app.errorhandler(429)
+def too_many_requests(error):
+    return jsonify({
+                    "success": False, 
+                    "error": 429,
+                    "message": "too many requests"
+                    }), 429
+
+
+@app.errorhandler(503)
+def unavailable(error):
+    return jsonify({
+                    "success": False, 
+                    "error": 503,
+                    "message": "service busy"
+                    }), 503
+
+
+'''
+error handler for AuthError
     error handler should conform to general task above 
 '''
+@app.errorhandler(AuthError)
+def auth_error(error):
+    return jsonify({
+                    "success": False, 
+                    "error": error.status_code,
+                    "message": error.error['description']
+                    }), error.status_code
+
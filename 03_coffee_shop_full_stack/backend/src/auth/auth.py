@@ -1,13 +1,25 @@
 import json
+import os
 from flask import request, _request_ctx_stack
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from fsnd_shared.instrumentation import span
+from fsnd_shared.jwks import JWKSProvider, JWKSError
+from fsnd_shared.jwt_executor import JWTVerifyExecutor
+from fsnd_shared.token_cache import VerifiedTokenCache, VerifiedToken
+
 
 
 AUTH0_DOMAIN = 'udacity-fsnd.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'dev'
+# point JWKS_URL at a file:// path or local server to test without Auth0
+JWKS_URL = os.environ.get('JWKS_URL', 'https://{}/.well-known/jwks.json'.format(AUTH0_DOMAIN))
+
+jwks = JWKSProvider(JWKS_URL)
+verified_tokens = VerifiedTokenCache()
+# JWT_VERIFY_WORKERS=4 verifies fresh tokens in 4 worker processes
+verify_executor = JWTVerifyExecutor.from_env()
 
 ## AuthError Exception
 '''
@@ -20,10 +32,28 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## Rate limit key
+
+'''
+rate_limit_key(req) method
+    the client a request is rate limited as: the token's sub when the
+    bearer token was verified before (a cache lookup, no RS256), the
+    remote address otherwise. an unverified sub is never trusted, or a
+    client could pick a fresh one per request.
+'''
+def rate_limit_key(req):
+    parts = req.headers.get('Authorization', '').split()
+    if len(parts) == 2 and parts[0].lower() == 'bearer':
+        verified = verified_tokens.peek(parts[1])
+        if verified is not None and verified.payload.get('sub'):
+            return 'sub:' + verified.payload['sub']
+    return 'ip:' + (req.remote_addr or '')
+
+
 ## Auth Header
 
 '''
-@#TODO implement get_token_auth_header() method
+get_token_auth_header() method
     it should attempt to get the header from the request
         it should raise an AuthError if no header is present
     it should attempt to split bearer and the token
@@ -31,56 +61,221 @@ class AuthError(Exception):
     return the token part of the header
 '''
 def get_token_auth_header():
-   raise Exception('Not Implemented')
+    auth = request.headers.get('Authorization', None)
+    if not auth:
+        raise AuthError({
+            'code': 'authorization_header_missing',
+            'description': 'Authorization header is expected.'
+        }, 401)
+
+    parts = auth.split()
+    if parts[0].lower() != 'bearer':
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization header must start with "Bearer".'
+        }, 401)
+
+    elif len(parts) == 1:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Token not found.'
+        }, 401)
+
+    elif len(parts) > 2:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization header must be bearer token.'
+        }, 401)
+
+    return parts[1]
+
+'''
+Permissions
+    a required permission is compiled once, when the route is decorated
+        'post:drinks'                               that permission
+        ['get:drinks-detail', 'post:drinks']        all of them
+        all_of('get:drinks-detail', 'post:drinks')  all of them
+        any_of('patch:drinks', 'delete:drinks')     at least one of them
+        '' or None                                  no permission needed
+    checking it against the token's frozenset of permissions is then a
+    single set operation
+'''
+class Permissions:
+    def __init__(self, required, any_of=False):
+        self.required = frozenset(required)
+        self.any_of = any_of
+
+    def allows(self, granted):
+        if not self.required:
+            return True
+        if self.any_of:
+            return not self.required.isdisjoint(granted)
+        return self.required <= granted
+
+    def __repr__(self):
+        return '{}({})'.format('any_of' if self.any_of else 'all_of', sorted(self.required))
+
+
+def all_of(*permissions):
+    return Permissions(permissions)
+
+
+def any_of(*permissions):
+    return Permissions(permissions, any_of=True)
+
+
+def compile_permissions(permission):
+    if isinstance(permission, Permissions):
+        return permission
+    if not permission:
+        return Permissions(())
+    if isinstance(permission, str):
+        return Permissions((permission,))
+    return Permissions(permission)
+
 
 '''
-@#TODO implement check_permissions(permission, payload) method
+check_permissions(permission, payload) method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
-        payload: decoded jwt payload
+        permission: string permission (i.e. 'post:drink'), a list of them
+            or a compiled Permissions
+        payload: decoded jwt payload, or its VerifiedToken
 
+    a route needing no permission passes, with or without the claim
     it should raise an AuthError if permissions are not included in the payload
         !!NOTE check your RBAC settings in Auth0
     it should raise an AuthError if the requested permission string is not in the payload permissions array
     return true otherwise
 '''
 def check_permissions(permission, payload):
-    raise Exception('Not Implemented')
+    required = compile_permissions(permission)
+    if not required.required:
+        return True
+    if isinstance(payload, VerifiedToken):
+        granted = payload.permissions
+    else:
+        granted = payload.get('permissions')
+        granted = frozenset(granted) if granted is not None else None
+
+    if granted is None:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Permissions not included in JWT.'
+        }, 400)
+
+    if not required.allows(granted):
+        raise AuthError({
+            'code': 'unauthorized',
+            'description': 'Permission not found.'
+        }, 403)
+
+    return True
 
 '''
-@#TODO implement verify_decode_jwt(token) method
+verify_decode_jwt(token) method
     @INPUTS
         token: a json web token (string)
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        the keys come from the cached jwks provider, not a fetch per request
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
 
-    !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
+    a token already verified is answered from verified_tokens until its exp
+    a new one is verified through verify_executor, in a worker process
+        when JWT_VERIFY_WORKERS is set
 '''
 def verify_decode_jwt(token):
-    raise Exception('Not Implemented')
+    return verify_token(token).payload
+
+
+def verify_token(token):
+    verified = verified_tokens.get(token)
+    if verified is not None:
+        return verified
+
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 401)
+
+    if 'kid' not in unverified_header:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Authorization malformed.'
+        }, 401)
+
+    try:
+        rsa_key = jwks.get_key(unverified_header['kid'])
+    except JWKSError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to fetch the signing keys, try again.'
+        }, 503)
+
+    if rsa_key is None:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to find the appropriate key.'
+        }, 400)
+
+    try:
+        payload = verify_executor.decode(
+            token,
+            rsa_key,
+            algorithms=ALGORITHMS,
+            audience=API_AUDIENCE,
+            issuer='https://' + AUTH0_DOMAIN + '/'
+        )
+
+    except jwt.ExpiredSignatureError:
+        raise AuthError({
+            'code': 'token_expired',
+            'description': 'Token expired.'
+        }, 401)
+
+    except jwt.JWTClaimsError:
+        raise AuthError({
+            'code': 'invalid_claims',
+            'description': 'Incorrect claims. Please, check the audience and issuer.'
+        }, 401)
+
+    except Exception:
+        raise AuthError({
+            'code': 'invalid_header',
+            'description': 'Unable to parse authentication token.'
+        }, 400)
+
+    return verified_tokens.put(token, payload)
 
 '''
-@#TODO implement @requires_auth(permission) decorator method
+@requires_auth(permission) decorator method
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: string permission (i.e. 'post:drink'), a list of them,
+            any_of(...) or all_of(...), see Permissions above
 
     it should use the get_token_auth_header method to get the token
     it should use the verify_decode_jwt method to decode the jwt
+        the time it takes is reported as the 'jwt' span
     it should use the check_permissions method validate claims and check the requested permission
     return the decorator which passes the decoded payload to the decorated method
 '''
 def requires_auth(permission=''):
+    required = compile_permissions(permission)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with span('jwt'):
+                verified = verify_token(token)
+            check_permissions(required, verified)
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
-    return requires_auth_decorator
\ No newline at end of file
+    return requires_auth_decorator
@@ -1,7 +1,12 @@
 import os
+import threading
+from collections import OrderedDict
 from sqlalchemy import Column, String, Integer
 from flask_sqlalchemy import SQLAlchemy
 import json
+from fsnd_shared.pool import engine_options
+from fsnd_shared.projection import Projector
+
 
 database_filename = "database.db"
 project_dir = os.path.dirname(os.path.abspath(__file__))
@@ -9,15 +14,29 @@ database_path = "sqlite:///{}".format(os.path.join(project_dir, database_filenam
 
 db = SQLAlchemy()
 
+# (id, recipe blob) -> (recipe, short recipe), shared by every Drink loaded
+# in any request, least recently used dropped past RECIPE_CACHE_SIZE
+RECIPE_CACHE_SIZE = 1024
+parsed_recipes = OrderedDict()
+parsed_recipes_lock = threading.Lock()
+
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    create_all: create missing tables (db_drop_and_create_all starts over instead)
+    pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping:
+        connection pool settings, see fsnd_shared.pool.engine_options
+    statement_timeout: postgres statement timeout in milliseconds
+    pool usage is reported by fsnd_shared.pool.pool_metrics, on /metrics
 '''
-def setup_db(app):
+def setup_db(app, database_path=database_path, create_all=False, **pool_options):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path, **pool_options)
     db.app = app
     db.init_app(app)
+    if create_all:
+        db.create_all()
 
 '''
 db_drop_and_create_all()
@@ -42,17 +61,38 @@ class Drink(db.Model):
     # the required datatype is [{'color': string, 'name':string, 'parts':number}]
     recipe =  Column(String(180), nullable=False)
 
+    '''
+    parsed_recipe()
+        the recipe blob decoded once, with its short form
+        the cache is keyed by the drink id and the recipe value it was
+        parsed from, so every request loading the same row shares one
+        parse, and a new recipe is parsed again
+        the returned lists are shared, treat them as read only
+    '''
+    def parsed_recipe(self):
+        key = (self.id, self.recipe)
+        with parsed_recipes_lock:
+            cached = parsed_recipes.get(key)
+            if cached is not None:
+                parsed_recipes.move_to_end(key)
+                return cached
+        recipe = json.loads(self.recipe)
+        cached = (recipe, [{'color': r['color'], 'parts': r['parts']} for r in recipe])
+        with parsed_recipes_lock:
+            parsed_recipes[key] = cached
+            while len(parsed_recipes) > RECIPE_CACHE_SIZE:
+                parsed_recipes.popitem(last=False)
+        return cached
+
     '''
     short()
         short form representation of the Drink model
     '''
     def short(self):
-        print(json.loads(self.recipe))
-        short_recipe = [{'color': r['color'], 'parts': r['parts']} for r in json.loads(self.recipe)]
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': short_recipe
+            'recipe': self.parsed_recipe()[1]
         }
 
     '''
@@ -63,7 +103,7 @@ class Drink(db.Model):
         return {
             'id': self.id,
             'title': self.title,
-            'recipe': json.loads(self.recipe)
+            'recipe': self.parsed_recipe()[0]
         }
 
     '''
@@ -104,4 +144,17 @@ class Drink(db.Model):
         db.session.commit()
 
     def __repr__(self):
-        return json.dumps(self.short())
\ No newline at end of file
+        return json.dumps(self.short())
+
+
+'''
+drink_fields
+    ?fields= projections of the long form, e.g. ?fields=title loads and
+    sends the titles only, without reading or parsing the recipe blobs.
+    id is always kept.
+'''
+drink_fields = Projector([
+    ('id', ('obj.id', ('id',))),
+    ('title', ('obj.title', ('title',))),
+    ('recipe', ('obj.parsed_recipe()[0]', ('recipe',))),
+])
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import threading
+import time
+from collections import namedtuple
+
+from flask import json
+from fsnd_shared.projection import Projector
+
+from .database.models import Drink, drink_fields
+
+'''
+MenuSnapshot
+    body: the encoded GET /drinks response
+    etag: strong etag of body
+    drinks: the short drinks in body
+    variants: ?fields= projections of body, MenuSnapshots built on demand
+'''
+MenuSnapshot = namedtuple('MenuSnapshot', ['body', 'etag', 'drinks', 'variants'])
+
+# the drink_fields projections, over the menu's short drinks
+menu_fields = Projector((name, ('obj[{!r}]'.format(name), ())) for name in drink_fields.fields)
+
+# seconds a snapshot is served before it is rebuilt from the database
+MENU_TTL = float(os.environ.get('MENU_TTL') or 5)
+
+
+'''
+MenuCache
+    holds the public drinks menu already encoded, so GET /drinks is a
+    memory copy.
+    writers call rebuild() once their change is committed. rebuilds run one
+    at a time and a writer whose change was already picked up by a rebuild
+    that started after it returns straight away, so a burst of writes
+    shares rebuilds instead of queueing one each.
+    rebuild() only reaches this process, so a snapshot older than ttl
+    seconds is rebuilt to pick up writes made through other workers. one
+    request rebuilds it, the others keep the old snapshot meanwhile.
+'''
+class MenuCache:
+    def __init__(self, ttl=MENU_TTL):
+        self.ttl = ttl
+        self._snapshot = None
+        self._built_at = 0.0
+        self._build_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        # writes seen / writes covered by the current snapshot
+        self._requested = 0
+        self._built = 0
+
+    '''
+    get(projection)
+        projection: optional menu_fields Projection, its variant is encoded
+        from the snapshot on first use, without a query
+    '''
+    def get(self, projection=None):
+        snapshot = self._snapshot
+        if snapshot is None:
+            self.rebuild()
+            snapshot = self._snapshot
+        elif time.monotonic() - self._built_at >= self.ttl:
+            snapshot = self._expire()
+        if projection is None or projection is menu_fields.all:
+            return snapshot
+        variant = snapshot.variants.get(projection.fields)
+        if variant is None:
+            variant = self._encode([projection.format(drink) for drink in snapshot.drinks])
+            snapshot.variants[projection.fields] = variant
+        return variant
+
+    def rebuild(self):
+        with self._counter_lock:
+            self._requested += 1
+            wanted = self._requested
+
+        with self._build_lock:
+            if self._built >= wanted and self._snapshot is not None:
+                return
+            self._rebuild_locked()
+
+    def _expire(self):
+        if self._build_lock.acquire(blocking=False):
+            try:
+                if time.monotonic() - self._built_at >= self.ttl:
+                    self._rebuild_locked()
+            finally:
+                self._build_lock.release()
+        return self._snapshot
+
+    def _rebuild_locked(self):
+        with self._counter_lock:
+            target = self._requested
+        built_at = time.monotonic()
+        self._snapshot = self._build()
+        self._built_at = built_at
+        self._built = target
+
+    def _build(self):
+        return self._encode([drink.short() for drink in Drink.query.order_by(Drink.id).all()])
+
+    def _encode(self, drinks):
+        body = (json.dumps({'success': True, 'drinks': drinks}, separators=(',', ':')) + '\n').encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        return MenuSnapshot(body, etag, drinks, {})
+
+
+menu = MenuCache()
@@ -0,0 +1,246 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from fsnd_shared.token_cache import VerifiedToken
+
+from src import api
+from src.auth.auth import AuthError, Permissions, all_of, any_of, check_permissions, compile_permissions
+from src.database import models
+from src.database.models import db, Drink
+from src.menu import MenuCache, menu, menu_fields
+
+BARISTA = ['get:drinks-detail']
+MANAGER = ['get:drinks-detail', 'post:drinks', 'patch:drinks', 'delete:drinks']
+WATER = {'name': 'water', 'color': 'blue', 'parts': 1}
+
+
+class CoffeeShopTestCase(unittest.TestCase):
+    """the drinks endpoints on a sqlite file, with token verification stubbed"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        # the engine is created on first use, so the tracked database.db is never opened
+        api.app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(cls.tmp_dir, 'coffee.db')
+        api.limiter.enabled = False
+
+    @classmethod
+    def tearDownClass(cls):
+        api.limiter.enabled = True
+        shutil.rmtree(cls.tmp_dir)
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        db.session.add(Drink(title='matcha', recipe=json.dumps([WATER])))
+        db.session.commit()
+        menu.rebuild()
+        self.client = api.app.test_client
+
+    def tearDown(self):
+        db.session.remove()
+
+    def headers(self, permissions):
+        return {'Authorization': 'Bearer ' + ','.join(permissions)}
+
+    def auth(self):
+        # the bearer token is the comma separated permissions it grants
+        def verify_token(token):
+            permissions = frozenset(token.split(','))
+            return VerifiedToken({'sub': 'tester', 'permissions': sorted(permissions)}, permissions)
+        return mock.patch('src.auth.auth.verify_token', verify_token)
+
+    def test_get_drinks(self):
+        res = self.client().get('/drinks')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'], [{'id': 1, 'title': 'matcha',
+                                           'recipe': [{'color': 'blue', 'parts': 1}]}])
+        self.assertEqual(self.client().get('/drinks', headers={'If-None-Match': res.headers['ETag']})
+                         .status_code, 304)
+
+    def test_get_drinks_detail_needs_permission(self):
+        with self.auth():
+            res = self.client().get('/drinks-detail', headers=self.headers(['post:drinks']))
+            ok = self.client().get('/drinks-detail', headers=self.headers(BARISTA))
+
+        self.assertEqual(res.status_code, 403)
+        self.assertEqual(ok.status_code, 200)
+        self.assertEqual(json.loads(ok.data)['drinks'][0]['recipe'], [WATER])
+
+    def test_recipes_parsed_once(self):
+        with self.auth(), mock.patch.object(models, 'json', wraps=json) as spy:
+            first = self.client().get('/drinks-detail', headers=self.headers(BARISTA))
+            parses = spy.loads.call_count
+            again = [self.client().get('/drinks-detail', headers=self.headers(BARISTA)) for i in range(3)]
+
+        self.assertLessEqual(parses, 1)
+        self.assertEqual(spy.loads.call_count, parses)
+        self.assertTrue(all(res.data == first.data for res in again))
+        # a changed recipe is parsed again
+        drink = Drink.query.get(1)
+        drink.recipe = json.dumps([dict(WATER, parts=2)])
+        drink.update()
+        self.assertEqual(drink.long()['recipe'][0]['parts'], 2)
+
+    def test_create_drink(self):
+        with self.auth():
+            res = self.client().post('/drinks', json={'title': 'tea', 'recipe': WATER},
+                                     headers=self.headers(MANAGER))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['drinks'][0]['recipe'], [WATER])
+        # the writer rebuilt the menu
+        titles = [d['title'] for d in json.loads(self.client().get('/drinks').data)['drinks']]
+        self.assertEqual(titles, ['matcha', 'tea'])
+
+    def test_create_drink_rejects_bad_recipes(self):
+        bad = [
+            None,
+            [],
+            'water',
+            ['water'],
+            [{'name': 'water', 'color': 'blue'}],
+            [{'name': 'water', 'color': 'blue', 'parts': '1'}],
+            [{'name': 'water', 'color': 'blue', 'parts': True}],
+            [{'name': '', 'color': 'blue', 'parts': 1}],
+            [WATER, {'color': 'white', 'parts': 1}],
+        ]
+        with self.auth():
+            statuses = [self.client().post('/drinks', json={'title': 'tea', 'recipe': recipe},
+                                           headers=self.headers(MANAGER)).status_code
+                        for recipe in bad]
+
+        self.assertEqual(statuses, [422] * len(bad))
+        self.assertEqual(Drink.query.count(), 1)
+
+    def test_update_drink(self):
+        with self.auth():
+            res = self.client().patch('/drinks/1', json={'title': 'iced matcha'},
+                                      headers=self.headers(MANAGER))
+            bad = self.client().patch('/drinks/1', json={'title': 'x', 'recipe': [{'name': 'ice'}]},
+                                      headers=self.headers(MANAGER))
+            missing = self.client().patch('/drinks/99', json={'title': 'x'},
+                                          headers=self.headers(MANAGER))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data)['drinks'][0]['title'], 'iced matcha')
+        self.assertEqual(bad.status_code, 422)
+        self.assertEqual(missing.status_code, 404)
+        db.session.expire_all()
+        self.assertEqual(Drink.query.get(1).title, 'iced matcha')
+        self.assertEqual(json.loads(self.client().get('/drinks').data)['drinks'][0]['title'],
+                         'iced matcha')
+
+    def test_delete_drink(self):
+        with self.auth():
+            res = self.client().delete('/drinks/1', headers=self.headers(MANAGER))
+            again = self.client().delete('/drinks/1', headers=self.headers(MANAGER))
+
+        self.assertEqual(json.loads(res.data), {'success': True, 'delete': 1})
+        self.assertEqual(again.status_code, 404)
+        self.assertEqual(json.loads(self.client().get('/drinks').data)['drinks'], [])
+
+    def test_menu_snapshot(self):
+        cache = MenuCache(ttl=3600)
+        snapshot = cache.get()
+
+        self.assertIs(cache.get(), snapshot)
+        self.assertEqual(json.loads(snapshot.body)['drinks'], snapshot.drinks)
+        titles = cache.get(menu_fields.parse('title'))
+        self.assertEqual(json.loads(titles.body)['drinks'], [{'id': 1, 'title': 'matcha'}])
+        self.assertIs(cache.get(menu_fields.parse('title')), titles)
+
+        # a write through this process is seen as soon as it is committed
+        Drink(title='tea', recipe=json.dumps([WATER])).insert()
+        cache.rebuild()
+        self.assertEqual(len(cache.get().drinks), 2)
+        self.assertNotEqual(cache.get().etag, snapshot.etag)
+
+    def test_menu_snapshot_expires(self):
+        cache = MenuCache(ttl=3600)
+        snapshot = cache.get()
+        # a write made by another worker, which never calls this cache's rebuild()
+        Drink(title='tea', recipe=json.dumps([WATER])).insert()
+
+        self.assertIs(cache.get(), snapshot)
+        cache.ttl = 0
+        self.assertEqual([d['title'] for d in cache.get().drinks], ['matcha', 'tea'])
+
+    def test_token_cache_metrics(self):
+        api.verified_tokens.clear()
+        api.verified_tokens.put('t', {'sub': 'a', 'exp': time.time() + 60})
+        api.verified_tokens.get('t')
+        api.verified_tokens.get('unknown')
+
+        # /metrics is only served with METRICS_ENABLED, read what it would serve
+        self.assertEqual(api.app.test_client().get('/metrics').status_code, 404)
+        lines = api.instrumentation.registry.exposition().splitlines()
+        self.assertIn('jwt_token_cache_size 1', lines)
+        self.assertIn('# TYPE jwt_token_cache_hits counter', lines)
+        self.assertTrue(any(line.startswith('jwt_token_cache_hits_total ') for line in lines))
+        self.assertTrue(any(line.startswith('jwt_token_cache_misses_total ') for line in lines))
+        self.assertTrue(any(line.startswith('jwt_token_cache_mean_lookup_microseconds ') for line in lines))
+
+
+class PermissionsTestCase(unittest.TestCase):
+    """compiled permission requirements, checked against a token's permissions"""
+
+    def test_compile_permissions(self):
+        required = any_of('patch:drinks')
+
+        self.assertIs(compile_permissions(required), required)
+        self.assertEqual(compile_permissions('post:drinks').required, {'post:drinks'})
+        self.assertEqual(compile_permissions(MANAGER).required, set(MANAGER))
+        self.assertFalse(compile_permissions(MANAGER).any_of)
+        for nothing in ('', None, []):
+            self.assertEqual(compile_permissions(nothing).required, frozenset())
+
+    def test_all_of(self):
+        required = all_of('get:drinks-detail', 'post:drinks')
+
+        self.assertTrue(required.allows(frozenset(MANAGER)))
+        self.assertFalse(required.allows(frozenset(BARISTA)))
+        self.assertEqual(repr(required), "all_of(['get:drinks-detail', 'post:drinks'])")
+
+    def test_any_of(self):
+        required = any_of('patch:drinks', 'delete:drinks')
+
+        self.assertTrue(required.allows(frozenset(['delete:drinks'])))
+        self.assertFalse(required.allows(frozenset(BARISTA)))
+        self.assertFalse(required.allows(frozenset()))
+
+    def test_nothing_required_allows_anything(self):
+        self.assertTrue(Permissions(()).allows(frozenset()))
+        self.assertTrue(any_of().allows(frozenset()))
+
+    def test_check_permissions(self):
+        token = VerifiedToken({'sub': 'tester'}, frozenset(BARISTA))
+
+        self.assertTrue(check_permissions('get:drinks-detail', token))
+        self.assertTrue(check_permissions(BARISTA, {'permissions': BARISTA}))
+        with self.assertRaises(AuthError) as denied:
+            check_permissions(any_of('post:drinks', 'patch:drinks'), token)
+        self.assertEqual(denied.exception.status_code, 403)
+
+    def test_missing_permissions_claim(self):
+        for payload in ({'sub': 'tester'}, VerifiedToken({'sub': 'tester'}, None)):
+            with self.assertRaises(AuthError) as missing:
+                check_permissions('get:drinks-detail', payload)
+            self.assertEqual(missing.exception.status_code, 400)
+            self.assertEqual(missing.exception.error['code'], 'invalid_claims')
+            # a route needing no permission does not look at the claim
+            self.assertTrue(check_permissions('', payload))
+            self.assertTrue(check_permissions(None, payload))
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()
@@ -1,16 +1,32 @@
 from flask import Flask, request, abort
 import json
+import os
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from fsnd_shared.compression import Compression
+from fsnd_shared.instrumentation import Instrumentation, span
+from fsnd_shared.jwks import JWKSProvider
+from fsnd_shared.jwt_executor import JWTVerifyExecutor
+from fsnd_shared.token_cache import VerifiedTokenCache
+
 
 # https://{{YOUR_DOMAIN}}/authorize?audience={{API_IDENTIFIER}}&response_type=token&client_id={{YOUR_CLIENT_ID}}&redirect_uri={{YOUR_CALLBACK_URI}}
 
 app = Flask(__name__)
+instrumentation = Instrumentation(app)
+Compression(app)
 
 AUTH0_DOMAIN = "danielfarahani.au.auth0.com"
 ALGORITHMS = ['RS256']
 API_AUDIENCE = "app"
+# point JWKS_URL at a file:// path or local server to test without Auth0
+JWKS_URL = os.environ.get('JWKS_URL', f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+jwks = JWKSProvider(JWKS_URL)
+verified_tokens = VerifiedTokenCache()
+verified_tokens.register_metrics(instrumentation.registry)
+# JWT_VERIFY_WORKERS=4 verifies fresh tokens in 4 worker processes
+verify_executor = JWTVerifyExecutor.from_env()
 
 
 class AuthError(Exception):
@@ -59,10 +75,12 @@ def get_token_auth_header():
     return token
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json') # TODO what is this?
-    jwks = json.loads(jsonurl.read())
+    # a token verified before is trusted until its exp
+    verified = verified_tokens.get(token)
+    if verified is not None:
+        return verified.payload
+
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
 
     # KID missing error
     if 'kid' not in unverified_header:
@@ -71,21 +89,14 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    # if KIDs are the sme go ahead and make the datapackage
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # cached kid -> key lookup, the jwks is only fetched when it expires
+    rsa_key = jwks.get_key(unverified_header['kid'])
 
     # decode the payload with the toek and key info
     if rsa_key:
         try:
-            payload = jwt.decode(
+            # RS256, in a worker process when JWT_VERIFY_WORKERS is set
+            payload = verify_executor.decode(
                 token,
                 rsa_key,
                 algorithms=ALGORITHMS,
@@ -93,6 +104,7 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
+            verified_tokens.put(token, payload)
             return payload
 
         except jwt.ExpiredSignatureError:
@@ -123,7 +135,8 @@ def requires_auth(f):
     def wrapper(*args, **kwargs):
         token = get_token_auth_header()
         try:
-            payload = verify_decode_jwt(token)
+            with span('jwt'):
+                payload = verify_decode_jwt(token)
         except:
             abort(401)
 
@@ -135,7 +148,6 @@ def requires_auth(f):
 @app.route('/headers')
 @requires_auth
 def headers(payload):
-    print(payload)
     return 'Access Granted'
 
 
@@ -0,0 +1,101 @@
+"""
+JSON encoder throughput on the payloads the apps actually send:
+pages of Question.format() rows, a quiz question, and the drinks menu
+in Drink.long() form.
+
+    python benchmarks/json_encoders.py [--rows 1000] [--repeat 5]
+
+prints one JSON document with the results of every encoder and payload,
+so two runs can be diffed.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, '02_trivia_api', 'backend'))
+sys.path.insert(0, os.path.join(ROOT, '03_coffee_shop_full_stack', 'backend'))
+
+from flask.json import JSONEncoder  # noqa: E402
+
+from fsnd_shared.json_provider import FastJSONEncoder, orjson  # noqa: E402
+from models import Question  # noqa: E402
+from src.database.models import Drink  # noqa: E402
+
+ENCODERS = {
+  'stdlib': JSONEncoder,
+  'fast': FastJSONEncoder,
+}
+
+
+def question_rows(n):
+  rows = []
+  for i in range(n):
+    question = Question(question='What is the answer to question number {}?'.format(i),
+                        answer='Answer {}'.format(i), category=i % 6 + 1,
+                        difficulty=i % 5 + 1)
+    question.id = i + 1
+    rows.append(question.format())
+  return rows
+
+
+def drink_rows(n):
+  rows = []
+  for i in range(n):
+    drink = Drink(title='drink {}'.format(i), recipe=json.dumps([
+      {'name': 'milk', 'color': 'white', 'parts': 1},
+      {'name': 'coffee', 'color': 'brown', 'parts': 2},
+      {'name': 'foam', 'color': 'grey', 'parts': 1}
+    ]))
+    drink.id = i + 1
+    rows.append(drink.long())
+  return rows
+
+
+def payloads(rows):
+  questions = question_rows(rows)
+  categories = {i: name for i, name in enumerate(
+    ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports'], start=1)}
+  return {
+    'questions_page': {'success': True, 'questions': questions[:10], 'total_questions': rows,
+                       'categories': categories, 'current_category': None},
+    'questions_all': {'success': True, 'questions': questions, 'total_questions': rows},
+    'quiz': {'success': True, 'question': questions[0]},
+    'drinks_long': {'success': True, 'drinks': drink_rows(max(rows // 10, 1))},
+  }
+
+
+def bench(encoder, payload, repeat):
+  encode = encoder(separators=(',', ':'), sort_keys=True).encode
+  size = len(encode(payload).encode('utf-8'))
+  number = max(1, 200000 // max(size, 1))
+  best = min(timeit.repeat(lambda: encode(payload), number=number, repeat=repeat)) / number
+  return {
+    'bytes': size,
+    'us_per_call': best * 1e6,
+    'mb_per_s': size / best / 1e6,
+  }
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--rows', type=int, default=1000)
+  parser.add_argument('--repeat', type=int, default=5)
+  args = parser.parse_args()
+
+  results = {}
+  for name, payload in payloads(args.rows).items():
+    results[name] = {enc: bench(cls, payload, args.repeat) for enc, cls in ENCODERS.items()}
+    results[name]['speedup'] = results[name]['stdlib']['us_per_call'] / results[name]['fast']['us_per_call']
+
+  print(json.dumps({
+    'orjson': orjson.__version__ if orjson is not None else None,
+    'rows': args.rows,
+    'results': results
+  }, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,138 @@
+"""
+RS256 verification throughput for a burst of freshly issued tokens,
+verified inline and through JWTVerifyExecutor with a growing number of
+worker processes, the tokens signed by a throwaway local key.
+
+    python benchmarks/jwt_verify.py [--tokens 2000] [--workers 1,2,4]
+        [--threads 16] [--output results.json]
+
+every token is new, so none is answered from the verified token cache:
+this is the cost of a login burst. --workers defaults to powers of two
+up to the core count. the results are one JSON document, so two
+commits or two machines can be diffed.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jose import jwk, jwt
+
+from fsnd_shared.jwt_executor import JWTVerifyExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ISSUER = 'https://bench.local/'
+AUDIENCE = 'bench'
+KID = 'bench-key'
+OPTIONS = {'algorithms': ['RS256'], 'audience': AUDIENCE, 'issuer': ISSUER}
+
+
+def private_key_pem(bits=2048):
+  """a new RSA key, from whichever RSA library python-jose was installed with"""
+  try:
+    from Crypto.PublicKey import RSA
+    return RSA.generate(bits).exportKey('PEM').decode()
+  except ImportError:
+    import rsa
+    return rsa.newkeys(bits)[1].save_pkcs1().decode()
+
+
+def issue(pem, count):
+  now = int(time.time())
+  return [jwt.encode({
+    'iss': ISSUER,
+    'aud': AUDIENCE,
+    'sub': 'user|{}'.format(i),
+    'iat': now,
+    'exp': now + 3600,
+    'permissions': ['get:drinks-detail']
+  }, pem, algorithm='RS256', headers={'kid': KID}) for i in range(count)]
+
+
+def percentile(ordered, q):
+  return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def run(executor, tokens, key, threads):
+  def timed(token):
+    start = time.perf_counter()
+    executor.decode(token, key, **OPTIONS)
+    return time.perf_counter() - start
+
+  started = time.perf_counter()
+  with ThreadPoolExecutor(threads) as pool:
+    latencies = sorted(pool.map(timed, tokens))
+  wall = time.perf_counter() - started
+  return {
+    'tokens_per_second': len(tokens) / wall,
+    'p50_ms': percentile(latencies, 0.50) * 1000,
+    'p99_ms': percentile(latencies, 0.99) * 1000,
+  }
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                   stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  cores = os.cpu_count() or 1
+  default_workers = []
+  n = 1
+  while n <= cores:
+    default_workers.append(n)
+    n *= 2
+
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--tokens', type=int, default=2000, help='fresh tokens per run')
+  parser.add_argument('--workers', default=','.join(str(w) for w in default_workers))
+  parser.add_argument('--threads', type=int, default=16, help='request threads verifying at once')
+  parser.add_argument('--output', help='write the JSON here instead of stdout')
+  args = parser.parse_args()
+
+  pem = private_key_pem()
+  key = jwk.construct(pem, 'RS256').public_key().to_dict()
+  key['kid'] = KID
+
+  runs = {}
+  for workers in [0] + [int(w) for w in args.workers.split(',') if w]:
+    # a fresh batch per run, and a queue as deep as the burst so that
+    # nothing falls back inline unless the pool times out
+    tokens = issue(pem, args.tokens)
+    executor = JWTVerifyExecutor(workers, max_pending=args.threads)
+    executor.start()
+    try:
+      result = run(executor, tokens, key, args.threads)
+    finally:
+      executor.shutdown()
+    result.update(executor.stats())
+    runs['inline' if workers == 0 else '{}_workers'.format(workers)] = result
+
+  inline = runs['inline']['tokens_per_second']
+  for result in runs.values():
+    result['speedup'] = result['tokens_per_second'] / inline
+
+  report = json.dumps({
+    'commit': git_commit(),
+    'python': platform.python_version(),
+    'cpu_count': cores,
+    'tokens': args.tokens,
+    'threads': args.threads,
+    'runs': runs
+  }, indent=2)
+  if args.output:
+    with open(args.output, 'w') as out:
+      out.write(report + '\n')
+  else:
+    print(report)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,278 @@
+"""
+Latency, throughput and memory of the trivia API read endpoints
+(questions, with and without ?fields=, search, category questions,
+quizzes) on synthetic datasets of growing size, with sqlite standing
+in for postgres.
+
+    python benchmarks/trivia_api.py [--sizes 1000,100000,1000000]
+        [--requests 200] [--servers test_client,wsgi] [--concurrency 4]
+        [--data-dir /tmp/trivia-bench] [--output results.json]
+
+every size runs in a fresh process so peak RSS is its own. datasets are
+seeded once into --data-dir and reused by later runs. the results are
+one JSON document, so two commits can be diffed.
+"""
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, '02_trivia_api', 'backend')
+
+CATEGORIES = ['Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports']
+WORDS = ['river', 'planet', 'painter', 'capital', 'ocean', 'king', 'movie', 'goal',
+         'element', 'mountain', 'novel', 'battle', 'album', 'island', 'player', 'empire',
+         'desert', 'symphony', 'league', 'molecule']
+SEED_CHUNK = 10000
+WARMUP = 5
+
+
+def seed(path, size, rng_seed=42):
+  """creates a sqlite file with the trivia schema and `size` questions"""
+  from sqlalchemy import create_engine
+  from models import Question, Category
+
+  engine = create_engine('sqlite:///' + path)
+  Question.metadata.create_all(engine)
+  rng = random.Random(rng_seed)
+  with engine.begin() as conn:
+    conn.execute(Category.__table__.insert(),
+                 [{'id': i, 'type': name} for i, name in enumerate(CATEGORIES, start=1)])
+    for start in range(0, size, SEED_CHUNK):
+      conn.execute(Question.__table__.insert(), [{
+        'question': 'Which {} is linked to the {} number {}?'.format(
+          rng.choice(WORDS), rng.choice(WORDS), i),
+        'answer': 'answer {}'.format(i),
+        'category': rng.randint(1, len(CATEGORIES)),
+        'difficulty': rng.randint(1, 5)
+      } for i in range(start, min(start + SEED_CHUNK, size))])
+  engine.dispose()
+
+
+def dataset(data_dir, size):
+  path = os.path.join(data_dir, 'trivia_{}.db'.format(size))
+  if not os.path.exists(path):
+    started = time.perf_counter()
+    seed(path + '.tmp', size)
+    os.rename(path + '.tmp', path)
+    return path, time.perf_counter() - started
+  return path, None
+
+
+def endpoints(size, rng):
+  """name -> callable returning a (method, url, json body) to send"""
+  pages = max(size // 10, 1)
+  category_pages = max(size // 10 // len(CATEGORIES), 1)
+
+  return {
+    'show_questions': lambda: ('GET', '/questions?page={}'.format(rng.randint(1, pages)), None),
+    'show_questions_fields': lambda: ('GET', '/questions?page={}&fields=question,category'.format(
+      rng.randint(1, pages)), None),
+    'find_question': lambda: ('POST', '/searchQuestions', {
+      'searchTerm': '{} is linked to the {}'.format(rng.choice(WORDS), rng.choice(WORDS))}),
+    'show_category_questions': lambda: ('GET', '/categories/{}/questions?page={}'.format(
+      rng.randint(1, len(CATEGORIES)), rng.randint(1, category_pages)), None),
+    'quiz': lambda: ('POST', '/quizzes', {
+      'quiz_category': {'id': rng.randint(0, len(CATEGORIES))},
+      'previous_questions': [rng.randint(1, size) for _ in range(5)]}),
+  }
+
+
+class TestClientDriver:
+  def __init__(self, app):
+    self.app = app
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    pass
+
+  def request(self, method, url, body):
+    client = self.app.test_client()
+    res = client.open(url, method=method, json=body)
+    res.get_data()
+    return res.status_code
+
+
+class WSGIServerDriver:
+  """the app behind werkzeug's threaded server, hit over real sockets"""
+
+  def __init__(self, app):
+    from werkzeug.serving import make_server
+    # one access log line per request would dominate the timings
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    self.server = make_server('127.0.0.1', 0, app, threaded=True)
+    self.port = self.server.server_port
+    self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.server.shutdown()
+
+  def request(self, method, url, body):
+    conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+    try:
+      headers = {}
+      data = None
+      if body is not None:
+        data = json.dumps(body)
+        headers['Content-Type'] = 'application/json'
+      conn.request(method, url, data, headers)
+      res = conn.getresponse()
+      res.read()
+      return res.status
+    finally:
+      conn.close()
+
+
+DRIVERS = {
+  'test_client': TestClientDriver,
+  'wsgi': WSGIServerDriver,
+}
+
+
+def percentile(ordered, q):
+  return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def peak_rss_mb():
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on linux, bytes on macos
+  return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_endpoint(driver, make_request, count, concurrency):
+  for _ in range(WARMUP):
+    driver.request(*make_request())
+
+  requests = [make_request() for _ in range(count)]
+  statuses = {}
+
+  def timed(req):
+    start = time.perf_counter()
+    status = driver.request(*req)
+    return time.perf_counter() - start, status
+
+  started = time.perf_counter()
+  if concurrency > 1:
+    with ThreadPoolExecutor(concurrency) as pool:
+      results = list(pool.map(timed, requests))
+  else:
+    results = [timed(req) for req in requests]
+  wall = time.perf_counter() - started
+
+  latencies = sorted(elapsed for elapsed, _ in results)
+  for _, status in results:
+    statuses[str(status)] = statuses.get(str(status), 0) + 1
+  return {
+    'requests': count,
+    'p50_ms': percentile(latencies, 0.50) * 1000,
+    'p99_ms': percentile(latencies, 0.99) * 1000,
+    'mean_ms': sum(latencies) / count * 1000,
+    'throughput_rps': count / wall,
+    'peak_rss_mb': peak_rss_mb(),
+    'statuses': statuses,
+  }
+
+
+def run_size(size, args, queue):
+  sys.path.insert(0, BACKEND)
+  from flaskr import create_app
+
+  path, seed_seconds = dataset(args.data_dir, size)
+  result = {
+    'seed_seconds': seed_seconds,
+    'db_mb': os.path.getsize(path) / (1024 * 1024),
+    'servers': {}
+  }
+
+  app = create_app({'database_path': 'sqlite:///' + path})
+  # one client hammering a route is the point here, not something to throttle
+  app.extensions['ratelimiter'].enabled = False
+  for server in args.servers:
+    # the same request sequence for every server
+    rng = random.Random(size)
+    concurrency = args.concurrency if server != 'test_client' else 1
+    with DRIVERS[server](app) as driver:
+      result['servers'][server] = {
+        name: run_endpoint(driver, make_request, args.requests, concurrency)
+        for name, make_request in endpoints(size, rng).items()
+      }
+  result['peak_rss_mb'] = peak_rss_mb()
+  queue.put(result)
+
+
+def wait_for(process, queue):
+  while True:
+    try:
+      result = queue.get(timeout=1)
+      process.join()
+      return result
+    except Empty:
+      if not process.is_alive():
+        raise SystemExit('benchmark process failed with exit code {}'.format(process.exitcode))
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                   stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--sizes', default='1000,100000,1000000')
+  parser.add_argument('--requests', type=int, default=200, help='timed requests per endpoint')
+  parser.add_argument('--servers', default='test_client,wsgi')
+  parser.add_argument('--concurrency', type=int, default=4, help='client threads against the wsgi server')
+  parser.add_argument('--data-dir', default=os.path.join(ROOT, 'benchmarks', '.data'))
+  parser.add_argument('--output', help='write the JSON here instead of stdout')
+  args = parser.parse_args()
+  args.servers = [s for s in args.servers.split(',') if s]
+  unknown = set(args.servers) - set(DRIVERS)
+  if unknown:
+    parser.error('unknown server {}'.format(', '.join(sorted(unknown))))
+  os.makedirs(args.data_dir, exist_ok=True)
+
+  results = {}
+  ctx = multiprocessing.get_context('spawn')
+  for size in (int(s) for s in args.sizes.split(',') if s):
+    queue = ctx.Queue()
+    process = ctx.Process(target=run_size, args=(size, args, queue))
+    process.start()
+    results[str(size)] = wait_for(process, queue)
+
+  report = json.dumps({
+    'commit': git_commit(),
+    'python': platform.python_version(),
+    'requests': args.requests,
+    'concurrency': args.concurrency,
+    'sizes': results
+  }, indent=2)
+  if args.output:
+    with open(args.output, 'w') as out:
+      out.write(report + '\n')
+  else:
+    print(report)
+
+
+if __name__ == '__main__':
+  main()
@@ -2,10 +2,17 @@ import os
 from flask import Flask, request, abort, jsonify
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from fsnd_shared.compression import Compression
+from fsnd_shared.instrumentation import Instrumentation
+from fsnd_shared.json_provider import install_json
+
 
 def create_app(test_config=None):
   # create and configure the app
   app = Flask(__name__)
+  install_json(app)
+  Instrumentation(app)
+  Compression(app)
   CORS(app)
 
   return app
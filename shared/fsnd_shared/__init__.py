@@ -0,0 +1,4 @@
+"""
+helpers shared by the projects of this repository, each one imported
+from its own module, e.g. fsnd_shared.instrumentation
+"""
@@ -0,0 +1,188 @@
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# below this many bytes compressing saves too little to be worth the cpu
+MIN_SIZE = 1024
+# per request bodies favour speed, bodies compressed once per etag size
+GZIP_LEVEL = 6
+GZIP_LEVEL_CACHED = 9
+BROTLI_QUALITY = 5
+BROTLI_QUALITY_CACHED = 11
+# precompressed variants kept, one per (etag, encoding)
+MAX_CACHED = 256
+
+# etag suffix of each coding: a compressed body is another representation
+ETAG_SUFFIXES = {'gzip': 'gz', 'br': 'br'}
+
+COMPRESSIBLE = {'application/json', 'application/x-ndjson', 'application/javascript'}
+
+
+def compressible(mimetype):
+    return mimetype in COMPRESSIBLE or mimetype.startswith('text/')
+
+
+def parse_accept_encoding(header):
+    """
+    header: an Accept-Encoding value, e.g. 'gzip;q=0.8, br'
+    returns {coding: q}
+    """
+    accepted = {}
+    for part in (header or '').split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate(header, offered):
+    """
+    offered: codings the server can produce, preferred first
+    returns the best coding the client accepts, None for identity
+    """
+    accepted = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for coding in offered:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def coded_etag(etag, coding):
+    """the etag of the coding's variant of a body tagged etag"""
+    return '{}-{}'.format(etag, ETAG_SUFFIXES[coding])
+
+
+def compress(body, coding, cached=False):
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY_CACHED if cached else BROTLI_QUALITY)
+    # wbits 31 writes a gzip header and trailer
+    compressor = zlib.compressobj(GZIP_LEVEL_CACHED if cached else GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_stream(chunks, coding):
+    """compresses a streamed body chunk by chunk, each one flushed as it comes"""
+    if coding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        step = lambda chunk: compressor.process(chunk) + compressor.flush()
+        finish = compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        step = lambda chunk: compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    try:
+        for chunk in chunks:
+            data = step(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # closing the body, e.g. a stream_with_context generator, ends its request context
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class Compression:
+    """
+    gzip / brotli response compression, negotiated through Accept-Encoding.
+
+    brotli is offered when the brotli package is installed. bodies under
+    min_size and types that do not compress (images, ...) are sent as is.
+    streamed responses are compressed chunk by chunk.
+
+    responses with a strong ETag are compressed once per etag at the
+    highest level and the variant is kept, so a change costs one
+    compression rather than one per request. the variant gets its own
+    etag, "<etag>-gz" or "<etag>-br", and If-None-Match is checked
+    against it.
+    """
+
+    def __init__(self, app=None, min_size=MIN_SIZE, max_cached=MAX_CACHED):
+        self.min_size = min_size
+        self.max_cached = max_cached
+        self.offered = ('br', 'gzip') if brotli is not None else ('gzip',)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['compression'] = self
+        app.after_request(self._after_request)
+
+    def _cached(self, etag, body, coding):
+        key = (etag, coding)
+        with self._lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+                return data
+        data = compress(body, coding, cached=True)
+        with self._lock:
+            self._cache[key] = data
+            while len(self._cache) > self.max_cached:
+                self._cache.popitem(last=False)
+        return data
+
+    def _after_request(self, response):
+        if response.status_code < 200 or response.status_code in (204, 206, 304) \
+                or response.direct_passthrough or 'Content-Encoding' in response.headers \
+                or not compressible(response.mimetype):
+            return response
+        response.vary.add('Accept-Encoding')
+
+        coding = negotiate(request.headers.get('Accept-Encoding'), self.offered)
+        if coding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, coding)
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = coding
+            return response
+
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            tagged = coded_etag(etag, coding)
+            if request.if_none_match.contains(tagged):
+                return self._not_modified(response, tagged)
+            data = self._cached(etag, body, coding)
+        else:
+            data = compress(body, coding)
+        if len(data) >= len(body):
+            return response
+        response.set_data(data)
+        response.headers['Content-Encoding'] = coding
+        if etag and not weak:
+            response.set_etag(tagged)
+        return response
+
+    def _not_modified(self, response, etag):
+        # the client holds this coding's variant already. werkzeug drops the
+        # entity headers of a 304 when it is sent
+        response.status_code = 304
+        response.set_data(b'')
+        response.set_etag(etag)
+        return response
@@ -0,0 +1,290 @@
+import bisect
+import collections
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# prometheus' default latency buckets, in seconds
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# the same statement this many times in one request counts as an N+1
+N_PLUS_ONE_THRESHOLD = 5
+
+
+class Histogram:
+    """
+    a prometheus style histogram, one set of buckets per label value tuple
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            series = [(labels, list(counts), total, n) for labels, (counts, total, n) in self._series.items()]
+        for labels, counts, total, n in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', labels, (('le', '{:g}'.format(bound)),), cumulative
+            yield '_bucket', labels, (('le', '+Inf'),), n
+            yield '_sum', labels, (), total
+            yield '_count', labels, (), n
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = collections.Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] += amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield '_total', labels, (), value
+
+
+class Gauge:
+    """
+    a value kept elsewhere (a cache's counters, a pool's size), read from
+    func() on every scrape. func returns a number, or a dict of label
+    value tuple -> number. kind='counter' exposes an ever growing value
+    as a counter.
+    """
+
+    def __init__(self, name, help, func, labelnames=(), kind='gauge'):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labelnames = labelnames
+        self.kind = kind
+
+    def samples(self):
+        values = self.func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        suffix = '_total' if self.kind == 'counter' else ''
+        for labels, value in sorted(values.items()):
+            yield suffix, labels, (), value
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, func, labelnames=(), kind='gauge'):
+        metric = Gauge(name, help, func, labelnames, kind)
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        """the metrics in the prometheus text format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for suffix, labels, extra, value in metric.samples():
+                pairs = tuple(zip(metric.labelnames, labels)) + extra
+                label_text = ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs)
+                lines.append('{}{}{} {:g}'.format(
+                    metric.name, suffix, '{' + label_text + '}' if label_text else '', value))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestStats:
+    """
+    what one request spent: sql statements and named spans (e.g. jwt)
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.statements = collections.Counter()
+        self.spans = {}
+        self.recorded = False
+
+
+def current_stats():
+    if has_app_context():
+        return g.get('request_stats')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    starts = conn.info.get('query_start')
+    if stats is None or not starts:
+        return
+    stats.sql_time += time.perf_counter() - starts.pop()
+    stats.sql_count += 1
+    stats.statements[statement] += 1
+
+
+def metrics_enabled(app):
+    """
+    METRICS_ENABLED from the app config, else from the environment, off by
+    default: the metrics endpoint has no auth and must only be reachable
+    by the scraper, never from outside
+    """
+    value = app.config.get('METRICS_ENABLED', os.environ.get('METRICS_ENABLED'))
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+
+@contextmanager
+def span(name):
+    """
+    times the block into the current request's Server-Timing entry `name`
+    and the span_duration_seconds histogram, a no-op outside a request
+    """
+    stats = current_stats()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            stats.spans[name] = stats.spans.get(name, 0.0) + time.perf_counter() - start
+
+
+class Instrumentation:
+    """
+    per route latency, sql statement counts and times, N+1 detection and
+    named spans for a flask app, in a Server-Timing header on every
+    response and, when metrics_enabled(app), on a prometheus /metrics
+    endpoint that the rate limiter leaves alone.
+
+    latency is measured up to the response object, a streamed body is
+    not included.
+    """
+
+    def __init__(self, app=None, metrics_path='/metrics', n_plus_one_threshold=N_PLUS_ONE_THRESHOLD):
+        self.metrics_path = metrics_path
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.registry = Registry()
+        self.request_latency = self.registry.histogram(
+            'http_request_duration_seconds', 'Time spent handling a request.',
+            ('method', 'route', 'status'))
+        self.sql_queries = self.registry.histogram(
+            'http_request_sql_queries', 'SQL statements executed per request.',
+            ('route',), QUERY_COUNT_BUCKETS)
+        self.sql_latency = self.registry.histogram(
+            'http_request_sql_duration_seconds', 'Time spent in SQL per request.', ('route',))
+        self.n_plus_one = self.registry.counter(
+            'sql_n_plus_one', 'Requests repeating one SQL statement at least {} times.'.format(
+                n_plus_one_threshold), ('route',))
+        self.span_latency = self.registry.histogram(
+            'span_duration_seconds', 'Time spent in named spans, e.g. jwt verification.', ('span',))
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['instrumentation'] = self
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        if self.metrics_path and metrics_enabled(app):
+            def metrics():
+                return self.metrics_view()
+            # scrapes are not rate limited, as if decorated with RateLimiter.limit(None)
+            metrics.rate_limit = None
+            app.add_url_rule(self.metrics_path, 'metrics', metrics)
+
+    def metrics_view(self):
+        return self.registry.exposition(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    def _before_request(self):
+        g.request_stats = RequestStats()
+
+    def _record(self, stats, status):
+        stats.recorded = True
+        elapsed = time.perf_counter() - stats.started
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        if route == self.metrics_path:
+            return elapsed
+
+        self.request_latency.observe(elapsed, request.method, route, str(status))
+        self.sql_queries.observe(stats.sql_count, route)
+        self.sql_latency.observe(stats.sql_time, route)
+        for name, seconds in stats.spans.items():
+            self.span_latency.observe(seconds, name)
+
+        if stats.statements:
+            statement, count = stats.statements.most_common(1)[0]
+            if count >= self.n_plus_one_threshold:
+                self.n_plus_one.inc(route)
+                current_app.logger.warning('possible N+1 on %s %s: %d x %s', request.method, route,
+                                           count, ' '.join(statement.split())[:200])
+        return elapsed
+
+    def _after_request(self, response):
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+        elapsed = self._record(stats, response.status_code)
+
+        timings = ['app;dur={:.2f}'.format(elapsed * 1000),
+                   'db;desc="{} queries";dur={:.2f}'.format(stats.sql_count, stats.sql_time * 1000)]
+        timings.extend('{};dur={:.2f}'.format(name, seconds * 1000) for name, seconds in stats.spans.items())
+        response.headers['Server-Timing'] = ', '.join(timings)
+        return response
+
+    def _teardown_request(self, exc):
+        stats = g.get('request_stats')
+        # an unhandled error skips after_request, count it as a 500
+        if stats is not None and not stats.recorded:
+            self._record(stats, 500)
@@ -0,0 +1,54 @@
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class FastJSONEncoder(JSONEncoder):
+    """
+    flask's JSONEncoder, encoding with orjson when it is installed.
+    orjson only takes over compact output (indent None); pretty printing,
+    values it cannot encode (e.g. ints over 64 bits) and a missing orjson
+    all fall back to the stdlib encoder, so the output is always valid.
+    datetimes still go through flask's default() (http dates).
+    non-ascii text is written as utf-8 rather than \\u escapes.
+    """
+
+    def encode(self, o):
+        if orjson is None or self.indent is not None:
+            return super().encode(o)
+
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME \
+                 | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(o, default=self.default, option=option).decode('utf-8')
+        except TypeError:
+            return super().encode(o)
+
+
+def dumps_bytes(o, sort_keys=False):
+    """
+    encodes o straight to compact utf-8 bytes, for bodies built outside
+    jsonify (streamed rows, cached responses)
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0)
+        try:
+            return orjson.dumps(o, option=option)
+        except TypeError:
+            pass
+    return FastJSONEncoder(separators=(',', ':'), sort_keys=sort_keys).encode(o).encode('utf-8')
+
+
+def install_json(app, pretty=False):
+    """
+    makes app use FastJSONEncoder for jsonify / flask.json.
+    JSONIFY_PRETTYPRINT_REGULAR is set to pretty, off by default. flask
+    still pretty prints in debug mode, through the stdlib encoder.
+    """
+    app.json_encoder = FastJSONEncoder
+    app.config['JSONIFY_PRETTYPRINT_REGULAR'] = pretty
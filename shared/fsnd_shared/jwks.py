@@ -0,0 +1,134 @@
+import json
+import re
+import threading
+import time
+from urllib.request import urlopen
+
+DEFAULT_TTL = 10 * 60
+REFRESH_AHEAD = 0.8
+MIN_REFETCH_INTERVAL = 30
+FETCH_TIMEOUT = 5
+
+
+class JWKSError(Exception):
+    pass
+
+
+class JWKSProvider:
+    """Caches the signing keys of a JWKS endpoint as a kid -> key dict.
+
+    url can be the Auth0 /.well-known/jwks.json address, a local server or
+    a file:// path (handy in tests).
+    Keys are kept for the max-age the endpoint sends in Cache-Control
+    (DEFAULT_TTL if it sends none). Past REFRESH_AHEAD of that time a single
+    background thread refetches them while the old keys keep being served.
+    An unknown kid forces a refetch to pick up rotated keys.
+    Fetch attempts, refresh-ahead and unknown kid ones alike, are at least
+    MIN_REFETCH_INTERVAL seconds apart, whether or not the last succeeded,
+    and a failed attempt never shortens the life of the keys already held.
+    With no keys held yet, get_key raises JWKSError right away for
+    MIN_REFETCH_INTERVAL seconds after a failed fetch instead of every
+    waiting request trying the endpoint again.
+    """
+
+    def __init__(self, url, default_ttl=DEFAULT_TTL,
+                 min_refetch_interval=MIN_REFETCH_INTERVAL, timeout=FETCH_TIMEOUT):
+        self.url = url
+        self.default_ttl = default_ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self._keys = None
+        self._fetched_at = 0.0
+        self._attempted_at = 0.0
+        self._expires_at = 0.0
+        # when the last fetch without any keys to fall back on failed
+        self._cold_failed_at = None
+        # held by whoever is fetching, so only one fetch runs at a time
+        self._fetch_lock = threading.Lock()
+
+    def get_key(self, kid):
+        """Returns the rsa key for kid, or None if the endpoint has no such key.
+        Raises JWKSError if the keys cannot be fetched and none are cached.
+        """
+        now = time.monotonic()
+        if self._keys is None or now >= self._expires_at:
+            self._fetch_blocking(self._attempted_at)
+        elif now >= self._fetched_at + REFRESH_AHEAD * (self._expires_at - self._fetched_at) \
+                and now - self._attempted_at >= self.min_refetch_interval:
+            self._refresh_in_background()
+
+        key = self._keys.get(kid)
+        if key is None and time.monotonic() - self._attempted_at >= self.min_refetch_interval:
+            # the signing key may have been rotated since the last fetch
+            self._fetch_blocking(self._attempted_at)
+            key = self._keys.get(kid)
+        return key
+
+    def _fetch_blocking(self, seen_attempted_at):
+        self._check_cold_failure()
+        with self._fetch_lock:
+            # another thread fetched while this one waited for the lock
+            if self._keys is not None and self._attempted_at != seen_attempted_at:
+                return
+            # or failed to, the endpoint is not asked again so soon
+            self._check_cold_failure()
+            try:
+                self._fetch()
+            except Exception as e:
+                if self._keys is None:
+                    self._cold_failed_at = time.monotonic()
+                    raise JWKSError('Unable to fetch the JWKS from {}'.format(self.url)) from e
+                # keep serving the keys we have, expired ones for a bit
+                # longer, and retry later
+                self._expires_at = max(self._expires_at, time.monotonic() + self.min_refetch_interval)
+
+    def _check_cold_failure(self):
+        failed_at = self._cold_failed_at
+        if self._keys is None and failed_at is not None \
+                and time.monotonic() - failed_at < self.min_refetch_interval:
+            raise JWKSError('Unable to fetch the JWKS from {}, retrying in at most {} seconds'
+                            .format(self.url, self.min_refetch_interval))
+
+    def _refresh_in_background(self):
+        if not self._fetch_lock.acquire(blocking=False):
+            return
+
+        def refresh():
+            try:
+                self._fetch()
+            except Exception:
+                # _fetch recorded the attempt, get_key waits
+                # min_refetch_interval before the next one
+                pass
+            finally:
+                self._fetch_lock.release()
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _fetch(self):
+        self._attempted_at = time.monotonic()
+        with urlopen(self.url, timeout=self.timeout) as response:
+            jwks = json.loads(response.read())
+            headers = getattr(response, 'headers', None)
+            cache_control = headers.get('Cache-Control', '') if headers else ''
+
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+
+        now = time.monotonic()
+        self._keys = keys
+        self._fetched_at = now
+        self._expires_at = now + self._ttl(cache_control)
+
+    def _ttl(self, cache_control):
+        if 'no-store' in cache_control or 'no-cache' in cache_control:
+            return self.min_refetch_interval
+        match = re.search(r'max-age=(\d+)', cache_control)
+        return int(match.group(1)) if match else self.default_ttl
@@ -0,0 +1,123 @@
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+from jose import jwt
+
+DEFAULT_TIMEOUT = 1.0
+# tokens queued per worker before verification goes inline
+PENDING_PER_WORKER = 8
+
+
+def _decode(token, key, options):
+    return jwt.decode(token, key, **options)
+
+
+def _ready(_):
+    return os.getpid()
+
+
+class JWTVerifyExecutor:
+    """Runs jwt.decode in worker processes, so RS256 verification of a burst
+    of fresh tokens (a shift change, every client logging in at once) uses
+    every core instead of holding the GIL in the request threads.
+
+    workers=0 verifies inline, as before. Otherwise at most max_pending
+    tokens wait for the pool; past that bound, after timeout seconds, or
+    when the pool has broken, the token is verified inline in the calling
+    thread, so a request never fails for lack of a worker.
+    jwt.decode errors (expired, bad claims, bad signature) are raised as if
+    it had been called directly. Workers are spawned, not forked, as the
+    app has threads running by then.
+    """
+
+    def __init__(self, workers=0, max_pending=None, timeout=DEFAULT_TIMEOUT, mp_context='spawn'):
+        self.workers = workers
+        self.max_pending = max_pending if max_pending is not None else workers * PENDING_PER_WORKER
+        self.timeout = timeout
+        self._mp_context = mp_context
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(self.max_pending)
+        self._pool = None
+        self.offloaded = 0
+        self.fallbacks = {'queue_full': 0, 'timeout': 0, 'broken': 0}
+
+    @classmethod
+    def from_env(cls, environ=os.environ):
+        """JWT_VERIFY_WORKERS (0, inline, when unset), JWT_VERIFY_QUEUE and
+        JWT_VERIFY_TIMEOUT in seconds."""
+        queue = environ.get('JWT_VERIFY_QUEUE')
+        return cls(int(environ.get('JWT_VERIFY_WORKERS') or 0),
+                   int(queue) if queue else None,
+                   float(environ.get('JWT_VERIFY_TIMEOUT') or DEFAULT_TIMEOUT))
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context(self._mp_context))
+            return self._pool
+
+    def _reset(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _fallback(self, reason):
+        with self._lock:
+            self.fallbacks[reason] += 1
+
+    def start(self):
+        """Starts the workers now instead of on the first token."""
+        if self.workers:
+            list(self._get_pool().map(_ready, range(self.workers)))
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def decode(self, token, key, **options):
+        """jwt.decode(token, key, **options), in a worker when one is free."""
+        if not self.workers:
+            return jwt.decode(token, key, **options)
+        if not self._slots.acquire(blocking=False):
+            self._fallback('queue_full')
+            return jwt.decode(token, key, **options)
+
+        pool = self._get_pool()
+        try:
+            future = pool.submit(_decode, token, key, options)
+        except RuntimeError:
+            # BrokenProcessPool, or a pool shut down under us
+            self._slots.release()
+            self._reset(pool)
+            self._fallback('broken')
+            return jwt.decode(token, key, **options)
+        # the slot is freed once the worker is done, even after a timeout
+        future.add_done_callback(lambda f: self._slots.release())
+        with self._lock:
+            self.offloaded += 1
+
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self._fallback('timeout')
+        except BrokenProcessPool:
+            self._reset(pool)
+            self._fallback('broken')
+        return jwt.decode(token, key, **options)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'offloaded': self.offloaded,
+                'fallbacks': dict(self.fallbacks)
+            }
@@ -0,0 +1,136 @@
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+# QueuePool's own default
+MAX_OVERFLOW = 10
+
+
+class PoolMetrics:
+    """
+    counters for the connection pool: checkouts, time spent waiting for a
+    connection (includes opening a new one), timeouts, and the pool's
+    current size / usage in snapshot(). register_metrics() puts them on
+    the /metrics registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self.max_overflow = MAX_OVERFLOW
+        self.reset()
+
+    def attach(self, pool, max_overflow):
+        """pool: the pool to report on, max_overflow: the one it was built with"""
+        self._pool = pool
+        self.max_overflow = max_overflow
+
+    def reset(self):
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def record_checkout(self, waited, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def snapshot(self):
+        with self._lock:
+            data = {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max
+            }
+        pool = self._pool
+        if pool is not None:
+            data.update({
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'overflow': max(pool.overflow(), 0)
+            })
+        return data
+
+    def saturated(self):
+        """true when every connection the pool may open is checked out"""
+        pool = self._pool
+        # max_overflow -1 means no limit
+        if pool is None or self.max_overflow < 0:
+            return False
+        return pool.checkedout() >= pool.size() + self.max_overflow
+
+    def register_metrics(self, registry, prefix='db_pool'):
+        """
+        exposes the counters and the pool's usage on an instrumentation
+        Registry, read on every /metrics scrape. usage reads 0 until a
+        TimedQueuePool is attached, sqlite has none
+        """
+        def read(key):
+            return lambda: self.snapshot().get(key, 0)
+        registry.gauge(prefix + '_checkouts', 'Connections checked out of the pool.',
+                       read('checkouts'), kind='counter')
+        registry.gauge(prefix + '_timeouts', 'Checkouts that timed out waiting for a connection.',
+                       read('timeouts'), kind='counter')
+        registry.gauge(prefix + '_wait_seconds', 'Time spent waiting for a connection.',
+                       read('wait_seconds_total'), kind='counter')
+        registry.gauge(prefix + '_wait_seconds_max', 'Longest wait for a connection.', read('wait_seconds_max'))
+        registry.gauge(prefix + '_size', 'Connections the pool keeps open.', read('size'))
+        registry.gauge(prefix + '_checked_out', 'Connections in use.', read('checked_out'))
+        registry.gauge(prefix + '_overflow', 'Connections open past the pool size.', read('overflow'))
+        registry.gauge(prefix + '_saturated', '1 while every connection the pool may open is in use.',
+                       lambda: int(self.saturated()))
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that reports checkout waits and timeouts to pool_metrics
+    """
+
+    def __init__(self, creator, max_overflow=MAX_OVERFLOW, **kwargs):
+        super().__init__(creator, max_overflow=max_overflow, **kwargs)
+        pool_metrics.attach(self, max_overflow)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            pool_metrics.record_checkout(time.perf_counter() - start, timed_out=True)
+            raise
+        pool_metrics.record_checkout(time.perf_counter() - start)
+        return conn
+
+
+def engine_options(database_path, pool_size=None, max_overflow=None, pool_timeout=None,
+                   pool_recycle=None, pool_pre_ping=True, statement_timeout=None):
+    """
+    builds SQLALCHEMY_ENGINE_OPTIONS for setup_db.
+    pool settings are left out for sqlite, which does not use a QueuePool.
+    statement_timeout is in milliseconds and only applies to postgres.
+    """
+    options = {'pool_pre_ping': pool_pre_ping}
+    if database_path.startswith('sqlite'):
+        return options
+
+    # max_overflow is always passed, pool_metrics.saturated() needs it
+    options['poolclass'] = TimedQueuePool
+    options['max_overflow'] = max_overflow if max_overflow is not None else MAX_OVERFLOW
+    for key, value in (('pool_size', pool_size), ('pool_timeout', pool_timeout),
+                       ('pool_recycle', pool_recycle)):
+        if value is not None:
+            options[key] = value
+    if statement_timeout is not None and database_path.startswith('postgres'):
+        options['connect_args'] = {'options': '-c statement_timeout={}'.format(int(statement_timeout))}
+    return options
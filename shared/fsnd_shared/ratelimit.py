@@ -0,0 +1,229 @@
+import math
+import threading
+import time
+
+from flask import abort, g, request
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+MAX_BUCKETS = 100000
+UNITS = {'second': 1, 'minute': 60, 'hour': 3600}
+
+# one round trip: refill by the time elapsed, then take a token if there is one.
+# returns the seconds to wait for the next token, 0 when one was taken
+TOKEN_BUCKET_LUA = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local tokens, stamp = tonumber(state[1]), tonumber(state[2])
+if tokens == nil then
+  tokens, stamp = burst, now
+end
+tokens = math.min(burst, tokens + math.max(0, now - stamp) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens, 'stamp', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class Limit:
+    """
+    a token bucket budget: `rate` tokens a second refill a bucket holding
+    at most `burst`, every request takes one
+    """
+
+    __slots__ = ('rate', 'burst')
+
+    def __init__(self, rate, burst=None):
+        if rate <= 0:
+            raise ValueError('rate must be positive')
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+
+    @classmethod
+    def parse(cls, value, burst=None):
+        """
+        value: '10/second', '300/minute', '1000/hour' or a Limit
+        burst defaults to the count, so '300/minute' allows 300 at once
+        """
+        if isinstance(value, Limit):
+            return value
+        count, _, unit = value.partition('/')
+        if unit.strip() not in UNITS:
+            raise ValueError('unknown rate limit {}'.format(value))
+        count = float(count)
+        return cls(count / UNITS[unit.strip()], burst if burst is not None else count)
+
+    def __repr__(self):
+        return 'Limit({:g}/s, burst {:g})'.format(self.rate, self.burst)
+
+
+class MemoryStorage:
+    """
+    buckets in a dict, per process. a take is a dict lookup and a little
+    arithmetic under a lock.
+    """
+
+    def __init__(self, max_buckets=MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, limit, now=None):
+        """returns 0 when a token was taken, else the seconds until there is one"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_buckets:
+                    self._prune(now)
+                bucket = self._buckets[key] = [limit.burst, now, limit]
+            else:
+                bucket[0] = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / limit.rate
+
+    def _prune(self, now):
+        # a bucket idle long enough to be full again is the same as no bucket
+        idle = [key for key, (tokens, stamp, limit) in self._buckets.items()
+                if tokens + (now - stamp) * limit.rate >= limit.burst]
+        for key in idle:
+            del self._buckets[key]
+        if len(self._buckets) >= self.max_buckets:
+            self._buckets.clear()
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class RedisStorage:
+    """
+    buckets in redis, or any server speaking its protocol (a local
+    keydb, dragonfly, ...), shared by every worker process. costs one
+    round trip per request; when the server is unreachable requests are
+    let through rather than failed.
+    """
+
+    def __init__(self, client, prefix='ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+        self._script = client.register_script(TOKEN_BUCKET_LUA)
+
+    @classmethod
+    def from_url(cls, url):
+        if redis is None:
+            raise RuntimeError('the redis package is needed for {}'.format(url))
+        return cls(redis.Redis.from_url(url, socket_timeout=0.05))
+
+    def take(self, key, limit, now=None):
+        now = time.time() if now is None else now
+        try:
+            return float(self._script(keys=[self.prefix + key], args=[limit.rate, limit.burst, now]))
+        except redis.RedisError:
+            return 0.0
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def storage_from_url(url):
+    """None or 'memory://' for in process buckets, redis:// for shared ones"""
+    if not url or url.startswith('memory://'):
+        return MemoryStorage()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStorage.from_url(url)
+    raise ValueError('unknown rate limit storage {}'.format(url))
+
+
+def remote_address(req):
+    return req.remote_addr or ''
+
+
+class RateLimiter:
+    """
+    per client token buckets in front of every route.
+
+    routes share the `default` budget unless they have their own through
+    @limiter.limit('10/second'), limit(None) exempts one. a client is
+    whatever key_func(request) returns, the remote address by default. a client
+    over budget gets a 429 with Retry-After.
+
+    shed: optional callable, while it returns true the routes with their
+    own budget (the expensive ones) answer 503 with Retry-After right
+    away instead of queueing for a db connection.
+
+    set enabled to False to let everything through, e.g. in benchmarks.
+    """
+
+    def __init__(self, app=None, default=None, storage=None, key_func=remote_address, shed=None):
+        self.default = Limit.parse(default) if default is not None else None
+        self.storage = storage if storage is not None else MemoryStorage()
+        self.key_func = key_func
+        self.shed = shed
+        self.enabled = True
+        # endpoint -> (limit, bucket scope), resolved on first use
+        self._routes = {}
+        self._view_functions = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['ratelimiter'] = self
+        self._view_functions = app.view_functions
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+    def limit(self, value, burst=None):
+        limit = Limit.parse(value, burst) if value is not None else None
+
+        def decorator(f):
+            f.rate_limit = limit
+            return f
+        return decorator
+
+    def _route(self, endpoint):
+        view = self._view_functions.get(endpoint)
+        if hasattr(view, 'rate_limit'):
+            route = self._routes[endpoint] = (view.rate_limit, endpoint + ':')
+        else:
+            route = self._routes[endpoint] = (self.default, None)
+        return route
+
+    def _before_request(self):
+        # this runs for every request, so the request proxy is resolved once
+        # and the route's budget is looked up in a plain dict
+        if not self.enabled:
+            return
+        req = request._get_current_object()
+        route = self._routes.get(req.endpoint) or self._route(req.endpoint)
+        limit, scope = route
+        if limit is None:
+            return
+
+        if scope is not None and self.shed is not None and self.shed():
+            g.retry_after = 1
+            abort(503)
+
+        wait = self.storage.take((scope or '*:') + self.key_func(req), limit)
+        if wait:
+            g.retry_after = max(1, math.ceil(wait))
+            abort(429)
+
+    def _after_request(self, response):
+        retry_after = g.get('retry_after')
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(retry_after)
+        return response
@@ -0,0 +1,100 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+MAX_TOKENS = 10000
+
+# permissions is the payload's permissions claim as a frozenset, None if absent
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions'])
+
+
+class VerifiedTokenCache:
+    """Bounded LRU of sha256(token) -> VerifiedToken for tokens that passed
+    signature and claims verification, so a reused bearer token skips RS256.
+
+    Entries are dropped at the token's own exp claim, and the least recently
+    used ones once max_size is reached.
+    Lookup counts and the time spent in get() are kept for stats().
+    """
+
+    def __init__(self, max_size=MAX_TOKENS):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+
+    @staticmethod
+    def _key(token):
+        if isinstance(token, str):
+            token = token.encode('utf-8')
+        return hashlib.sha256(token).digest()
+
+    def get(self, token):
+        """Returns the cached VerifiedToken, None if unknown or expired."""
+        start = time.perf_counter()
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            self.lookup_seconds += time.perf_counter() - start
+        return entry[1] if entry is not None else None
+
+    def peek(self, token):
+        """Like get(), without counting the lookup or touching the LRU order."""
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return entry[1]
+
+    def put(self, token, payload):
+        """Caches a verified payload and returns its VerifiedToken."""
+        permissions = payload.get('permissions')
+        verified = VerifiedToken(payload, frozenset(permissions) if permissions is not None else None)
+        exp = payload.get('exp')
+        # tokens without an expiry are never cached
+        if not isinstance(exp, (int, float)):
+            return verified
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (exp, verified)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return verified
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def register_metrics(self, registry, prefix='jwt_token_cache'):
+        """Exposes the size, hit and miss counts and mean lookup time on an
+        instrumentation Registry, read on every /metrics scrape."""
+        registry.gauge(prefix + '_size', 'Verified tokens cached.', lambda: len(self._entries))
+        registry.gauge(prefix + '_hits', 'Verified token cache hits.', lambda: self.hits, kind='counter')
+        registry.gauge(prefix + '_misses', 'Verified token cache misses.', lambda: self.misses,
+                       kind='counter')
+        registry.gauge(prefix + '_mean_lookup_microseconds', 'Mean time of a verified token cache lookup.',
+                       lambda: self.stats()['mean_lookup_us'])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'mean_lookup_us': self.lookup_seconds / lookups * 1e6 if lookups else 0.0
+            }
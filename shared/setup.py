@@ -0,0 +1,13 @@
+from setuptools import setup
+
+setup(
+    name='fsnd-shared',
+    version='0.1.0',
+    description='Flask helpers shared by the trivia API, the coffee shop, BasicFlaskAuth and the capstone',
+    packages=['fsnd_shared'],
+    python_requires='>=3.6',
+    install_requires=[
+        'Flask>=1.0',
+        'SQLAlchemy>=1.3',
+    ],
+)
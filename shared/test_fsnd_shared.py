@@ -0,0 +1,419 @@
+import concurrent.futures
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import types
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+from unittest import mock
+
+from flask import Flask, jsonify
+from jose import jwt
+from jose.exceptions import ExpiredSignatureError, JWTError
+from sqlalchemy import exc
+
+from fsnd_shared import json_provider, jwks as jwks_module, jwt_executor as jwt_executor_module, \
+    token_cache as token_cache_module
+from fsnd_shared.instrumentation import Registry
+from fsnd_shared.json_provider import FastJSONEncoder, dumps_bytes, install_json
+from fsnd_shared.jwks import JWKSError, JWKSProvider
+from fsnd_shared.jwt_executor import JWTVerifyExecutor
+from fsnd_shared.pool import MAX_OVERFLOW, TimedQueuePool, engine_options, pool_metrics
+from fsnd_shared.token_cache import VerifiedTokenCache
+
+
+class JWKSProviderTestCase(unittest.TestCase):
+    """the cached signing keys, read from a file:// JWKS on a fake clock"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'jwks.json')
+        self.write('k1')
+        self.now = 1000.0
+        clock = mock.patch.object(jwks_module, 'time', types.SimpleNamespace(monotonic=lambda: self.now))
+        clock.start()
+        self.addCleanup(clock.stop)
+        self.provider = JWKSProvider('file://' + self.path, default_ttl=600, min_refetch_interval=30)
+        self.fetches = 0
+        fetch = self.provider._fetch
+
+        def counted_fetch():
+            self.fetches += 1
+            fetch()
+        self.provider._fetch = counted_fetch
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, *kids):
+        with open(self.path, 'w') as f:
+            json.dump({'keys': [{'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'AQAB'}
+                                for kid in kids]}, f)
+
+    def get_key(self, kid):
+        key = self.provider.get_key(kid)
+        # a background refresh holds the lock until it is done
+        with self.provider._fetch_lock:
+            pass
+        return key
+
+    def test_refresh_ahead(self):
+        self.assertEqual(self.get_key('k1')['kid'], 'k1')
+        self.write('k1', 'k2')
+        self.now += 500
+
+        # served from the old keys while the refresh runs
+        self.assertEqual(self.get_key('k1')['kid'], 'k1')
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.get_key('k2')['kid'], 'k2')
+        self.assertEqual(self.fetches, 2)
+
+    def test_failed_refresh_backs_off(self):
+        self.get_key('k1')
+        os.remove(self.path)
+        self.now += 500
+
+        for i in range(5):
+            self.assertEqual(self.get_key('k1')['kid'], 'k1')
+        self.assertEqual(self.fetches, 2)
+        self.now += 30
+        self.get_key('k1')
+        self.assertEqual(self.fetches, 3)
+
+    def test_expired_keys_outlive_failed_fetch(self):
+        self.get_key('k1')
+        os.remove(self.path)
+        self.now += 600
+
+        self.assertEqual(self.get_key('k1')['kid'], 'k1')
+        self.now += 10
+        self.assertEqual(self.get_key('k1')['kid'], 'k1')
+        self.assertEqual(self.fetches, 2)
+
+    def test_no_keys_raises(self):
+        os.remove(self.path)
+        with self.assertRaises(JWKSError):
+            self.get_key('k1')
+
+    def test_failed_cold_fetch_backs_off(self):
+        os.remove(self.path)
+        for i in range(5):
+            with self.assertRaises(JWKSError):
+                self.get_key('k1')
+        self.assertEqual(self.fetches, 1)
+
+        self.write('k1')
+        self.now += 29
+        with self.assertRaises(JWKSError):
+            self.get_key('k1')
+        self.now += 1
+        self.assertEqual(self.get_key('k1')['kid'], 'k1')
+        self.assertEqual(self.fetches, 2)
+
+    def test_unknown_kid_refetch(self):
+        self.get_key('k1')
+        self.write('k1', 'k2')
+
+        # too soon after the last fetch
+        self.assertIsNone(self.get_key('k2'))
+        self.now += 30
+        self.assertEqual(self.get_key('k2')['kid'], 'k2')
+        self.assertEqual(self.fetches, 2)
+
+    def test_failed_unknown_kid_refetch_keeps_expiry(self):
+        self.get_key('k1')
+        expires_at = self.provider._expires_at
+        os.remove(self.path)
+        self.now += 30
+
+        self.assertIsNone(self.get_key('k2'))
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.provider._expires_at, expires_at)
+
+
+class VerifiedTokenCacheTestCase(unittest.TestCase):
+    """verified tokens, kept until their exp or LRU eviction"""
+
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.patch.object(token_cache_module, 'time', types.SimpleNamespace(
+            time=lambda: self.now, perf_counter=time.perf_counter))
+        clock.start()
+        self.addCleanup(clock.stop)
+
+    def test_expires_at_exp(self):
+        cache = VerifiedTokenCache()
+        cache.put('t', {'sub': 'a', 'exp': 1010, 'permissions': ['get:drinks-detail']})
+        cache.put('no-exp', {'sub': 'b'})
+
+        self.assertEqual(cache.get('t').permissions, frozenset(['get:drinks-detail']))
+        self.assertIsNone(cache.get('no-exp'))
+        self.now = 1010
+        self.assertIsNone(cache.get('t'))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_lru_eviction(self):
+        cache = VerifiedTokenCache(max_size=2)
+        cache.put('a', {'sub': 'a', 'exp': 2000})
+        cache.put('b', {'sub': 'b', 'exp': 2000})
+        cache.get('a')
+        cache.put('c', {'sub': 'c', 'exp': 2000})
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual([cache.get(t).payload['sub'] for t in ('a', 'c')], ['a', 'c'])
+        stats = cache.stats()
+        self.assertEqual((stats['size'], stats['hits'], stats['misses']), (2, 3, 1))
+
+
+class JSONProviderTestCase(unittest.TestCase):
+    """FastJSONEncoder on orjson, its stdlib fallbacks, and install_json"""
+
+    def encode(self, o, **options):
+        return FastJSONEncoder(**options).encode(o)
+
+    @unittest.skipIf(json_provider.orjson is None, 'orjson is not installed')
+    def test_orjson_path(self):
+        with mock.patch.object(json_provider.orjson, 'dumps', wraps=json_provider.orjson.dumps) as dumps:
+            body = self.encode({'b': 1, 'a': 'caf\u00e9', 'c': None}, sort_keys=True)
+
+        self.assertEqual(dumps.call_count, 1)
+        # compact, and utf-8 rather than \u escapes
+        self.assertEqual(body, '{"a":"caf\u00e9","b":1,"c":null}')
+
+    def test_stdlib_fallback(self):
+        # orjson stops at 64 bit ints
+        self.assertEqual(json.loads(self.encode({'n': 2 ** 70})), {'n': 2 ** 70})
+        with mock.patch.object(json_provider, 'orjson', None):
+            self.assertEqual(self.encode({'a': [1, 2]}), '{"a": [1, 2]}')
+
+    def test_indent_uses_stdlib(self):
+        self.assertEqual(self.encode({'a': 1}, indent=2), '{\n  "a": 1\n}')
+
+    def test_datetime_through_flask_default(self):
+        at = datetime.datetime(2020, 1, 2, 3, 4, 5)
+
+        self.assertEqual(json.loads(self.encode({'at': at})), {'at': 'Thu, 02 Jan 2020 03:04:05 GMT'})
+        with mock.patch.object(json_provider, 'orjson', None):
+            self.assertEqual(json.loads(self.encode({'at': at})), {'at': 'Thu, 02 Jan 2020 03:04:05 GMT'})
+
+    def test_dumps_bytes(self):
+        self.assertEqual(dumps_bytes({'b': 1, 'a': 2}, sort_keys=True), b'{"a":2,"b":1}')
+        self.assertEqual(json.loads(dumps_bytes({'n': 2 ** 70})), {'n': 2 ** 70})
+        with mock.patch.object(json_provider, 'orjson', None):
+            self.assertEqual(dumps_bytes({'b': 1, 'a': 2}, sort_keys=True), b'{"a":2,"b":1}')
+
+    def make_app(self, **options):
+        app = Flask(__name__)
+        app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
+        install_json(app, **options)
+
+        @app.route('/')
+        def index():
+            return jsonify({'b': 1, 'a': [1, 2]})
+        return app
+
+    def test_install_json_compact(self):
+        app = self.make_app()
+
+        self.assertIs(app.json_encoder, FastJSONEncoder)
+        self.assertEqual(app.test_client().get('/').data, b'{"a":[1,2],"b":1}\n')
+
+    def test_install_json_pretty(self):
+        body = self.make_app(pretty=True).test_client().get('/').data
+
+        self.assertTrue(body.startswith(b'{\n  "a": ['))
+        self.assertEqual(json.loads(body), {'a': [1, 2], 'b': 1})
+
+
+class PoolTestCase(unittest.TestCase):
+    """engine_options and the pool counters, on a pool of sqlite memory connections"""
+
+    def setUp(self):
+        self.addCleanup(pool_metrics.attach, pool_metrics._pool, pool_metrics.max_overflow)
+        pool_metrics.reset()
+        self.pool = self.make_pool(max_overflow=1)
+
+    def make_pool(self, **options):
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1, timeout=0.01, **options)
+        self.addCleanup(pool.dispose)
+        return pool
+
+    def test_engine_options(self):
+        self.assertEqual(engine_options('sqlite:///trivia.db', pool_size=5), {'pool_pre_ping': True})
+        self.assertEqual(engine_options('postgres://localhost/trivia', pool_size=5, pool_timeout=2,
+                                        statement_timeout=1500), {
+            'pool_pre_ping': True,
+            'poolclass': TimedQueuePool,
+            'pool_size': 5,
+            'max_overflow': MAX_OVERFLOW,
+            'pool_timeout': 2,
+            'connect_args': {'options': '-c statement_timeout=1500'}
+        })
+        # statement_timeout is postgres only
+        self.assertEqual(engine_options('mysql://localhost/trivia', max_overflow=0, pool_pre_ping=False,
+                                        statement_timeout=1500),
+                         {'pool_pre_ping': False, 'poolclass': TimedQueuePool, 'max_overflow': 0})
+
+    def test_checkouts_counted(self):
+        first = self.pool.connect()
+        second = self.pool.connect()
+        with self.assertRaises(exc.TimeoutError):
+            self.pool.connect()
+        second.close()
+        first.close()
+
+        stats = pool_metrics.snapshot()
+        self.assertEqual((stats['checkouts'], stats['timeouts']), (2, 1))
+        self.assertEqual((stats['size'], stats['checked_out']), (1, 0))
+        # the timed out checkout waited out pool_timeout
+        self.assertGreaterEqual(stats['wait_seconds_max'], 0.01)
+        self.assertGreaterEqual(stats['wait_seconds_total'], stats['wait_seconds_max'])
+
+    def test_saturated(self):
+        self.assertEqual(pool_metrics.max_overflow, 1)
+        first = self.pool.connect()
+        self.assertFalse(pool_metrics.saturated())
+        second = self.pool.connect()
+        self.assertTrue(pool_metrics.saturated())
+        second.close()
+        self.assertFalse(pool_metrics.saturated())
+        first.close()
+
+    def test_unbounded_overflow_never_saturated(self):
+        pool = self.make_pool(max_overflow=-1)
+        connections = [pool.connect() for i in range(3)]
+
+        self.assertFalse(pool_metrics.saturated())
+        for connection in connections:
+            connection.close()
+
+    def test_register_metrics(self):
+        registry = Registry()
+        pool_metrics.register_metrics(registry)
+        connection = self.pool.connect()
+        lines = registry.exposition().splitlines()
+        connection.close()
+
+        self.assertIn('# TYPE db_pool_checkouts counter', lines)
+        self.assertIn('db_pool_checkouts_total 1', lines)
+        self.assertIn('db_pool_timeouts_total 0', lines)
+        self.assertIn('db_pool_checked_out 1', lines)
+        self.assertIn('db_pool_saturated 0', lines)
+
+
+class JWTVerifyExecutorTestCase(unittest.TestCase):
+    """offloaded jwt.decode and its inline fallbacks, with HS256 tokens and a thread pool
+    standing in for the worker processes"""
+
+    KEY = 'secret'
+
+    def setUp(self):
+        self.token = self.encode(exp=time.time() + 60)
+
+    def encode(self, key=KEY, **claims):
+        return jwt.encode(dict({'sub': 'tester'}, **claims), key, algorithm='HS256')
+
+    def executor(self, pool=None, **kwargs):
+        executor = JWTVerifyExecutor(workers=1, **kwargs)
+        if pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(1)
+            self.addCleanup(pool.shutdown)
+        executor._pool = pool
+        return executor
+
+    def decode(self, executor, token=None):
+        return executor.decode(token or self.token, self.KEY, algorithms=['HS256'])
+
+    def test_inline_without_workers(self):
+        executor = JWTVerifyExecutor(workers=0)
+
+        with mock.patch.object(executor, '_get_pool', side_effect=AssertionError('no pool')):
+            self.assertEqual(self.decode(executor)['sub'], 'tester')
+        self.assertEqual(executor.stats()['offloaded'], 0)
+
+    def test_offloaded(self):
+        executor = self.executor()
+
+        self.assertEqual(self.decode(executor)['sub'], 'tester')
+        self.assertEqual(executor.stats()['offloaded'], 1)
+        self.assertEqual(executor.stats()['fallbacks'], {'queue_full': 0, 'timeout': 0, 'broken': 0})
+
+    def test_queue_full_goes_inline(self):
+        executor = self.executor(max_pending=0)
+
+        self.assertEqual(self.decode(executor)['sub'], 'tester')
+        self.assertEqual(executor.stats()['offloaded'], 0)
+        self.assertEqual(executor.stats()['fallbacks']['queue_full'], 1)
+
+    def test_timeout_goes_inline(self):
+        executor = self.executor(max_pending=1, timeout=0.05)
+        release = threading.Event()
+
+        def slow_decode(token, key, options):
+            release.wait(5)
+            return jwt.decode(token, key, **options)
+
+        with mock.patch.object(jwt_executor_module, '_decode', slow_decode):
+            self.assertEqual(self.decode(executor)['sub'], 'tester')
+            self.assertEqual(executor.stats()['fallbacks']['timeout'], 1)
+            # the slot stays taken until the worker is done
+            self.assertEqual(self.decode(executor)['sub'], 'tester')
+            self.assertEqual(executor.stats()['fallbacks']['queue_full'], 1)
+            release.set()
+        executor._pool.shutdown(wait=True)
+        self.assertTrue(executor._slots.acquire(blocking=False))
+
+    def test_broken_pool_is_reset(self):
+        broken = mock.Mock()
+        broken.submit.side_effect = BrokenProcessPool('a worker died')
+        executor = self.executor(pool=broken)
+
+        self.assertEqual(self.decode(executor)['sub'], 'tester')
+        self.assertEqual(executor.stats()['fallbacks']['broken'], 1)
+        self.assertIsNone(executor._pool)
+        broken.shutdown.assert_called_once_with(wait=False)
+        # its slot was given back
+        self.assertTrue(executor._slots.acquire(blocking=False))
+
+    def test_pool_breaking_mid_decode_is_reset(self):
+        future = concurrent.futures.Future()
+        future.set_exception(BrokenProcessPool('a worker died'))
+        broken = mock.Mock()
+        broken.submit.return_value = future
+        executor = self.executor(pool=broken)
+
+        self.assertEqual(self.decode(executor)['sub'], 'tester')
+        self.assertEqual(executor.stats()['fallbacks']['broken'], 1)
+        self.assertIsNone(executor._pool)
+
+    def test_decode_errors_propagate(self):
+        expired = self.encode(exp=time.time() - 60)
+        forged = self.encode(key='not the secret', exp=time.time() + 60)
+
+        for executor in (JWTVerifyExecutor(workers=0), self.executor()):
+            with self.assertRaises(ExpiredSignatureError):
+                self.decode(executor, expired)
+            with self.assertRaises(JWTError) as bad_signature:
+                self.decode(executor, forged)
+            self.assertNotIsInstance(bad_signature.exception, ExpiredSignatureError)
+            self.assertEqual(executor.stats()['fallbacks'], {'queue_full': 0, 'timeout': 0, 'broken': 0})
+
+    def test_worker_process(self):
+        executor = JWTVerifyExecutor(workers=1, timeout=30)
+        self.addCleanup(executor.shutdown)
+        executor.start()
+
+        self.assertEqual(self.decode(executor)['sub'], 'tester')
+        with self.assertRaises(ExpiredSignatureError):
+            self.decode(executor, self.encode(exp=time.time() - 60))
+        self.assertEqual(executor.stats()['offloaded'], 2)
+
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()